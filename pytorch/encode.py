@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+import torch
+from torch.autograd import Variable
+
+from models import load_models
+from utils import to_gpu
+
+###############################################################################
+# Encoding methods
+###############################################################################
+
+
+def index_lines(path):
+    """Byte offset of every line in a text file"""
+    offsets = []
+    pos = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            offsets.append(pos)
+            pos += len(line)
+    return np.array(offsets, dtype=np.int64)
+
+
+def read_chunks(path, offset, chunk_size):
+    """Yield lists of up to chunk_size lines, from byte offset on"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        chunk = []
+        for line in f:
+            chunk.append(line.decode('utf-8').rstrip('\n'))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def vectorize(line, word2idx, maxlen, lowercase):
+    """Source indices for a sentence (<sos> + words, truncated to maxlen)"""
+    if lowercase:
+        line = line.lower()
+    words = line.strip().split(" ")[:maxlen]
+    unk_idx = word2idx['<oov>']
+    return [word2idx['<sos>']] + [word2idx.get(w, unk_idx) for w in words]
+
+
+def encode_chunk(autoencoder, lines, word2idx, args):
+    """
+    Encode a chunk of sentences in length-bucketed batches: sentences are
+    sorted by length so each batch needs little padding, then the codes
+    are put back in file order.
+    """
+    sources = [vectorize(l, word2idx, args.maxlen, args.lowercase)
+               for l in lines]
+    order = sorted(range(len(sources)), key=lambda i: -len(sources[i]))
+    codes = np.zeros((len(sources), autoencoder.nhidden), dtype=np.float32)
+
+    for b in range(0, len(order), args.batch_size):
+        batch = order[b:b+args.batch_size]
+        lengths = [len(sources[i]) for i in batch]
+        padded = np.zeros((len(batch), lengths[0]), dtype=np.int64)
+        for row, i in enumerate(batch):
+            padded[row, :lengths[row]] = sources[i]
+        source = to_gpu(args.cuda, Variable(torch.from_numpy(padded)))
+        hidden = autoencoder.encode(source, lengths, noise=False)
+        codes[batch] = hidden.data.cpu().numpy()
+
+    return codes
+
+
+def check_resume(meta, settings, codes, dtype, nhidden):
+    """
+    Refuse to resume into codes written with other settings (model, data,
+    maxlen, precision...) than this run's
+    """
+    changed = [k for k in sorted(settings) if meta.get(k) != settings[k]]
+    if codes.dtype != dtype or codes.shape != (meta['total'], nhidden):
+        changed.append('codes.npy')
+    if changed:
+        raise ValueError("the codes in the output directory were written "
+                         "with different settings ({}); use a new --outf"
+                         .format(", ".join(changed)))
+
+
+def main(args):
+    model_args, idx2word, autoencoder, gan_gen, gan_disc \
+        = load_models(args.load_path)
+    word2idx = {w: i for i, w in idx2word.items()}
+    if args.maxlen is None:
+        args.maxlen = model_args['maxlen']
+    args.lowercase = model_args.get('lowercase', False)
+
+    if args.cuda:
+        autoencoder = autoencoder.cuda()
+        autoencoder.gpu = True
+    autoencoder.eval()
+
+    if not os.path.isdir(args.outf):
+        os.makedirs(args.outf)
+    meta_path = os.path.join(args.outf, "meta.json")
+    codes_path = os.path.join(args.outf, "codes.npy")
+    offsets_path = os.path.join(args.outf, "offsets.npy")
+
+    # everything the stored codes depend on
+    settings = {'data_path': os.path.abspath(args.data_path),
+                'load_path': os.path.abspath(args.load_path),
+                'maxlen': args.maxlen,
+                'lowercase': args.lowercase,
+                'fp16': args.fp16}
+    dtype = np.float16 if args.fp16 else np.float32
+
+    if os.path.exists(meta_path):
+        # resume an interrupted run, with the same settings only
+        meta = json.load(open(meta_path))
+        codes = np.load(codes_path, mmap_mode='r+')
+        offsets = np.load(offsets_path, mmap_mode='r')
+        check_resume(meta, settings, codes, dtype, autoencoder.nhidden)
+        print("Resuming at sentence {} of {}".format(meta['count'],
+                                                    meta['total']))
+    else:
+        offsets = index_lines(args.data_path)
+        np.save(offsets_path, offsets)
+        codes = np.lib.format.open_memmap(
+            codes_path, mode='w+', dtype=dtype,
+            shape=(len(offsets), autoencoder.nhidden))
+        meta = dict(settings, total=len(offsets), count=0)
+
+    start_time = time.time()
+    start = meta['count']
+    if start == meta['total']:
+        return
+    for lines in read_chunks(args.data_path, offsets[start], args.chunk_size):
+        with torch.no_grad():
+            chunk_codes = encode_chunk(autoencoder, lines, word2idx, args)
+        codes[meta['count']:meta['count']+len(lines)] = chunk_codes
+        codes.flush()
+
+        # only record progress once the codes are on disk
+        meta['count'] += len(lines)
+        with open(meta_path+".tmp", 'w') as f:
+            json.dump(meta, f)
+        os.rename(meta_path+".tmp", meta_path)
+
+        elapsed = time.time() - start_time
+        print("{:d}/{:d} sentences | {:.1f} sents/s".
+              format(meta['count'], meta['total'],
+                     (meta['count']-start) / max(elapsed, 1e-6)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PyTorch ARAE corpus encoder')
+    parser.add_argument('--load_path', type=str, required=True,
+                        help='directory to load models from')
+    parser.add_argument('--data_path', type=str, required=True,
+                        help='text file with one sentence per line')
+    parser.add_argument('--outf', type=str, default='./codes',
+                        help='directory to write codes.npy, offsets.npy '
+                             '(byte offset of each sentence in data_path) '
+                             'and meta.json to')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='encoding batch size')
+    parser.add_argument('--chunk_size', type=int, default=100000,
+                        help='sentences read (and length-bucketed) at a time')
+    parser.add_argument('--maxlen', type=int, default=None,
+                        help='truncate sentences to this many tokens '
+                             '(default: the model maxlen)')
+    parser.add_argument('--fp16', action='store_true',
+                        help='store codes as float16')
+    parser.add_argument('--cuda', action='store_true',
+                        help='use CUDA')
+    args = parser.parse_args()
+    print(vars(args))
+    main(args)
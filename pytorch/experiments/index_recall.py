@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from index import ExactIndex, IVFIndex, normalize
+
+
+def recall(ids, exact_ids):
+    """Fraction of the exact k nearest neighbours found, over all queries"""
+    return np.mean([len(np.intersect1d(a, b)) / float(len(b))
+                    for a, b in zip(ids, exact_ids)])
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+    codes = normalize(rng.randn(args.ncodes, args.dim).astype(np.float32))
+    queries = normalize(rng.randn(args.nqueries, args.dim).astype(np.float32))
+    nprobes = [int(x) for x in args.nprobes.split('-')]
+
+    print('{:>7s} {:>5s} {:>7s} {:>8s} {:>10s}'.format(
+        'metric', 'pq_m', 'nprobe', 'recall', 'ms/query'))
+    ok = True
+    for metric in ('cosine', 'l2'):
+        exact_scores, exact_ids = ExactIndex(codes, metric).nearest(
+            queries, args.k)
+        for pq_m in (0, args.pq_m):
+            index = IVFIndex(codes, nlist=args.nlist, metric=metric,
+                             pq_m=pq_m, seed=args.seed)
+            for nprobe in nprobes + [args.nlist]:
+                index.nprobe = nprobe
+                start = time.time()
+                scores, ids = index.nearest(queries, args.k)
+                ms = 1000 * (time.time() - start) / args.nqueries
+                r = recall(ids, exact_ids)
+                print('{:>7s} {:5d} {:7d} {:8.3f} {:10.3f}'.format(
+                    metric, pq_m, nprobe, r, ms))
+                if pq_m == 0 and nprobe == args.nlist:
+                    # every cell scanned: exact up to the float16 storage
+                    ok &= r >= args.min_recall
+
+    print('OK' if ok else 'FAILED: recall with every cell scanned (pq_m 0) '
+          'under --min_recall {}'.format(args.min_recall))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Recall of IVFIndex.nearest against ExactIndex.nearest '
+                    'on random unit codes, for both metrics')
+    parser.add_argument('--ncodes', type=int, default=20000,
+                        help='number of indexed codes')
+    parser.add_argument('--dim', type=int, default=64,
+                        help='code dimension')
+    parser.add_argument('--nqueries', type=int, default=200,
+                        help='number of queries (random unit codes)')
+    parser.add_argument('--k', type=int, default=10,
+                        help='neighbours per query')
+    parser.add_argument('--nlist', type=int, default=64,
+                        help='IVF cells')
+    parser.add_argument('--nprobes', type=str, default='1-4-16',
+                        help='cells scanned per query to report (all nlist '
+                             'cells are always added)')
+    parser.add_argument('--pq_m', type=int, default=8,
+                        help='bytes per code of the product-quantized index')
+    parser.add_argument('--min_recall', type=float, default=0.99,
+                        help='recall required of the unquantized index when '
+                             'it scans every cell')
+    parser.add_argument('--seed', type=int, default=1111,
+                        help='random seed')
+    args = parser.parse_args()
+    sys.exit(0 if main(args) else 1)
@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def current_rss():
+    """Resident memory of this process in bytes (Linux)"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(args):
+    """
+    Time and peak memory of the autoencoder training step (forward, loss,
+    backward) at one maxlen and checkpoint segment, in this process
+    """
+    import torch
+    from torch.autograd import Variable
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if args.yelp:
+        sys.path.insert(0, os.path.join(os.path.dirname(root), 'yelp'))
+        from models import Seq2Seq2Decoder
+        autoencoder = Seq2Seq2Decoder(emsize=args.emsize,
+                                      nhidden=args.nhidden,
+                                      ntokens=args.ntokens,
+                                      nlayers=1,
+                                      arch_latent=str(args.nhidden),
+                                      checkpoint_segment=args.segment,
+                                      gpu=args.cuda)
+    else:
+        sys.path.insert(0, root)
+        from models import Seq2Seq
+        autoencoder = Seq2Seq(emsize=args.emsize,
+                              nhidden=args.nhidden,
+                              ntokens=args.ntokens,
+                              nlayers=1,
+                              checkpoint_segment=args.segment,
+                              gpu=args.cuda)
+    if args.cuda:
+        autoencoder = autoencoder.cuda()
+    autoencoder.train()
+
+    # worst case for memory: every sentence is maxlen long
+    torch.manual_seed(args.seed)
+    lengths = [args.maxlen] * args.batch_size
+    source = torch.LongTensor(args.batch_size, args.maxlen).random_(4, args.ntokens)
+    target = torch.LongTensor(args.batch_size * args.maxlen).random_(4, args.ntokens)
+    if args.cuda:
+        source, target = source.cuda(), target.cuda()
+    source, target = Variable(source), Variable(target)
+
+    def step():
+        autoencoder.zero_grad()
+        if args.yelp:
+            loss, correct = autoencoder(1, source, lengths, noise=False,
+                                        target=target)
+        else:
+            loss, correct = autoencoder(source, lengths, noise=False,
+                                        target=target)
+        loss.backward()
+        if args.cuda:
+            torch.cuda.synchronize()
+
+    # one untimed step first: lazy imports and allocator warm-up would
+    # otherwise be counted against the first configuration's step
+    step()
+
+    if args.cuda:
+        base = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        base = current_rss()
+    start = time.time()
+    for i in range(args.repeats):
+        step()
+    elapsed = (time.time() - start) / args.repeats
+    if args.cuda:
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        # ru_maxrss is in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return {'maxlen': args.maxlen,
+            'segment': args.segment,
+            'batch_size': args.batch_size,
+            'ntokens': args.ntokens,
+            'peak_mb': (peak - base) / 2.0**20,
+            'ms_per_step': elapsed * 1000}
+
+
+def run(args, maxlen, segment):
+    """measure() in a fresh process, so peak memory is per configuration"""
+    command = [sys.executable, os.path.abspath(__file__), '--worker',
+               '--maxlen', str(maxlen), '--segment', str(segment)]
+    for name in ['batch_size', 'emsize', 'nhidden', 'ntokens', 'repeats',
+                 'seed']:
+        command += ['--' + name, str(getattr(args, name))]
+    if args.cuda:
+        command.append('--cuda')
+    if args.yelp:
+        command.append('--yelp')
+    env = dict(os.environ)
+    # a fixed mmap threshold makes glibc return freed tensors to the OS, so
+    # that peak RSS follows the live tensors (CPU)
+    env.setdefault('MALLOC_MMAP_THRESHOLD_', '65536')
+    output = subprocess.check_output(command, env=env).decode('utf-8')
+    return json.loads(output.strip().split('\n')[-1])
+
+
+def main(args):
+    maxlens = [int(x) for x in args.maxlens.split('-')]
+    segments = [int(x) for x in args.segments.split('-')]
+    results = []
+    print('{:>7s} {:>8s} {:>10s} {:>10s} {:>8s} {:>8s}'.format(
+        'maxlen', 'segment', 'peak MB', 'ms/step', 'memory', 'time'))
+    for maxlen in maxlens:
+        base = None
+        for segment in segments:
+            r = run(args, maxlen, segment)
+            if base is None:
+                base = r
+            r['memory_ratio'] = r['peak_mb'] / base['peak_mb']
+            r['time_ratio'] = r['ms_per_step'] / base['ms_per_step']
+            results.append(r)
+            print('{:7d} {:8d} {:10.1f} {:10.1f} {:8.2f} {:8.2f}'.format(
+                maxlen, segment, r['peak_mb'], r['ms_per_step'],
+                r['memory_ratio'], r['time_ratio']))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Memory and time of the autoencoder step with and '
+                    'without activation checkpointing (--checkpoint_segment)')
+    parser.add_argument('--maxlens', type=str, default='30-60-100',
+                        help='sentence lengths to measure')
+    parser.add_argument('--segments', type=str, default='0-10-5',
+                        help='checkpoint segments to compare (0 = off, '
+                             'the baseline for the ratios)')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='batch size')
+    parser.add_argument('--emsize', type=int, default=300,
+                        help='size of word embeddings')
+    parser.add_argument('--nhidden', type=int, default=300,
+                        help='number of hidden units')
+    parser.add_argument('--ntokens', type=int, default=11004,
+                        help='vocabulary size')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='training steps to time per configuration')
+    parser.add_argument('--yelp', action='store_true',
+                        help='measure the two-decoder yelp autoencoder')
+    parser.add_argument('--cuda', action='store_true',
+                        help='use CUDA (peak allocated memory instead of RSS)')
+    parser.add_argument('--seed', type=int, default=1111,
+                        help='random seed')
+    parser.add_argument('--save', type=str, default='',
+                        help='also write the results to this json file')
+    parser.add_argument('--maxlen', type=int, default=30,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--segment', type=int, default=0,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        print(json.dumps(measure(args)))
+    else:
+        main(args)
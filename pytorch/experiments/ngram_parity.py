@@ -0,0 +1,152 @@
+import argparse
+import gzip
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+from ngram import train_kneser_ney
+
+fixture_dir = os.path.join(root, 'experiments', 'ngram_fixture')
+data_dir = os.path.join(os.path.dirname(root), 'yelp', 'data')
+
+
+def load_data(ntrain, neval):
+    """
+    Training and evaluation sentences (lists of words) from the repo's Yelp
+    data, and the vocabulary as lm_eval.py has it (special tokens first, then
+    the training words); the evaluation sentences have words outside it
+    """
+    def read(name, n):
+        with open(os.path.join(data_dir, name), 'r') as f:
+            return [l.split() for l in f.read().split('\n')[:n]]
+    train = read('valid1.txt', ntrain)
+    evals = read('valid2.txt', neval)
+    vocab = ['<pad>', '<sos>', '<eos>', '<oov>'] + \
+        sorted({w for s in train for w in s})
+    return train, evals, vocab
+
+
+def build_fixtures(kenlm_path, train, vocab, orders):
+    """ARPA files of lmplz on the text train_ngram_lm would write"""
+    text = "".join(w+"\n" for w in vocab) + \
+        "".join(" ".join(s)+"\n" for s in train)
+    if not os.path.isdir(fixture_dir):
+        os.makedirs(fixture_dir)
+    for N in orders:
+        arpa = subprocess.run(
+            [os.path.join(kenlm_path, 'build', 'bin', 'lmplz'), '-o', str(N)],
+            input=text.encode('utf-8'), stdout=subprocess.PIPE, check=True)
+        with gzip.open(arpa_path(N), 'wb') as f:
+            f.write(arpa.stdout)
+
+
+def arpa_path(N):
+    return os.path.join(fixture_dir, 'o{}.arpa.gz'.format(N))
+
+
+def read_arpa(path):
+    """log10 probabilities and backoffs of the n-grams (word tuples)"""
+    logp, logbo = {}, {}
+    order = 0
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('\\') and line.endswith('-grams:'):
+                order = int(line[1:].split('-')[0])
+                continue
+            if not line or line.startswith('\\') or order == 0:
+                continue
+            fields = line.split('\t')
+            ngram = tuple(fields[1].split())
+            logp[ngram] = float(fields[0])
+            if len(fields) > 2:
+                logbo[ngram] = float(fields[2])
+    return logp, logbo
+
+
+def arpa_score(logp, logbo, N, sentence, bos=True):
+    """
+    log10 probability of a sentence under an ARPA model, with backoff, as
+    kenlm.Model.score (without </s>)
+    """
+    words = [w if (w,) in logp else '<unk>' for w in sentence]
+    history = ['<s>'] if bos else []
+    total = 0.
+    for w in words:
+        context = history[-(N-1):] if N > 1 else []
+        while tuple(context) + (w,) not in logp:
+            total += logbo.get(tuple(context), 0.)
+            context = context[1:]
+        total += logp[tuple(context) + (w,)]
+        history.append(w)
+    return total
+
+
+def main(args):
+    train, evals, vocab = load_data(args.ntrain, args.neval)
+    orders = [int(x) for x in args.orders.split('-')]
+    if args.kenlm_path:
+        build_fixtures(args.kenlm_path, train, vocab, orders)
+
+    word2idx = {w: i for i, w in enumerate(vocab)}
+    train_ids = [[word2idx[w] for w in s] for s in train]
+    # words not in the vocabulary are -1, as lm_eval.py scores them
+    eval_ids = [[word2idx.get(w, -1) for w in s] for s in evals]
+    noov = sum(1 for s in eval_ids for w in s if w < 0)
+    print('{} training, {} evaluation sentences ({} words not in the '
+          'vocabulary of {})'.format(len(train), len(evals), noov, len(vocab)))
+    print('{:>2s} {:>12s} {:>12s} {:>12s} {:>12s} {:>10s}'.format(
+        'N', 'ppl (lmplz)', 'ppl (numpy)', 'max |diff|', 'no <s> diff',
+        'ppl rdiff'))
+    ok = True
+    for N in orders:
+        logp, logbo = read_arpa(arpa_path(N))
+        lm = train_kneser_ney(train_ids, N=N, vocab_size=len(vocab))
+
+        reference = np.array([arpa_score(logp, logbo, N, s) for s in evals])
+        scores, word_counts = lm.sentence_scores(eval_ids)
+        # from no context, the first word by its unigram probability
+        reference_nobos = np.array([arpa_score(logp, logbo, N, s, bos=False)
+                                    for s in evals])
+        scores_nobos = np.array([lm.score(s, bos=False) for s in eval_ids])
+
+        ppl_ref = 10**-(reference.sum() / word_counts.sum())
+        ppl = 10**-(scores.sum() / word_counts.sum())
+        diff = np.abs(scores - reference).max()
+        diff_nobos = np.abs(scores_nobos - reference_nobos).max()
+        rdiff = abs(ppl - ppl_ref) / ppl_ref
+        print('{:2d} {:12.4f} {:12.4f} {:12.2e} {:12.2e} {:10.2e}'.format(
+            N, ppl_ref, ppl, diff, diff_nobos, rdiff))
+        ok &= max(diff, diff_nobos) <= args.atol and rdiff <= args.rtol
+
+    print('OK' if ok else 'FAILED: over --atol {} or --rtol {}'.format(
+        args.atol, args.rtol))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Check the NumPy Kneser-Ney LM (ngram.py) against KenLM '
+                    'ARPA models built by lmplz on the same text')
+    parser.add_argument('--orders', type=str, default='2-3-4-5',
+                        help='n-gram orders to check')
+    parser.add_argument('--ntrain', type=int, default=200,
+                        help='training sentences (yelp/data/valid1.txt)')
+    parser.add_argument('--neval', type=int, default=200,
+                        help='evaluation sentences (yelp/data/valid2.txt)')
+    parser.add_argument('--atol', type=float, default=1e-4,
+                        help='largest difference allowed in the log10 '
+                             'probability of a sentence')
+    parser.add_argument('--rtol', type=float, default=1e-5,
+                        help='largest relative difference allowed in '
+                             'the perplexity')
+    parser.add_argument('--kenlm_path', type=str, default="",
+                        help='rebuild the ARPA fixtures with the lmplz of '
+                             'this kenlm directory (default: use the '
+                             'committed ones)')
+    args = parser.parse_args()
+    sys.exit(0 if main(args) else 1)
@@ -1,53 +1,118 @@
 import argparse
-from models import load_models, generate
-import torch
+from models import load_models, generate_batches
 import difflib
-import numpy.linalg
+import numpy as np
 
 ENDC = '\033[0m'
 BOLD = '\033[1m'
 
 
+def neighborhoods(anchors, nneighbors, radius=0.1, rng=np.random):
+    """
+    Perturb every anchor code with nneighbors random directions of norm
+    radius. Returns nanchors x (nneighbors+1) x z_size; row 0 of each
+    neighborhood is the anchor itself.
+    """
+    nanchors, z_size = anchors.shape
+    offsets = rng.normal(0, 1, (nanchors, nneighbors, z_size))
+    offsets *= radius / np.linalg.norm(offsets, axis=2, keepdims=True)
+    noise = np.empty((nanchors, nneighbors+1, z_size), dtype=np.float32)
+    noise[:, 0] = anchors
+    noise[:, 1:] = anchors[:, None, :] + offsets
+    return noise
+
+
+def explore(anchors, nneighbors, radius=0.1, batch_size=1000,
+            rng=np.random):
+    """
+    Decode the neighborhoods of all anchors in one chunked batch.
+    Returns an nanchors x (nneighbors+1) array of sentences.
+    """
+    noise = neighborhoods(anchors, nneighbors, radius, rng)
+    nanchors, size, z_size = noise.shape
+    sents = gen(noise.reshape(nanchors*size, z_size), batch_size)
+    return np.array(sents, dtype=object).reshape(nanchors, size)
+
+
+def neighborhood_stats(sents):
+    """
+    Bulk statistics over an nanchors x (nneighbors+1) sentence array:
+    number of unique sentences, fraction of neighbors differing from the
+    anchor and mean absolute change in length, per neighborhood.
+    """
+    unique = np.array([len(set(row)) for row in sents])
+    changed = (sents[:, 1:] != sents[:, :1]).mean(axis=1)
+    lengths = np.vectorize(lambda s: len(s.split()), otypes=[int])(sents)
+    length_diff = np.abs(lengths[:, 1:] - lengths[:, :1]).mean(axis=1)
+    return unique, changed, length_diff
+
+
+def print_diff(anchor, sents):
+    "Print unseen sentences, highlighting how they differ from the anchor."
+    print(anchor)
+    seen = set()
+    seen.add(anchor)
+    a = anchor.split()
+    for sent in sents:
+        if sent not in seen:
+            seen.add(sent)
+            b = sent.split()
+            sm = difflib.SequenceMatcher(a=a, b=b)
+
+            for tag, i1, i2, j1, j2 in sm.get_opcodes():
+                if tag == "equal":
+                    print(" ".join(b[j1:j2]), end=" ")
+                if tag == "replace":
+                    print(BOLD + " ".join(b[j1:j2]) + ENDC, end=" ")
+                    # print("*" + " ".join(b[j1:j2]) + "*", end=" ")
+            print()
+    print()
+
+
 def main(args):
-    noise = torch.ones(100, model_args['z_size'])
-
-    for k in range(10):
-        noise[0].normal_()
-        for i in range(1, 100):
-            noise[i].normal_()
-            noise[i] = noise[i] / (10 * numpy.linalg.norm(noise[i]))
-            noise[i] += noise[0]
-        sents = gen(noise)
-        print(sents[0])
-        seen = set()
-        seen.add(sents[0])
-        for i in range(40):
-            if sents[i] not in seen:
-                seen.add(sents[i])
-                a = sents[0].split()
-                b = sents[i].split()
-                sm = difflib.SequenceMatcher(a=a, b=b)
-
-                for tag, i1, i2, j1, j2 in sm.get_opcodes():
-                    if tag == "equal":
-                        print(" ".join(b[j1:j2]), end=" ")
-                    if tag == "replace":
-                        print(BOLD + " ".join(b[j1:j2]) + ENDC, end=" ")
-                        # print("*" + " ".join(b[j1:j2]) + "*", end=" ")
-                print()
-        print()
-
-def gen(vec):
-    "Generate argmax sentence from vector."
-    return generate(autoencoder, gan_gen, z=vec,
-                    vocab=idx2word, sample=False,
-                    maxlen=model_args['maxlen'])
+    rng = np.random.RandomState(args.seed)
+    anchors = rng.normal(0, 1, (args.nanchors, model_args['z_size']))
+    sents = explore(anchors, args.nneighbors, args.radius,
+                    args.batch_size, rng)
+
+    for row in sents[:args.nshow]:
+        print_diff(row[0], row[1:args.nprint])
+
+    unique, changed, length_diff = neighborhood_stats(sents)
+    print("anchors: {} | neighbors per anchor: {} | radius: {}".
+          format(args.nanchors, args.nneighbors, args.radius))
+    print("unique sentences per neighborhood: mean {:.2f} | "
+          "min {} | max {}".format(unique.mean(), unique.min(), unique.max()))
+    print("neighbors differing from anchor: {:.3f}".format(changed.mean()))
+    print("mean length change: {:.3f}".format(length_diff.mean()))
+
+
+def gen(vec, batch_size=1000):
+    "Generate argmax sentences from vectors."
+    return generate_batches(autoencoder, gan_gen, z=vec,
+                            vocab=idx2word, sample=False,
+                            maxlen=model_args['maxlen'],
+                            batch_size=batch_size)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='PyTorch experiment')
     parser.add_argument('--load_path', type=str,
                         help='directory to load models from')
+    parser.add_argument('--nanchors', type=int, default=10,
+                        help='number of random anchor points')
+    parser.add_argument('--nneighbors', type=int, default=99,
+                        help='perturbed codes per anchor')
+    parser.add_argument('--radius', type=float, default=0.1,
+                        help='norm of the perturbations')
+    parser.add_argument('--nshow', type=int, default=10,
+                        help='neighborhoods to print')
+    parser.add_argument('--nprint', type=int, default=40,
+                        help='sentences to diff per printed neighborhood')
+    parser.add_argument('--batch_size', type=int, default=1000,
+                        help='decoding batch size')
+    parser.add_argument('--seed', type=int, default=1111,
+                        help='random seed')
     args = parser.parse_args()
     model_args, idx2word, autoencoder, gan_gen, gan_disc \
         = load_models(args.load_path)
@@ -0,0 +1,81 @@
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+
+
+def run(script, nprocs, batch_size, steps, nthreads, outf, extra):
+    """Train for steps steps on nprocs processes; returns throughput.json"""
+    workdir = os.path.dirname(os.path.abspath(script))
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(nthreads)
+    command = [sys.executable, '-m', 'torch.distributed.run', '--standalone',
+               '--nproc_per_node', str(nprocs), os.path.basename(script),
+               '--outf', outf,
+               '--batch_size', str(batch_size),
+               '--max_steps', str(steps),
+               '--checkpoint_interval', '0'] + extra
+    print(" ".join(command))
+    subprocess.check_call(command, cwd=workdir, env=env)
+
+    # pytorch/train.py writes to ./output/outf, yelp/train.py to outf
+    for path in [os.path.join(workdir, 'output', outf, 'throughput.json'),
+                 os.path.join(workdir, outf, 'throughput.json')]:
+        if os.path.exists(path):
+            return json.load(open(path))
+    raise IOError("no throughput.json for {}".format(outf))
+
+
+def main(args, extra):
+    nprocs = [int(x) for x in args.nprocs.split('-')]
+    results = []
+    for n in nprocs:
+        # strong scaling keeps the batch (and so the training run) fixed;
+        # weak scaling gives every process a full batch
+        batch_size = args.batch_size * n if args.weak else args.batch_size
+        nthreads = max(1, args.ncores // n)
+        results.append(run(args.script, n, batch_size, args.steps, nthreads,
+                           "{}_np{}".format(args.outf, n), extra))
+
+    base = results[0]['sents_per_sec'] / nprocs[0]
+    print('-' * 72)
+    print('{:>6s} {:>8s} {:>8s} {:>10s} {:>12s} {:>10s}'.format(
+        'procs', 'batch', 'steps/s', 'sents/s', 'speedup', 'efficiency'))
+    for n, r in zip(nprocs, results):
+        speedup = r['sents_per_sec'] / (base * nprocs[0])
+        r['efficiency'] = r['sents_per_sec'] / (base * n)
+        print('{:6d} {:8d} {:8.2f} {:10.1f} {:12.2f} {:10.2f}'.format(
+            n, r['batch_size'], r['steps_per_sec'], r['sents_per_sec'],
+            speedup, r['efficiency']))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Scaling of data parallel CPU training; arguments not '
+                    'listed here (e.g. --data_path) are passed to train.py')
+    parser.add_argument('--script', type=str, default='train.py',
+                        help='training script to launch (pytorch/train.py '
+                             'or yelp/train.py)')
+    parser.add_argument('--nprocs', type=str, default='1-2-4-8',
+                        help='process counts to run')
+    parser.add_argument('--steps', type=int, default=200,
+                        help='training steps per run (the first is not timed)')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='batch size (per process with --weak)')
+    parser.add_argument('--weak', action='store_true',
+                        help='weak scaling: batch_size per process')
+    parser.add_argument('--ncores', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='cores to divide between processes '
+                             '(OMP_NUM_THREADS = ncores // nprocs)')
+    parser.add_argument('--outf', type=str, default='scaling',
+                        help='output directory prefix for the runs')
+    parser.add_argument('--save', type=str, default='',
+                        help='also write the results to this json file')
+    args, extra = parser.parse_known_args()
+    main(args, extra)
@@ -1,13 +1,21 @@
 import numpy as np
-import pickle
-from collections import defaultdict
+import json
+import os
 import spacy
 from spacy.symbols import nsubj, VERB
-from models import load_models, generate
+from models import load_models, generate, generate_batches
 import argparse
 import torch
 
-nlp = spacy.load("en")
+# written against the spaCy 3 API (pipe names, nlp.pipe(n_process=...))
+if int(spacy.__version__.split(".")[0]) != 3:
+    raise ImportError("vector.py requires spacy 3.x, found {}".format(
+        spacy.__version__))
+nlp = spacy.load("en_core_web_sm")
+# get_subj_verb only needs part-of-speech tags and the dependency parse
+for name in ("ner", "textcat", "lemmatizer"):
+    if name in nlp.pipe_names:
+        nlp.remove_pipe(name)
 
 
 def get_subj_verb(sent):
@@ -44,30 +52,137 @@ def featurize(sent):
     return d
 
 
-def gen(vec):
-    "Generate argmax sentence from vector."
-    return generate(autoencoder, gan_gen, z=torch.FloatTensor(vec).view(1, -1),
-                    vocab=idx2word, sample=False,
-                    maxlen=model_args['maxlen'])
-
-
-def gen_samples(vec):
-    "Generate sample sentences from vector."
-    sentences = []
-    sentences = generate(autoencoder, gan_gen, z=torch.FloatTensor(vec)
-                         .view(1, -1).expand(20, vec.shape[0]),
-                         vocab=idx2word, sample=True,
-                         maxlen=model_args['maxlen'])[0]
-    return sentences
-
-
-def switch(vec, mat, rev, f1, f2):
+def gen(vecs, batch_size=1000):
+    "Generate argmax sentences from a matrix of vectors."
+    return generate_batches(autoencoder, gan_gen,
+                            z=np.ascontiguousarray(vecs, dtype=np.float32),
+                            vocab=idx2word, sample=False,
+                            maxlen=model_args['maxlen'],
+                            batch_size=batch_size)
+
+
+def gen_samples(vecs, nsamples=20, batch_size=1000):
+    "Generate nsamples sample sentences from each of a matrix of vectors."
+    z = np.repeat(np.asarray(vecs, dtype=np.float32), nsamples, axis=0)
+    sentences = generate_batches(autoencoder, gan_gen, z=z,
+                                 vocab=idx2word, sample=True,
+                                 maxlen=model_args['maxlen'],
+                                 batch_size=batch_size)
+    return [sentences[i:i+nsamples]
+            for i in range(0, len(sentences), nsamples)]
+
+
+class FeatureIndex(object):
+    """
+    Sparse feature x sample index over a sample dump.
+    The sample ids of feature i are indices[indptr[i]:indptr[i+1]] (CSR
+    layout), and per-feature code sums and counts are kept alongside, so
+    a feature centroid costs one row lookup instead of a mean over all of
+    its samples. Samples can be added incrementally with `add`.
+    """
+    FILES = ("feature_indptr.npy", "feature_indices.npy",
+             "feature_sums.npy", "feature_counts.npy")
+
+    def __init__(self, z_size, names=None, indptr=None, indices=None,
+                 sums=None, counts=None):
+        self.names = names if names is not None else []
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        nfeatures = len(self.names)
+        self.indptr = indptr if indptr is not None \
+            else np.zeros(1, dtype=np.int64)
+        self.indices = indices if indices is not None \
+            else np.zeros(0, dtype=np.int64)
+        self.sums = sums if sums is not None \
+            else np.zeros((nfeatures, z_size), dtype=np.float64)
+        self.counts = counts if counts is not None \
+            else np.zeros(nfeatures, dtype=np.int64)
+        # (feature, sample) pairs added since the CSR arrays were built
+        self.pending = []
+
+    def __contains__(self, feature):
+        return feature in self.ids
+
+    def add(self, features, codes, start):
+        "Index samples start, start+1, ... with feature dicts and codes."
+        codes = np.asarray(codes, dtype=np.float64)
+        cols, rows = [], []
+        for k, feats in enumerate(features):
+            for feat in feats:
+                if feat not in self.ids:
+                    self.ids[feat] = len(self.names)
+                    self.names.append(feat)
+                cols.append(self.ids[feat])
+                rows.append(start + k)
+        cols = np.array(cols, dtype=np.int64)
+        rows = np.array(rows, dtype=np.int64)
+
+        nfeatures = len(self.names)
+        if nfeatures > len(self.counts):
+            grow = nfeatures - len(self.counts)
+            self.sums = np.concatenate(
+                [self.sums, np.zeros((grow, self.sums.shape[1]))])
+            self.counts = np.concatenate(
+                [self.counts, np.zeros(grow, dtype=np.int64)])
+        # centroids are updated incrementally from running sums
+        np.add.at(self.sums, cols, codes[rows - start])
+        self.counts += np.bincount(cols, minlength=nfeatures)
+        self.pending.append((cols, rows))
+
+    def compact(self):
+        "Merge pending samples into the CSR arrays."
+        if not self.pending:
+            return
+        nfeatures = len(self.names)
+        old_cols = np.repeat(np.arange(len(self.indptr)-1),
+                             np.diff(self.indptr))
+        cols = np.concatenate([old_cols] + [c for c, r in self.pending])
+        rows = np.concatenate([self.indices] + [r for c, r in self.pending])
+        order = np.argsort(cols, kind="mergesort")
+        self.indices = rows[order]
+        self.indptr = np.zeros(nfeatures+1, dtype=np.int64)
+        np.cumsum(np.bincount(cols, minlength=nfeatures),
+                  out=self.indptr[1:])
+        self.pending = []
+
+    def samples(self, feature):
+        "Sample ids having feature."
+        self.compact()
+        i = self.ids[feature]
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def count(self, feature):
+        return self.counts[self.ids[feature]] if feature in self.ids else 0
+
+    def centroid(self, feature):
+        "Mean code of the samples having feature."
+        i = self.ids[feature]
+        return self.sums[i] / self.counts[i]
+
+    def save(self, path):
+        self.compact()
+        json.dump(self.names, open(os.path.join(path, "feature_names.json"),
+                                   "w"))
+        for name, array in zip(self.FILES, (self.indptr, self.indices,
+                                            self.sums, self.counts)):
+            np.save(os.path.join(path, name), array)
+
+    @classmethod
+    def load(cls, path, z_size):
+        names = json.load(open(os.path.join(path, "feature_names.json")))
+        arrays = [np.load(os.path.join(path, name), mmap_mode="r")
+                  for name in cls.FILES]
+        indptr, indices, sums, counts = arrays
+        return cls(z_size, names, np.array(indptr), indices,
+                   np.array(sums), np.array(counts))
+
+
+def switch(vec, index, f1, f2):
     "Update vec away from feature1 and towards feature2."
     means = []
-    m2 = np.mean(mat[list(rev[f2])], axis=0)
+    m2 = index.centroid(f2)
     for f in f1:
-        if list(rev[f]):
-            means.append(np.mean(mat[list(rev[f])], axis=0))
+        if index.count(f):
+            means.append(index.centroid(f))
     m1 = np.mean(means) if f1 else np.zeros(m2.shape)
 
     val = vec + (m2 - m1)
@@ -75,83 +190,180 @@ def switch(vec, mat, rev, f1, f2):
 
 
 def alter(args):
-    sents, features, rev, mat = pickle.load(open(args.dump, "br"))
-    mat = mat.numpy()
+    """
+    Alter nsent vectors from the dump towards args.alter. All vectors
+    still missing the target word advance together: one argmax and one
+    sampling generate call per round, one nlp.pipe pass over the
+    resulting sentences, and vectors retire as soon as they succeed.
+    """
+    sents, index, mat = load_dump(args.dump)
 
     # Find examples to alter toward new feat.
     new_feat = args.alter
+    if new_feat not in index:
+        raise ValueError("Feature {} not found in {}".format(new_feat,
+                                                            args.dump))
 
     pre = new_feat.split("_")[0]
     word = new_feat.split("_")[1]
-    for i in range(args.nsent):
-        vec = mat[i]
-
-        for j in range(10):
-            sent = gen(vec)[0]
-            f = featurize(nlp(sent))
-            print("Sent ", j, ": \t ", sent, "\t")
-            if word in sent:
-                break
 
-            # Compute the feature distribution associated with this point.
-            samples = gen_samples(vec)
-            feats = [f] * 50
-            for s in samples:
-                feats.append(featurize(nlp(s)))
+    vecs = np.array(mat[:args.nsent], dtype=np.float64)
+    orig = np.zeros_like(vecs)
+    history = [[] for _ in range(len(vecs))]
+    active = np.arange(len(vecs))
+    for j in range(10):
+        if len(active) == 0:
+            break
+        argmax_sents = gen(vecs[active], args.gen_batch_size)
+        for i, sent in zip(active, argmax_sents):
+            history[i].append(sent)
+
+        # retire vectors that reached the target word
+        keep = [k for k, sent in enumerate(argmax_sents) if word not in sent]
+        active = active[keep]
+        argmax_sents = [argmax_sents[k] for k in keep]
+        if len(active) == 0 or j == 9:
+            break
+
+        # Compute the feature distribution associated with each point.
+        samples = gen_samples(vecs[active], batch_size=args.gen_batch_size)
+        texts = argmax_sents + [s for row in samples for s in row]
+        feats = [featurize(doc) for doc in
+                 nlp.pipe(texts, batch_size=args.nlp_batch_size,
+                          n_process=args.nlp_workers)]
+        sample_feats = feats[len(active):]
+
+        for k, i in enumerate(active):
+            nsamples = len(samples[k])
+            vec_feats = [feats[k]] * 50 + \
+                sample_feats[k*nsamples:(k+1)*nsamples]
 
             mod = []
-            for feat in feats:
+            for feat in vec_feats:
                 for feature in feat:
                     if feature.startswith(pre):
                         mod.append(feature)
 
             # Try to updated the vector towards new_feat
-            update, temp = switch(vec, mat, rev, mod, new_feat)
+            update, temp = switch(vecs[i], index, mod, new_feat)
             if j == 0:
-                orig = temp
+                orig[i] = temp
 
             # Interpolate with original.
-            vec = 0.2 * orig + 0.8 * update
+            vecs[i] = 0.2 * orig[i] + 0.8 * update
 
+    for sents in history:
+        for j, sent in enumerate(sents):
+            print("Sent ", j, ": \t ", sent, "\t")
         print()
         print()
 
 
-def dump_samples(args):
-    "Construct a large number of samples with features and dump to file."
-    all_features = []
-    all_sents = []
-
-    batches = args.nbatches
-    batch = args.batch_size
-    samples = 1
-    total = batches * batch * samples
-    all_zs = torch.FloatTensor(total, model_args['z_size'])
-    rev = defaultdict(set)
-
-    for j in range(batches):
-        print("%d / %d batches " % (j, batches))
-        noise = torch.ones(batch, model_args['z_size'])
+def sample_stream(args):
+    "Generate nbatches x batch_size sample sentences with their codes."
+    for j in range(args.nbatches):
+        print("%d / %d batches " % (j, args.nbatches))
+        noise = torch.ones(args.batch_size, model_args['z_size'])
         noise.normal_()
-        noise = noise.view(batch, 1, model_args['z_size'])\
-                     .expand(batch, samples,
-                             model_args['z_size']).contiguous()\
-                     .view(batch*samples,
-                           model_args['z_size'])
         sentences = generate(autoencoder, gan_gen, z=noise,
                              vocab=idx2word, sample=True,
                              maxlen=model_args['maxlen'])
+        for sent, z in zip(sentences, noise.numpy()):
+            yield sent, z
+
+
+def append_shard(path, shard):
+    "Append a shard of (sentence, features, code) samples to the dump."
+    sents, feats, zs = zip(*shard)
+    with open(os.path.join(path, "sents.txt"), "a") as f:
+        for sent in sents:
+            f.write(sent + "\n")
+    with open(os.path.join(path, "features.jsonl"), "a") as f:
+        for feat in feats:
+            f.write(json.dumps(feat) + "\n")
+    with open(os.path.join(path, "codes.f32"), "ab") as f:
+        np.asarray(zs, dtype=np.float32).tofile(f)
+
+    meta_path = os.path.join(path, "meta.json")
+    meta = {"z_size": model_args['z_size'], "count": 0}
+    if os.path.exists(meta_path):
+        meta = json.load(open(meta_path))
+    meta["count"] += len(shard)
+    # written last: a shard only counts once all its files are appended
+    json.dump(meta, open(meta_path, "w"))
+
+
+def load_dump(path):
+    """
+    Load a sample dump: sentences, its FeatureIndex (built from
+    features.jsonl and saved if missing or stale) and the memory-mapped
+    code matrix.
+    """
+    meta = json.load(open(os.path.join(path, "meta.json")))
+    count = meta["count"]
+    with open(os.path.join(path, "sents.txt")) as f:
+        sents = [line[:-1] for _, line in zip(range(count), f)]
+    mat = np.memmap(os.path.join(path, "codes.f32"), dtype=np.float32,
+                    mode="r", shape=(count, meta["z_size"]))
+
+    if meta.get("indexed") == count:
+        index = FeatureIndex.load(path, meta["z_size"])
+    else:
+        index = FeatureIndex(meta["z_size"])
+        chunk = []
+        with open(os.path.join(path, "features.jsonl")) as f:
+            for k, line in zip(range(count), f):
+                chunk.append(json.loads(line))
+                if len(chunk) == 100000 or k == count-1:
+                    start = k+1-len(chunk)
+                    index.add(chunk, mat[start:k+1], start)
+                    chunk = []
+        save_index(path, index, count)
+    return sents, index, mat
+
+
+def save_index(path, index, count):
+    "Save index and record in meta.json how many samples it covers."
+    index.save(path)
+    meta_path = os.path.join(path, "meta.json")
+    meta = json.load(open(meta_path))
+    meta["indexed"] = count
+    json.dump(meta, open(meta_path, "w"))
+
 
-        for i in range(batch * samples):
-            k = len(all_features)
-            nlp_sent = nlp(sentences[i])
-            feats = featurize(nlp_sent)
-            all_sents.append(sentences[i])
-            all_features.append(feats)
-            for f in feats:
-                rev[f].add(k)
-            all_zs[k] = noise[i]
-    pickle.dump((all_sents, all_features, rev, all_zs), open(args.dump, "bw"))
+def dump_samples(args):
+    """
+    Construct a large number of samples with features and dump to disk.
+    Featurization is streamed through nlp.pipe and results are appended
+    shard by shard, so memory stays flat however many samples are made.
+    """
+    if not os.path.isdir(args.dump):
+        os.makedirs(args.dump)
+    # start a fresh dump rather than appending to an old one
+    for name in ("sents.txt", "features.jsonl", "codes.f32", "meta.json"):
+        if os.path.exists(os.path.join(args.dump, name)):
+            os.remove(os.path.join(args.dump, name))
+
+    index = FeatureIndex(model_args['z_size'])
+    docs = nlp.pipe(sample_stream(args), as_tuples=True,
+                    batch_size=args.nlp_batch_size,
+                    n_process=args.nlp_workers)
+    shard = []
+    count = 0
+    for doc, z in docs:
+        shard.append((doc.text, featurize(doc), z))
+        if len(shard) == args.batch_size:
+            append_shard(args.dump, shard)
+            index.add([feats for _, feats, _ in shard],
+                      [z for _, _, z in shard], count)
+            count += len(shard)
+            shard = []
+    if shard:
+        append_shard(args.dump, shard)
+        index.add([feats for _, feats, _ in shard],
+                  [z for _, _, z in shard], count)
+        count += len(shard)
+    save_index(args.dump, index, count)
 
 
 def main(args):
@@ -168,12 +380,18 @@ if __name__ == "__main__":
     parser.add_argument('--load_path', type=str,
                         help='directory to load models from')
 
-    parser.add_argument('--dump', type=str, default="features.pkl",
-                        help='path to sample dump')
+    parser.add_argument('--dump', type=str, default="features",
+                        help='directory of the sample dump')
     parser.add_argument('--nbatches', type=int, default=1000)
     parser.add_argument('--batch_size', type=int, default=1000)
     parser.add_argument('--alter', type=str, default="")
     parser.add_argument('--nsent', type=int, default=100)
+    parser.add_argument('--nlp_batch_size', type=int, default=1000,
+                        help='sentences per spaCy pipe batch')
+    parser.add_argument('--nlp_workers', type=int, default=1,
+                        help='spaCy featurization processes')
+    parser.add_argument('--gen_batch_size', type=int, default=1000,
+                        help='decoding batch size for alter')
     args = parser.parse_args()
     model_args, idx2word, autoencoder, gan_gen, gan_disc \
         = load_models(args.load_path)
@@ -1,11 +1,13 @@
 import argparse
+import os
+import time
 import numpy as np
 import random
 
 import torch
-from torch.autograd import Variable
+import torch.multiprocessing as mp
 
-from models import load_models, generate
+from models import load_models, generate, generate_batches, to_noise
 
 ###############################################################################
 # Generation methods
@@ -13,37 +15,127 @@ from models import load_models, generate
 
 
 def interpolate(ae, gg, z1, z2, vocab,
-                steps=5, sample=None, maxlen=None):
+                steps=5, sample=None, maxlen=None, spherical=False,
+                batch_size=1000):
     """
     Interpolating in z space
     Assumes that type(z1) == type(z2)
+    The whole (pairs x steps) noise grid is built at once and decoded in
+    chunks of batch_size rows; spherical=True walks along great circles
+    (slerp) instead of straight lines.
     """
-    if type(z1) == Variable:
-        noise1 = z1
-        noise2 = z2
-    elif type(z1) == torch.FloatTensor or type(z1) == torch.cuda.FloatTensor:
-        noise1 = Variable(z1, volatile=True)
-        noise2 = Variable(z2, volatile=True)
-    elif type(z1) == np.ndarray:
-        noise1 = Variable(torch.from_numpy(z1).float(), volatile=True)
-        noise2 = Variable(torch.from_numpy(z2).float(), volatile=True)
+    noise1 = to_noise(z1).data.cpu().numpy().astype(np.float32)
+    noise2 = to_noise(z2).data.cpu().numpy().astype(np.float32)
+    npairs, z_size = noise1.shape
+
+    # interpolation weights: steps x 1, broadcast against pairs x 1 x z_size
+    lambdas = np.linspace(0, 1, steps).astype(np.float32)[:, None]
+
+    if spherical:
+        norms1 = np.linalg.norm(noise1, axis=1, keepdims=True)
+        norms2 = np.linalg.norm(noise2, axis=1, keepdims=True)
+        cos = np.sum(noise1 * noise2, axis=1, keepdims=True) / (norms1*norms2)
+        omega = np.arccos(np.clip(cos, -1, 1))[:, None]
+        sin = np.sin(omega)
+        # fall back to linear weights for (anti-)parallel endpoints
+        parallel = sin < 1e-6
+        safe_sin = np.where(parallel, 1, sin)
+        w1 = np.where(parallel, 1-lambdas, np.sin((1-lambdas)*omega)/safe_sin)
+        w2 = np.where(parallel, lambdas, np.sin(lambdas*omega)/safe_sin)
     else:
-        raise ValueError("Unsupported input type (noise): {}".format(type(z1)))
+        w1 = 1-lambdas
+        w2 = lambdas
 
-    # interpolation weights
-    lambdas = [x*1.0/(steps-1) for x in range(steps)]
+    # pairs x steps x z_size
+    grid = w1 * noise1[:, None, :] + w2 * noise2[:, None, :]
+    grid = np.ascontiguousarray(grid.reshape(npairs*steps, z_size),
+                                dtype=np.float32)
 
-    gens = []
-    for L in lambdas:
-        gens.append(generate(ae, gg, (1-L)*noise1 + L*noise2,
-                             vocab, sample, maxlen))
+    gens = generate_batches(ae, gg, z=grid, vocab=vocab, sample=sample,
+                            maxlen=maxlen, batch_size=batch_size)
 
     interpolations = []
-    for i in range(len(gens[0])):
-        interpolations.append([s[i] for s in gens])
+    for i in range(npairs):
+        interpolations.append(gens[i*steps:(i+1)*steps])
     return interpolations
 
 
+def init_bulk_worker(ae, gg, vocab, args, maxlen, z_size):
+    """Pool initializer: keep the shared-memory models in worker globals"""
+    global bulk_models, bulk_vocab, bulk_args, bulk_maxlen, bulk_z_size
+    # one intra-op thread per worker so throughput scales with processes
+    torch.set_num_threads(1)
+    bulk_models = (ae, gg)
+    bulk_vocab = vocab
+    bulk_args = args
+    bulk_maxlen = maxlen
+    bulk_z_size = z_size
+
+
+def generate_shard(shard):
+    """
+    Generate one shard of the bulk corpus and write it straight to disk.
+    Noise (and sampling) is seeded by shard index only, so the output
+    does not depend on the number of workers.
+    """
+    shard_idx, nsentences = shard
+    path = os.path.join(bulk_args.bulk_dir, "shard_{:05d}.txt".format(shard_idx))
+    if os.path.exists(path):
+        return shard_idx, 0
+
+    shard_seed = bulk_args.seed + shard_idx
+    torch.manual_seed(shard_seed)
+    rng = np.random.RandomState(shard_seed)
+    noise = rng.normal(0, 1, (nsentences, bulk_z_size)).astype(np.float32)
+
+    autoencoder, gan_gen = bulk_models
+    sentences = generate_batches(autoencoder, gan_gen, z=noise,
+                                 vocab=bulk_vocab, sample=bulk_args.sample,
+                                 maxlen=bulk_maxlen,
+                                 batch_size=bulk_args.batch_size)
+
+    # write to a temporary file first so a killed run never leaves
+    # a partial shard behind that would be skipped on restart
+    with open(path+".tmp", "w") as f:
+        for sent in sentences:
+            f.write(sent+"\n")
+    os.rename(path+".tmp", path)
+    return shard_idx, nsentences
+
+
+def bulk_generate(autoencoder, gan_gen, idx2word, model_args, args):
+    """
+    Generate args.nbulk sentences into args.bulk_dir, sharded over a pool
+    of args.nworkers processes sharing the model weights. Existing shards
+    are skipped, so an interrupted run can be restarted.
+    """
+    if not os.path.isdir(args.bulk_dir):
+        os.makedirs(args.bulk_dir)
+
+    shards = []
+    for shard_idx, start in enumerate(range(0, args.nbulk, args.shard_size)):
+        shards.append((shard_idx, min(args.shard_size, args.nbulk-start)))
+
+    autoencoder.share_memory()
+    gan_gen.share_memory()
+
+    start_time = time.time()
+    ndone = 0
+    pool = mp.Pool(args.nworkers, initializer=init_bulk_worker,
+                   initargs=(autoencoder, gan_gen, idx2word, args,
+                             model_args['maxlen'], model_args['z_size']))
+    try:
+        for shard_idx, nsentences in pool.imap_unordered(generate_shard,
+                                                         shards):
+            ndone += nsentences
+            elapsed = time.time() - start_time
+            print("shard {:5d} done | {:d} sentences | {:.1f} sents/s".
+                  format(shard_idx, ndone, ndone / max(elapsed, 1e-6)))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def main(args):
     # Set the random seed manually for reproducibility.
     random.seed(args.seed)
@@ -65,6 +157,10 @@ def main(args):
     # Generation code
     ###########################################################################
 
+    # Bulk generation to sharded files
+    if args.nbulk > 0:
+        bulk_generate(autoencoder, gan_gen, idx2word, model_args, args)
+
     # Generate sentences
     if args.ngenerations > 0:
         noise = torch.ones(args.ngenerations, model_args['z_size'])
@@ -94,7 +190,9 @@ def main(args):
                               vocab=idx2word,
                               steps=args.steps,
                               sample=args.sample,
-                              maxlen=model_args['maxlen'])
+                              maxlen=model_args['maxlen'],
+                              spherical=args.slerp,
+                              batch_size=args.batch_size)
 
         if not args.noprint:
             print("\nSentence interpolations:\n")
@@ -130,6 +228,21 @@ if __name__ == "__main__":
                         help='sample when decoding for generation')
     parser.add_argument('--seed', type=int, default=1111,
                         help='random seed')
+    parser.add_argument('--nbulk', type=int, default=0,
+                        help='Number of sentences to generate in bulk mode '
+                             '(sharded over worker processes)')
+    parser.add_argument('--bulk_dir', type=str, default='./bulk',
+                        help='directory to write bulk generation shards to')
+    parser.add_argument('--shard_size', type=int, default=100000,
+                        help='sentences per bulk generation shard')
+    parser.add_argument('--nworkers', type=int, default=mp.cpu_count(),
+                        help='worker processes for bulk generation')
+    parser.add_argument('--batch_size', type=int, default=1000,
+                        help='decoding batch size for bulk generation '
+                             'and interpolation')
+    parser.add_argument('--slerp', action='store_true',
+                        help='interpolate along great circles instead of '
+                             'straight lines')
     args = parser.parse_args()
     print(vars(args))
     main(args)
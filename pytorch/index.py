@@ -0,0 +1,252 @@
+import json
+import os
+import numpy as np
+
+
+def as_numpy(codes):
+    """Codes given as Variable, tensor or array -> float32 ndarray"""
+    if hasattr(codes, 'data') and hasattr(codes.data, 'cpu'):
+        codes = codes.data
+    if hasattr(codes, 'cpu'):
+        codes = codes.cpu().numpy()
+    return np.asarray(codes, dtype=np.float32)
+
+
+def normalize(x):
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def merge_topk(scores, ids, k):
+    """Keep the k highest scores (and their ids) in every row"""
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k-1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        ids = np.take_along_axis(ids, top, axis=1)
+    order = np.argsort(-scores, axis=1)
+    return (np.take_along_axis(scores, order, axis=1),
+            np.take_along_axis(ids, order, axis=1))
+
+
+def kmeans(x, ncentroids, niter=20, spherical=True, block_size=65536,
+           rng=np.random):
+    """Lloyd's k-means; spherical=True keeps centroids on the unit sphere"""
+    centroids = x[rng.choice(len(x), ncentroids, replace=False)].copy()
+    for i in range(niter):
+        assign = assign_nearest(x, centroids, spherical, block_size)
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=ncentroids)
+        empty = counts == 0
+        # re-seed empty clusters with random points
+        sums[empty] = x[rng.choice(len(x), empty.sum())]
+        counts[empty] = 1
+        centroids = (sums / counts[:, None]).astype(np.float32)
+        if spherical:
+            centroids = normalize(centroids)
+    return centroids
+
+
+def assign_nearest(x, centroids, spherical=True, block_size=65536):
+    """Index of the nearest centroid for every row of x, blockwise"""
+    assign = np.empty(len(x), dtype=np.int64)
+    cnorms = (centroids**2).sum(1)
+    for b in range(0, len(x), block_size):
+        block = np.asarray(x[b:b+block_size], dtype=np.float32)
+        scores = block.dot(centroids.T)
+        if not spherical:
+            scores = 2*scores - cnorms
+        assign[b:b+block_size] = scores.argmax(1)
+    return assign
+
+
+class ExactIndex(object):
+    """
+    Exact nearest neighbours by blocked matrix multiplication; suited to
+    small and medium code sets. codes may be a memory-mapped matrix (e.g.
+    the codes.npy written by encode.py) and is read block_size rows at a
+    time. metric is 'cosine' (score = cosine similarity) or 'l2'
+    (score = -squared distance).
+    """
+
+    def __init__(self, codes, metric='cosine', block_size=65536):
+        assert metric in ('cosine', 'l2')
+        self.codes = codes
+        self.metric = metric
+        self.block_size = block_size
+        self.norms = None
+        if metric == 'l2':
+            self.norms = np.concatenate(
+                [(np.asarray(codes[b:b+block_size], dtype=np.float32)**2)
+                 .sum(1) for b in range(0, len(codes), block_size)])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def nearest(self, codes, k=10):
+        """
+        Returns (scores, ids), both nqueries x k, best first.
+        For cosine, queries (and code blocks) are normalized, so raw MLP_G
+        outputs can be queried directly.
+        """
+        queries = as_numpy(codes)
+        if self.metric == 'cosine':
+            queries = normalize(queries)
+        qnorms = (queries**2).sum(1, keepdims=True)
+
+        nq = len(queries)
+        best_scores = np.full((nq, 0), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((nq, 0), dtype=np.int64)
+        for b in range(0, len(self.codes), self.block_size):
+            block = np.asarray(self.codes[b:b+self.block_size],
+                               dtype=np.float32)
+            if self.metric == 'cosine':
+                scores = queries.dot(normalize(block).T)
+            else:
+                scores = 2*queries.dot(block.T) - qnorms - \
+                    self.norms[b:b+len(block)]
+            ids = np.broadcast_to(np.arange(b, b+len(block)), scores.shape)
+            best_scores, best_ids = merge_topk(
+                np.concatenate([best_scores, scores], 1),
+                np.concatenate([best_ids, ids], 1), k)
+        return best_scores, best_ids
+
+
+class IVFIndex(object):
+    """
+    Approximate nearest neighbours for large code sets: an inverted file
+    over nlist k-means cells, of which nprobe are scanned per query.
+    With pq_m > 0 the codes in each cell are product-quantized to pq_m
+    bytes (256 centroids per sub-vector) and scored with lookup tables;
+    otherwise they are stored as float16 and scored exactly.
+    """
+
+    def __init__(self, codes, nlist=1024, nprobe=16, metric='cosine',
+                 pq_m=0, niter=20, train_size=None, block_size=65536,
+                 seed=1111):
+        assert metric in ('cosine', 'l2')
+        self.metric = metric
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        spherical = metric == 'cosine'
+        rng = np.random.RandomState(seed)
+
+        # train the coarse quantizer (and PQ codebooks) on a sample
+        if train_size is None:
+            train_size = 256 * max(nlist, 256 if pq_m else 1)
+        ntrain = min(train_size, len(codes))
+        # k-means seeds its centroids with distinct training codes
+        assert ntrain >= nlist, \
+            "nlist={} cells need as many training codes, got {} of {} " \
+            "codes".format(nlist, ntrain, len(codes))
+        assert not pq_m or ntrain >= 256, \
+            "pq_m needs 256 training codes (the centroids per sub-vector), " \
+            "got {} of {} codes".format(ntrain, len(codes))
+        sample = rng.choice(len(codes), ntrain, replace=False)
+        train = np.asarray(codes[np.sort(sample)], dtype=np.float32)
+        if spherical:
+            train = normalize(train)
+        self.centroids = kmeans(train, nlist, niter, spherical,
+                                block_size, rng)
+        if pq_m:
+            dim = train.shape[1]
+            assert dim % pq_m == 0, "pq_m must divide the code dimension"
+            sub = dim // pq_m
+            self.codebooks = np.stack(
+                [kmeans(train[:, j*sub:(j+1)*sub], 256, niter, False,
+                        block_size, rng) for j in range(pq_m)])
+
+        # fill the inverted lists
+        assign = np.empty(len(codes), dtype=np.int64)
+        stored = []
+        norms = []
+        for b in range(0, len(codes), block_size):
+            block = np.asarray(codes[b:b+block_size], dtype=np.float32)
+            if spherical:
+                block = normalize(block)
+            assign[b:b+len(block)] = assign_nearest(block, self.centroids,
+                                                    spherical, block_size)
+            stored.append(self.encode(block))
+            norms.append((block**2).sum(1))
+        stored = np.concatenate(stored)
+        norms = np.concatenate(norms)
+
+        order = np.argsort(assign, kind='mergesort')
+        self.ids = order
+        self.stored = stored[order]
+        self.norms = norms[order]
+        self.offsets = np.zeros(nlist+1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def encode(self, block):
+        """Storage form of a block of codes"""
+        if not self.pq_m:
+            return block.astype(np.float16)
+        sub = block.shape[1] // self.pq_m
+        return np.stack([assign_nearest(block[:, j*sub:(j+1)*sub],
+                                        self.codebooks[j], False)
+                         for j in range(self.pq_m)], 1).astype(np.uint8)
+
+    def dots(self, queries, stored):
+        """Query x stored dot products (approximate under PQ)"""
+        if not self.pq_m:
+            return queries.dot(stored.astype(np.float32).T)
+        sub = queries.shape[1] // self.pq_m
+        scores = np.zeros((len(queries), len(stored)), dtype=np.float32)
+        for j in range(self.pq_m):
+            # nqueries x 256 lookup table for sub-vector j
+            table = queries[:, j*sub:(j+1)*sub].dot(self.codebooks[j].T)
+            scores += table[:, stored[:, j]]
+        return scores
+
+    def nearest(self, codes, k=10):
+        """Returns (scores, ids), both nqueries x k, best first"""
+        queries = as_numpy(codes)
+        if self.metric == 'cosine':
+            queries = normalize(queries)
+        qnorms = (queries**2).sum(1)
+
+        cscores = queries.dot(self.centroids.T)
+        if self.metric == 'l2':
+            cscores = 2*cscores - (self.centroids**2).sum(1)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-cscores, nprobe-1, axis=1)[:, :nprobe]
+
+        nq = len(queries)
+        best_scores = np.full((nq, k), -np.inf, dtype=np.float32)
+        best_ids = np.full((nq, k), -1, dtype=np.int64)
+        # scan cell by cell, scoring all queries that probe it together
+        for cell in np.unique(probes):
+            start, end = self.offsets[cell], self.offsets[cell+1]
+            if start == end:
+                continue
+            q = np.nonzero((probes == cell).any(1))[0]
+            scores = self.dots(queries[q], self.stored[start:end])
+            if self.metric == 'l2':
+                scores = 2*scores - qnorms[q, None] - self.norms[start:end]
+            ids = np.broadcast_to(self.ids[start:end], scores.shape)
+            best_scores[q], best_ids[q] = merge_topk(
+                np.concatenate([best_scores[q], scores], 1),
+                np.concatenate([best_ids[q], ids], 1), k)
+        return best_scores, best_ids
+
+
+def build_index(codes, exact_limit=1000000, **kwargs):
+    """
+    ExactIndex for up to exact_limit codes, IVFIndex beyond that.
+    kwargs are passed on to IVFIndex (metric and block_size to either).
+    """
+    if len(codes) <= exact_limit:
+        return ExactIndex(codes, metric=kwargs.get('metric', 'cosine'),
+                          block_size=kwargs.get('block_size', 65536))
+    return IVFIndex(codes, **kwargs)
+
+
+def load_codes(path):
+    """Memory-map the codes written by encode.py into directory path"""
+    meta = json.load(open(os.path.join(path, "meta.json")))
+    codes = np.load(os.path.join(path, "codes.npy"), mmap_mode='r')
+    return codes[:meta['count']]
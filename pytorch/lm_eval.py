@@ -0,0 +1,360 @@
+"""
+Reverse perplexity for early stopping: an n-gram language model trained on
+generated sentences, scored on real ones. Run as a script, this file is the
+background worker that LMEvaluator hands model snapshots to.
+"""
+import argparse
+import atexit
+import collections
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import traceback
+
+import numpy as np
+import torch
+
+from utils import to_gpu, train_ngram_lm, score_sentences, save_state
+from models import Seq2Seq, MLP_G
+from ngram import train_kneser_ney, truncate
+
+
+def generate(autoencoder, gan_gen, args, nsentences, batch_size=100):
+    """
+    Ids (nsentences x maxlen) of sentences generated from noise, with the
+    models in evaluation mode (batch norm running statistics, no dropout)
+    """
+    autoencoder.eval()
+    gan_gen.eval()
+    indices = []
+    noise = to_gpu(args.cuda, torch.ones(batch_size, args.z_size))
+    for i in range(0, nsentences, batch_size):
+        noise.normal_(0, 1)
+
+        with torch.no_grad():
+            fake_hidden = gan_gen(noise)
+            max_indices = autoencoder.generate(fake_hidden, args.maxlen)
+        indices.append(max_indices.cpu().numpy())
+
+    return np.concatenate(indices, axis=0)[:nsentences]
+
+
+def sample_sizes(min_samples, max_samples):
+    """
+    Doubling numbers of generated sentences, up to max_samples; just
+    max_samples (a fixed budget) when min_samples is 0
+    """
+    if min_samples <= 0:
+        return [max_samples]
+    sizes = [min(min_samples, max_samples)]
+    while sizes[-1] < max_samples:
+        sizes.append(min(2 * sizes[-1], max_samples))
+    return sizes
+
+
+def bootstrap_log_ppl_diff(scores, reference, word_counts, nboot, seed,
+                           chunk_size=100):
+    """
+    Paired bootstrap (over evaluation sentences) of the difference in log10
+    perplexity between per-sentence scores and reference scores
+    """
+    rng = np.random.RandomState(seed)
+    # the difference in log10 ppl is that in total log10 probability, over
+    # the number of words
+    delta = reference - scores
+    diffs = []
+    for i in range(0, nboot, chunk_size):
+        idx = rng.randint(0, len(delta), size=(min(chunk_size, nboot-i),
+                                               len(delta)))
+        diffs.append(delta[idx].sum(1) / word_counts[idx].sum(1))
+    return np.concatenate(diffs)
+
+
+class ReversePerplexity(object):
+    """
+    Reverse perplexity: an args.N-gram LM is trained on args.lm_samples
+    sentences generated by the models and scored on real ones. With
+    args.lm_min_samples > 0 the budget is adaptive: the sentences are
+    generated in doubling stages (sample_sizes()), and the LM is retrained
+    and scored after each. A model is compared with the best one so far (the
+    reference) at the same number of samples, as fewer samples give a higher
+    perplexity. Once a paired bootstrap over the evaluation sentences shows
+    it worse or better (at level args.lm_alpha over all the stages, on
+    either side), sampling stops. Otherwise it goes on to the reference's
+    last stage, where the perplexities decide as with a fixed budget. The
+    reference only holds the stages its models were evaluated at, so after
+    an early improvement the following evaluations end at that stage too.
+    The bootstrap does not cover the variance between LMs trained on
+    different generated samples, so the stopping rule is a heuristic.
+    """
+
+    def __init__(self, args, idx2word, reference=None):
+        self.args = args
+        self.idx2word = idx2word
+        self.word2idx = {w: i for i, w in idx2word.items()}
+        self.sizes = sample_sizes(args.lm_min_samples, args.lm_samples)
+        # per-sentence scores of the best models at every stage
+        self.reference = np.load(reference) if reference else None
+        self.eval_path = None
+
+    def load_sentences(self, eval_path):
+        if eval_path == self.eval_path:
+            return
+        with open(eval_path, 'r') as f:
+            lines = [l.replace('\n', '') for l in f]
+        if self.args.lm_backend == 'numpy':
+            # words not in the vocabulary are <unk>, as in KenLM
+            self.sentences = [[self.word2idx.get(w, -1) for w in l.split()]
+                              for l in lines]
+        else:
+            self.sentences = lines
+        self.eval_path = eval_path
+
+    def score(self, indices, save_path):
+        """
+        log10 probability and word count of every evaluation sentence under
+        an LM trained on the generated indices. The LM is KenLM's
+        (--lm_backend kenlm) or the NumPy estimator of ngram.py, which works
+        on the generated ids directly.
+        """
+        args = self.args
+        if args.lm_backend == 'numpy':
+            # vocabulary words are added as sentences (laplacian smoothing)
+            lm = train_kneser_ney(truncate(indices, self.word2idx['<eos>']),
+                                  N=args.N, vocab_size=len(self.word2idx))
+            return lm.sentence_scores(self.sentences)
+
+        # write generated sentences to text file
+        with open(save_path+".txt", "w") as f:
+            # laplacian smoothing
+            for word in self.idx2word.values():
+                f.write(word+"\n")
+            for idx in indices:
+                # generated sentence
+                words = [self.idx2word[x] for x in idx]
+                # truncate sentences to first occurrence of <eos>
+                truncated_sent = []
+                for w in words:
+                    if w != '<eos>':
+                        truncated_sent.append(w)
+                    else:
+                        break
+                chars = " ".join(truncated_sent)
+                f.write(chars+"\n")
+
+        # train language model on generated examples
+        lm = train_ngram_lm(kenlm_path=args.kenlm_path,
+                            data_path=save_path+".txt",
+                            output_path=save_path+".arpa",
+                            N=args.N)
+        lm_scores = score_sentences(lm, self.sentences)
+        return lm_scores.scores, lm_scores.word_counts
+
+    def evaluate(self, autoencoder, gan_gen, eval_path, save_path):
+        """
+        Reverse perplexity of the models on the sentences of eval_path,
+        generating to save_path. Returns a dict with the perplexity 'ppl',
+        the number of sentences generated 'nsamples', whether the models
+        improve on the reference 'improved' and, if so, 'reference': the
+        file their scores are saved to, which replaces the reference (the
+        argument to pass to resume with them as the best models).
+        """
+        args = self.args
+        self.load_sentences(eval_path)
+        sizes = self.sizes
+        if self.reference is not None:
+            # the stages the best models were evaluated at
+            sizes = sizes[:len(self.reference)]
+        # every stage before the last may stop early, either way
+        alpha = args.lm_alpha / max(1, len(sizes) - 1)
+
+        indices = np.zeros((0, args.maxlen), dtype=np.int64)
+        all_scores = []
+        for stage, nsamples in enumerate(sizes):
+            indices = np.concatenate(
+                [indices, generate(autoencoder, gan_gen, args,
+                                   nsamples - len(indices))])
+            scores, word_counts = self.score(indices, save_path)
+            all_scores.append(scores)
+            ppl = 10**-(scores.sum() / word_counts.sum())
+            if self.reference is None:
+                continue
+            reference = self.reference[stage]
+            if stage == len(sizes) - 1:
+                improved = scores.sum() > reference.sum()
+                break
+            diffs = bootstrap_log_ppl_diff(scores, reference, word_counts,
+                                           args.lm_bootstrap, args.seed)
+            if np.percentile(diffs, 100 * alpha) > 0:
+                # significantly worse than the best models
+                improved = False
+                break
+            if np.percentile(diffs, 100 * (1 - alpha)) < 0:
+                # significantly better
+                improved = True
+                break
+        else:
+            # the first evaluation
+            improved = True
+
+        result = {'ppl': float(ppl), 'nsamples': int(nsamples),
+                  'improved': bool(improved)}
+        if improved:
+            # the stages run, which may be fewer than self.sizes
+            self.reference = np.stack(all_scores)
+            result['reference'] = save_path+"_scores.npy"
+            np.save(result['reference'], self.reference)
+        return result
+
+
+class LMEvaluator(object):
+    """
+    Reverse perplexity of model snapshots, evaluated by a worker process
+    (this file run as a script) while training continues. The snapshot file
+    is written by writer and then handed to the worker, which deletes it
+    once loaded; the snapshot's state dicts are kept here until its result
+    is collected with poll(), so that the models that were evaluated are the
+    ones saved on improvement.
+    """
+
+    def __init__(self, outdir, writer, seed=0):
+        self.outdir = os.path.abspath(outdir)
+        self.writer = writer
+        self.seed = seed
+        # scores of the best models so far (ReversePerplexity), when resuming
+        self.reference = None
+        self.njobs = 0
+        self.process = None
+        self.results = queue.Queue()
+        self.pending = collections.OrderedDict()
+        atexit.register(self.close)
+
+    def start(self):
+        # the worker's stdout carries the results; its logging (and KenLM's)
+        # goes to our stderr
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), self.outdir] +
+            ([self.reference] if self.reference else []),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        self.reader = threading.Thread(target=self.read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read(self):
+        for line in self.process.stdout:
+            self.results.put(json.loads(line))
+        # the worker exited
+        self.results.put(None)
+
+    def send(self, job):
+        if self.process.poll() is not None:
+            return  # terminated by close()
+        self.process.stdin.write(json.dumps(job)+"\n")
+        self.process.stdin.flush()
+
+    def submit(self, label, states, eval_path, save_path):
+        """
+        Queue the evaluation of states (a dict of snapshotted state dicts
+        with at least 'autoencoder' and 'gan_gen'), generating to save_path
+        """
+        if self.process is None:
+            self.start()
+        self.pending[label] = states
+        job = {'label': label,
+               'snapshot': os.path.join(self.outdir,
+                                        "{}_lm_snapshot.pt".format(label)),
+               'eval_path': eval_path,
+               'save_path': save_path,
+               'seed': self.seed + self.njobs}
+        self.njobs += 1
+        # the worker gets the job once the snapshot is on disk
+        self.writer.put(save_state, {'autoencoder': states['autoencoder'],
+                                     'gan_gen': states['gan_gen']},
+                        job['snapshot'])
+        self.writer.put(self.send, job)
+
+    def poll(self, wait=False):
+        """
+        (label, result, states) of the evaluations finished so far, in the
+        order they were submitted (result as ReversePerplexity.evaluate's);
+        with wait, of all pending evaluations
+        """
+        done = []
+        while self.pending:
+            try:
+                result = self.results.get(block=wait)
+            except queue.Empty:
+                break
+            if result is None:
+                raise RuntimeError("reverse perplexity worker exited with "
+                                   "evaluations pending")
+            if 'error' in result:
+                raise RuntimeError("reverse perplexity evaluation {} failed:"
+                                   "\n{}".format(result['label'],
+                                                 result['error']))
+            label = result.pop('label')
+            done.append((label, result, self.pending.pop(label)))
+        return done
+
+    def close(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        if self.pending:
+            # exiting early (early stopping, preemption): drop the rest
+            self.process.terminate()
+        else:
+            self.process.stdin.close()
+        self.process.wait()
+
+
+def worker(outdir, reference=None):
+    """
+    Evaluate the jobs read from stdin (one json object per line) with the
+    models and arguments of the training run in outdir, starting from the
+    reference scores in reference; write one json result per line to stdout
+    """
+    results = os.fdopen(os.dup(1), 'w')
+    # everything else printed, here or by lmplz, goes to stderr
+    os.dup2(2, 1)
+
+    args = argparse.Namespace(
+        **json.load(open(os.path.join(outdir, 'args.json'), 'r')))
+    word2idx = json.load(open(os.path.join(outdir, 'vocab.json'), 'r'))
+    idx2word = {v: k for k, v in word2idx.items()}
+
+    autoencoder = Seq2Seq(emsize=args.emsize,
+                          nhidden=args.nhidden,
+                          ntokens=args.ntokens,
+                          nlayers=args.nlayers,
+                          hidden_init=args.hidden_init,
+                          gpu=args.cuda)
+    gan_gen = MLP_G(ninput=args.z_size, noutput=args.nhidden,
+                    layers=args.arch_g)
+    if args.cuda:
+        autoencoder = autoencoder.cuda()
+        gan_gen = gan_gen.cuda()
+    reverse_ppl = ReversePerplexity(args, idx2word, reference)
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            states = torch.load(job['snapshot'])
+            os.remove(job['snapshot'])
+            autoencoder.load_state_dict(states['autoencoder'])
+            gan_gen.load_state_dict(states['gan_gen'])
+            torch.manual_seed(job['seed'])
+            result = reverse_ppl.evaluate(autoencoder, gan_gen,
+                                          job['eval_path'], job['save_path'])
+            result['label'] = job['label']
+        except Exception:
+            result = {'label': job['label'], 'error': traceback.format_exc()}
+        results.write(json.dumps(result)+"\n")
+        results.flush()
+
+
+if __name__ == "__main__":
+    worker(*sys.argv[1:])
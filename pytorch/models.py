@@ -2,7 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, \
+    PackedSequence
 
 from utils import to_gpu
 import json
@@ -10,6 +11,27 @@ import os
 import numpy as np
 
 
+def masked_loss(decoded, target, temp=1):
+    """
+    Summed cross entropy of decoded (... x ntokens) over the non-padding
+    positions of target, and the number of them the argmax gets right
+    """
+    ntokens = decoded.size(-1)
+    target = target.contiguous().view(-1)
+    mask = target.gt(0)
+    masked_target = target.masked_select(mask)
+    # examples x ntokens
+    output_mask = mask.unsqueeze(1).expand(mask.size(0), ntokens)
+    masked_output = \
+        decoded.contiguous().view(-1, ntokens).masked_select(output_mask)
+    masked_output = masked_output.view(-1, ntokens)
+    loss = F.cross_entropy(masked_output/temp, masked_target) * \
+        masked_target.size(0)
+    max_vals, max_indices = torch.max(masked_output.detach(), 1)
+    correct = max_indices.eq(masked_target).float().sum()
+    return loss, correct
+
+
 class MLP_D(nn.Module):
     def __init__(self, ninput, noutput, layers,
                  activation=nn.LeakyReLU(0.2), gpu=False):
@@ -102,7 +124,8 @@ class MLP_G(nn.Module):
 
 class Seq2Seq(nn.Module):
     def __init__(self, emsize, nhidden, ntokens, nlayers, noise_radius=0.2,
-                 hidden_init=False, dropout=0, gpu=False):
+                 hidden_init=False, dropout=0, checkpoint_segment=0,
+                 gpu=False):
         super(Seq2Seq, self).__init__()
         self.nhidden = nhidden
         self.emsize = emsize
@@ -111,10 +134,9 @@ class Seq2Seq(nn.Module):
         self.noise_radius = noise_radius
         self.hidden_init = hidden_init
         self.dropout = dropout
+        self.checkpoint_segment = checkpoint_segment
         self.gpu = gpu
 
-        self.start_symbols = to_gpu(gpu, Variable(torch.ones(10, 1).long()))
-
         # Vocabulary embedding
         self.embedding = nn.Embedding(ntokens, emsize)
         self.embedding_decoder = nn.Embedding(ntokens, emsize)
@@ -137,6 +159,7 @@ class Seq2Seq(nn.Module):
         self.linear = nn.Linear(nhidden, ntokens)
 
         self.init_weights()
+        self.reset_grad_norm()
 
     def init_weights(self):
         initrange = 0.1
@@ -164,12 +187,25 @@ class Seq2Seq(nn.Module):
         zeros = Variable(torch.zeros(self.nlayers, bsz, self.nhidden))
         return to_gpu(self.gpu, zeros)
 
+    def reset_grad_norm(self):
+        """Start averaging grad_norm over the micro-batches of a new step"""
+        self.grad_norm_sum = 0
+        self.grad_norm_count = 0
+
     def store_grad_norm(self, grad):
+        # mean code gradient norm over all examples since reset_grad_norm
         norm = torch.norm(grad, 2, 1)
-        self.grad_norm = norm.detach().data.mean()
+        self.grad_norm_sum += norm.detach().data.sum()
+        self.grad_norm_count += norm.size(0)
+        self.grad_norm = self.grad_norm_sum / self.grad_norm_count
         return grad
 
-    def forward(self, indices, lengths, noise, encode_only=False):
+    def forward(self, indices, lengths, noise, encode_only=False,
+                target=None, temp=1):
+        """
+        Returns the decoded logits, or with target, the summed reconstruction
+        loss and number of correct predictions (see decode_loss)
+        """
         batch_size, maxlen = indices.size()
 
         hidden = self.encode(indices, lengths, noise)
@@ -180,6 +216,9 @@ class Seq2Seq(nn.Module):
         if hidden.requires_grad:
             hidden.register_hook(self.store_grad_norm)
 
+        if target is not None:
+            return self.decode_loss(hidden, indices, lengths, target, temp)
+
         decoded = self.decode(hidden, batch_size, maxlen,
                               indices=indices, lengths=lengths)
 
@@ -207,13 +246,25 @@ class Seq2Seq(nn.Module):
         hidden = torch.div(hidden, norms.unsqueeze(1).expand_as(hidden))
 
         if noise and self.noise_radius > 0:
-            gauss_noise = torch.normal(means=torch.zeros(hidden.size()),
+            gauss_noise = torch.normal(mean=torch.zeros(hidden.size()),
                                        std=self.noise_radius)
             hidden = hidden + to_gpu(self.gpu, Variable(gauss_noise))
 
         return hidden
 
     def decode(self, hidden, batch_size, maxlen, indices=None, lengths=None):
+        packed_output = self.decode_packed(hidden, indices, lengths)
+        output, lengths = pad_packed_sequence(packed_output, batch_first=True)
+
+        # reshape to batch_size*maxlen x nhidden before linear over vocab
+        decoded = self.linear(output.contiguous().view(-1, self.nhidden))
+        decoded = decoded.view(batch_size, maxlen, self.ntokens)
+
+        return decoded
+
+    def decode_packed(self, hidden, indices, lengths):
+        """Teacher-forced decoder outputs, as a PackedSequence"""
+        batch_size, maxlen = indices.size()
         # batch x hidden
         all_hidden = hidden.unsqueeze(1).repeat(1, maxlen, 1)
 
@@ -230,17 +281,88 @@ class Seq2Seq(nn.Module):
                                                  batch_first=True)
 
         packed_output, state = self.decoder(packed_embeddings, state)
-        output, lengths = pad_packed_sequence(packed_output, batch_first=True)
 
-        # reshape to batch_size*maxlen x nhidden before linear over vocab
-        decoded = self.linear(output.contiguous().view(-1, self.nhidden))
-        decoded = decoded.view(batch_size, maxlen, self.ntokens)
+        return packed_output
+
+    def decode_loss(self, hidden, indices, lengths, target, temp=1,
+                    predictions=False):
+        """
+        Teacher-forced decoding scored against target: returns the summed
+        cross entropy over the non-padding targets and the number of correct
+        argmax predictions. With checkpoint_segment > 0 the decoder, output
+        projection and loss run checkpoint_segment steps at a time under
+        activation checkpointing, so only the LSTM state between segments is
+        kept for the backward pass and never more than one segment's logits.
+        With predictions, the argmax words (batch x maxlen, 0 at the padding)
+        are returned as well, from the same logits.
+        """
+        batch_size, maxlen = indices.size()
+        target = target.view(batch_size, maxlen)
+        if self.checkpoint_segment <= 0 or not hidden.requires_grad or \
+                predictions:
+            # project and score the unpadded positions only
+            packed_output = self.decode_packed(hidden, indices, lengths)
+            decoded = self.linear(packed_output.data)
+            packed_target = pack_padded_sequence(target, lengths,
+                                                 batch_first=True)
+            loss, correct = masked_loss(decoded, packed_target.data, temp)
+            if not predictions:
+                return loss, correct
+            max_indices, _ = pad_packed_sequence(
+                PackedSequence(decoded.max(1)[1], packed_output.batch_sizes),
+                batch_first=True, total_length=maxlen)
+            return loss, correct, max_indices
+
+        from torch.utils.checkpoint import checkpoint
+
+        def segment(indices, target, hidden, h, c):
+            embeddings = self.embedding_decoder(indices)
+            all_hidden = hidden.unsqueeze(1).repeat(1, indices.size(1), 1)
+            augmented_embeddings = torch.cat([embeddings, all_hidden], 2)
+            # padding is decoded too but masked out of the loss; the state
+            # is only carried on for rows that are still running
+            output, (h, c) = self.decoder(augmented_embeddings, (h, c))
+            decoded = self.linear(output.contiguous().view(-1, self.nhidden))
+            loss, correct = masked_loss(decoded, target, temp)
+            return loss, correct, h, c
 
-        return decoded
+        if self.hidden_init:
+            # initialize decoder hidden state to encoder output
+            h, c = hidden.unsqueeze(0), self.init_state(batch_size)
+        else:
+            h, c = self.init_hidden(batch_size)
+
+        loss, correct = 0, 0
+        for start in range(0, maxlen, self.checkpoint_segment):
+            end = min(start + self.checkpoint_segment, maxlen)
+            # rows are sorted by decreasing length: drop finished sentences
+            nrows = sum(1 for l in lengths if l > start)
+            seg_loss, seg_correct, h, c = checkpoint(
+                segment, indices[:nrows, start:end], target[:nrows, start:end],
+                hidden[:nrows], h[:, :nrows], c[:, :nrows],
+                use_reentrant=False)
+            loss = loss + seg_loss
+            correct = correct + seg_correct
+        return loss, correct
 
     def generate(self, hidden, maxlen, sample=True, temp=1.0):
         """Generate through decoder; no backprop"""
 
+        all_indices = [indices for indices, finished in
+                       self.generate_steps(hidden, maxlen, sample, temp)]
+        max_indices = torch.cat(all_indices, 1)
+
+        return max_indices
+
+    def generate_steps(self, hidden, maxlen, sample=True, temp=1.0,
+                       eos_idx=2):
+        """
+        Generate through decoder one step at a time; no backprop.
+        Yields (indices, finished) as soon as each step is decoded:
+        indices is batch_size x 1 and finished flags the rows that have
+        already emitted <eos> at or before this step.
+        """
+
         batch_size = hidden.size(0)
 
         if self.hidden_init:
@@ -250,33 +372,29 @@ class Seq2Seq(nn.Module):
             state = self.init_hidden(batch_size)
 
         # <sos>
-        self.start_symbols.data.resize_(batch_size, 1)
-        self.start_symbols.data.fill_(1)
-
-        embedding = self.embedding_decoder(self.start_symbols)
-        inputs = torch.cat([embedding, hidden.unsqueeze(1)], 2)
+        indices = to_gpu(self.gpu, torch.ones(batch_size, 1).long())
 
-        # unroll
-        all_indices = []
+        # unroll; grad mode is only switched off around each step, not
+        # while the caller holds the yielded step
+        finished = None
         for i in range(maxlen):
-            output, state = self.decoder(inputs, state)
-            overvocab = self.linear(output.squeeze(1))
-
-            if not sample:
-                vals, indices = torch.max(overvocab, 1)
-            else:
-                # sampling
-                probs = F.softmax(overvocab/temp)
-                indices = torch.multinomial(probs, 1)
+            with torch.no_grad():
+                embedding = self.embedding_decoder(indices)
+                inputs = torch.cat([embedding, hidden.unsqueeze(1)], 2)
+                output, state = self.decoder(inputs, state)
+                overvocab = self.linear(output.squeeze(1))
 
-            all_indices.append(indices)
+                if not sample:
+                    vals, indices = torch.max(overvocab, 1)
+                    indices = indices.unsqueeze(1)
+                else:
+                    # sampling
+                    probs = F.softmax(overvocab/temp, dim=1)
+                    indices = torch.multinomial(probs, 1)
 
-            embedding = self.embedding_decoder(indices)
-            inputs = torch.cat([embedding, hidden.unsqueeze(1)], 2)
-
-        max_indices = torch.cat(all_indices, 1)
-
-        return max_indices
+            eos = indices.view(-1).eq(eos_idx)
+            finished = eos if finished is None else finished | eos
+            yield indices, finished
 
 
 def load_models(load_path):
@@ -307,27 +425,31 @@ def load_models(load_path):
     return model_args, idx2word, autoencoder, gan_gen, gan_disc
 
 
+def to_noise(z):
+    """Noise given as a tensor or ndarray, as a float tensor"""
+    if torch.is_tensor(z):
+        return z
+    elif type(z) == np.ndarray:
+        return torch.from_numpy(z).float()
+    else:
+        raise ValueError("Unsupported input type (noise): {}".format(type(z)))
+
+
 def generate(autoencoder, gan_gen, z, vocab, sample, maxlen):
     """
     Assume noise is batch_size x z_size
     """
-    if type(z) == Variable:
-        noise = z
-    elif type(z) == torch.FloatTensor or type(z) == torch.cuda.FloatTensor:
-        noise = Variable(z, volatile=True)
-    elif type(z) == np.ndarray:
-        noise = Variable(torch.from_numpy(z).float(), volatile=True)
-    else:
-        raise ValueError("Unsupported input type (noise): {}".format(type(z)))
+    noise = to_noise(z)
 
     gan_gen.eval()
     autoencoder.eval()
 
     # generate from random noise
-    fake_hidden = gan_gen(noise)
-    max_indices = autoencoder.generate(hidden=fake_hidden,
-                                       maxlen=maxlen,
-                                       sample=sample)
+    with torch.no_grad():
+        fake_hidden = gan_gen(noise)
+        max_indices = autoencoder.generate(hidden=fake_hidden,
+                                           maxlen=maxlen,
+                                           sample=sample)
 
     max_indices = max_indices.data.cpu().numpy()
     sentences = []
@@ -345,3 +467,39 @@ def generate(autoencoder, gan_gen, z, vocab, sample, maxlen):
         sentences.append(sent)
 
     return sentences
+
+
+def generate_stream(autoencoder, gan_gen, z, vocab, sample, maxlen):
+    """
+    Streaming version of `generate`; yields (words, finished) after every
+    decoder step instead of the full sentences after maxlen steps.
+    words holds the token decoded for each row of the batch and finished
+    (numpy bool array) flags the rows that have produced <eos>, whose
+    later tokens should be ignored.
+    """
+    noise = to_noise(z)
+
+    gan_gen.eval()
+    autoencoder.eval()
+
+    with torch.no_grad():
+        fake_hidden = gan_gen(noise)
+    for indices, finished in autoencoder.generate_steps(hidden=fake_hidden,
+                                                        maxlen=maxlen,
+                                                        sample=sample):
+        indices = indices.data.cpu().view(-1).numpy()
+        words = [vocab[x] for x in indices]
+        yield words, finished.cpu().numpy().astype(bool)
+
+
+def generate_batches(autoencoder, gan_gen, z, vocab, sample, maxlen,
+                     batch_size=1000):
+    """
+    `generate` over a large noise matrix in chunks of batch_size rows,
+    so memory stays bounded by one chunk
+    """
+    sentences = []
+    for i in range(0, z.shape[0], batch_size):
+        sentences.extend(generate(autoencoder, gan_gen, z[i:i+batch_size],
+                                  vocab, sample, maxlen))
+    return sentences
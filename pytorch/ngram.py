@@ -0,0 +1,252 @@
+"""
+Interpolated modified Kneser-Ney n-gram language model over token ids,
+estimated and queried with NumPy. It follows KenLM's lmplz: adjusted
+(continuation) counts for all but the highest order and for n-grams that
+start with <s>, three discounts per order from the counts of counts, and
+interpolation down to the uniform distribution over the vocabulary. Scores
+are log10 probabilities with backoff, as KenLM queries an ARPA file.
+"""
+import numpy as np
+
+
+def truncate(indices, eos_idx):
+    """Rows of a batch x maxlen id matrix cut before their first eos_idx"""
+    indices = np.asarray(indices)
+    eos = indices == eos_idx
+    lengths = np.where(eos.any(1), eos.argmax(1), indices.shape[1])
+    return [row[:l] for row, l in zip(indices, lengths)]
+
+
+class KneserNeyLM(object):
+    """
+    N-gram LM over ids 0..vocab_size-1; <s>, </s> and <unk> get the ids
+    vocab_size, vocab_size+1 and vocab_size+2. Any id outside the vocabulary
+    is <unk> when scoring.
+    """
+
+    # discounts when the counts of counts can't estimate them (as KenLM's
+    # --discount_fallback)
+    fallback_discounts = [0.5, 1.0, 1.5]
+
+    def __init__(self, sentences, N, vocab_size):
+        """sentences: sequences of ids (e.g. truncate() of generated rows)"""
+        assert N >= 1
+        self.N = N
+        self.vocab_size = vocab_size
+        self.bos = vocab_size
+        self.eos = vocab_size + 1
+        self.unk = vocab_size + 2
+        self.nwords = vocab_size + 3
+        self.estimate(*self.stream(sentences, eos=True))
+
+    def stream(self, sentences, eos, bos=True):
+        """
+        All sentences as one array of ids, each one preceded by <s> (unless
+        not bos) and followed by </s> (if eos), with every token's position
+        in its sentence
+        """
+        sentences = [np.asarray(s, dtype=np.int64).reshape(-1)
+                     for s in sentences]
+        lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+        lengths += int(bos) + int(eos)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        tokens = np.empty(ends[-1] if len(ends) else 0, dtype=np.int64)
+        body = np.ones(len(tokens), dtype=bool)
+        if bos:
+            tokens[starts] = self.bos
+            body[starts] = False
+        if eos:
+            tokens[ends-1] = self.eos
+            body[ends-1] = False
+        if len(sentences):
+            words = np.concatenate(sentences)
+            unknown = (words < 0) | (words >= self.vocab_size)
+            tokens[body] = np.where(unknown, self.unk, words)
+        positions = np.arange(len(tokens)) - np.repeat(starts, lengths)
+        return tokens, positions
+
+    def ngram_ids(self, tokens, positions, n, prev_ids, keys=None):
+        """
+        Keys of the n-grams ending at each token (-1 where the n-gram would
+        cross the sentence start), from those of the (n-1)-grams. With keys
+        (the sorted keys of the model's n-grams) returns the index of each
+        n-gram in keys instead, or -1 if the model doesn't have it.
+        """
+        prefix = np.empty_like(prev_ids)
+        prefix[:1] = -1
+        prefix[1:] = prev_ids[:-1]
+        valid = (positions >= n-1) & (prefix >= 0)
+        ngram = prefix * self.nwords + tokens
+        if keys is None:
+            return np.where(valid, ngram, -1)
+        idx = np.searchsorted(keys, ngram)
+        idx[idx == len(keys)] = 0
+        found = valid & (keys[idx] == ngram) if len(keys) else valid & False
+        return np.where(found, idx, -1)
+
+    def discounts(self, counts):
+        """
+        Modified Kneser-Ney discounts D(0), D(1), D(2), D(3+), with lmplz's
+        checks: counts of counts 1 to 3 must be nonzero (not 4, which just
+        gives D(3+) = 3) and 0 <= D(k) <= k
+        """
+        t = [np.sum(counts == k) for k in range(1, 5)]
+        if min(t[:3]) == 0:
+            return np.array([0.] + self.fallback_discounts)
+        y = t[0] / float(t[0] + 2*t[1])
+        d = [k - (k+1) * y * t[k] / float(t[k-1]) for k in range(1, 4)]
+        if any(not 0 <= d[k-1] <= k for k in range(1, 4)):
+            return np.array([0.] + self.fallback_discounts)
+        return np.array([0.] + d)
+
+    def estimate(self, tokens, positions):
+        N = self.N
+        # per order: sorted n-gram keys (prefix id * nwords + word), and for
+        # every n-gram its prefix (context) and suffix ids one order down
+        self.keys = [None] * (N+1)
+        prefixes = [None] * (N+1)
+        suffixes = [None] * (N+1)
+        raw = [None] * (N+1)
+        first = [None] * (N+1)
+
+        # unigram ids are the word ids
+        raw[1] = np.bincount(tokens, minlength=self.nwords)
+        first[1] = np.arange(self.nwords)
+        ids = tokens
+        for n in range(2, N+1):
+            keys = self.ngram_ids(tokens, positions, n, ids)
+            at = np.nonzero(keys >= 0)[0]
+            uniq, index, inverse, counts = np.unique(
+                keys[at], return_index=True, return_inverse=True,
+                return_counts=True)
+            self.keys[n] = uniq
+            raw[n] = counts
+            prefixes[n] = uniq // self.nwords
+            # the suffix of the n-gram ending at a token is the (n-1)-gram
+            # ending there
+            suffixes[n] = ids[at[index]]
+            first[n] = first[n-1][prefixes[n]]
+            ids = np.full(len(tokens), -1, dtype=np.int64)
+            ids[at] = inverse.reshape(-1)
+
+        # adjusted counts: the number of distinct words preceding the n-gram,
+        # except at the highest order and for n-grams that start with <s>
+        adjusted = [None] * (N+1)
+        adjusted[N] = raw[N]
+        for n in range(N-1, 0, -1):
+            adjusted[n] = np.bincount(suffixes[n+1], minlength=len(raw[n]))
+            bos = first[n] == self.bos
+            adjusted[n][bos] = raw[n][bos]
+        # <s> is only ever context
+        adjusted[1][self.bos] = 0
+
+        # probabilities before interpolation, and the backoff (interpolation)
+        # weight of every n-gram as context
+        self.logp = [None] * (N+1)
+        self.logbo = [None] * (N+1)
+        probs = [None] * (N+1)
+        gammas = [None] * (N+1)
+        for n in range(1, N+1):
+            a = adjusted[n].astype(np.float64)
+            d = self.discounts(adjusted[n][adjusted[n] > 0])
+            discount = d[np.minimum(adjusted[n], 3)]
+            if n == 1:
+                context = np.zeros(len(a), dtype=np.int64)
+                ncontexts = 1
+            else:
+                context = prefixes[n]
+                ncontexts = len(raw[n-1])
+            total = np.bincount(context, weights=a, minlength=ncontexts)
+            gamma = np.bincount(context, weights=discount, minlength=ncontexts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                gamma = np.where(total > 0, gamma / total, 1.)
+                probs[n] = np.where(total[context] > 0,
+                                    (a - discount) / total[context], 0.)
+            gammas[n-1] = gamma
+
+        # interpolate: p(w|context) = u(w|context) + gamma(context) p(w|suffix)
+        # <unk> and unseen words only get the uniform share; <s> none at all
+        probs[1] = probs[1] + gammas[0][0] / (self.nwords - 1)
+        probs[1][self.bos] = 0
+        for n in range(2, N+1):
+            probs[n] = probs[n] + gammas[n-1][prefixes[n]] * \
+                probs[n-1][suffixes[n]]
+
+        with np.errstate(divide='ignore'):
+            for n in range(1, N+1):
+                self.logp[n] = np.log10(probs[n])
+                if n < N:
+                    self.logbo[n] = np.log10(gammas[n])
+                else:
+                    self.logbo[n] = np.zeros(len(probs[n]))
+
+    def token_scores(self, tokens, positions):
+        """log10 p of every token given its (up to N-1) predecessors"""
+        N = self.N
+        # index of the longest n-gram ending at each token the model has,
+        # for every order, and of each token's contexts
+        ids = [None, tokens]
+        for n in range(2, N+1):
+            ids.append(self.ngram_ids(tokens, positions, n, ids[n-1],
+                                      keys=self.keys[n]))
+        scores = np.zeros(len(tokens))
+        done = np.zeros(len(tokens), dtype=bool)
+        for n in range(N, 0, -1):
+            found = ~done & (ids[n] >= 0)
+            scores[found] += self.logp[n][ids[n][found]]
+            done |= found
+            if n > 1:
+                # back off: p(w|c) = b(c) p(w|c') where b = 1 for an unseen c
+                context = np.empty_like(ids[n-1])
+                context[:1] = -1
+                context[1:] = ids[n-1][:-1]
+                backoff = ~done & (context >= 0) & (positions >= n-1)
+                scores[backoff] += self.logbo[n-1][context[backoff]]
+        return scores
+
+    def score(self, sentence, bos=True, eos=False):
+        """
+        log10 probability of a sequence of ids (like kenlm.Model.score):
+        from <s>, or without bos from no context, so that the first word is
+        scored by its unigram probability
+        """
+        tokens, positions = self.stream([sentence], eos, bos)
+        scores = self.token_scores(tokens, positions)
+        if bos:
+            # <s> is only context
+            scores = scores[positions > 0]
+        return float(scores.sum())
+
+    def sentence_scores(self, sentences):
+        """
+        log10 probability (from <s>, without </s>) and word count of each
+        sentence (sequence of ids)
+        """
+        tokens, positions = self.stream(sentences, eos=False)
+        scores = self.token_scores(tokens, positions)
+        words = positions > 0
+        sentence = (np.cumsum(positions == 0) - 1)[words]
+        return (np.bincount(sentence, weights=scores[words],
+                            minlength=len(sentences)),
+                np.bincount(sentence, minlength=len(sentences)))
+
+    def perplexity(self, sentences):
+        """
+        Perplexity of sentences (sequences of ids), as get_ppl: scored from
+        <s>, without </s>, normalized by the number of words
+        """
+        scores, word_counts = self.sentence_scores(sentences)
+        return 10**-(scores.sum() / word_counts.sum())
+
+
+def train_kneser_ney(sentences, N, vocab_size, laplace=True):
+    """
+    Kneser-Ney LM on sentences of ids, as train_ngram_lm; with laplace every
+    vocabulary word is also added as a one word sentence, like the vocabulary
+    lines train_ngram_lm's input file starts with
+    """
+    sentences = list(sentences)
+    if laplace:
+        sentences = [[w] for w in range(vocab_size)] + sentences
+    return KneserNeyLM(sentences, N, vocab_size)
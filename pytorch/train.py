@@ -6,6 +6,7 @@ import numpy as np
 import random
 import sys
 import json
+import signal
 
 import torch
 import torch.nn as nn
@@ -13,8 +14,12 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
 
-from utils import to_gpu, Corpus, batchify, train_ngram_lm, get_ppl
+from utils import to_gpu, Corpus, batchify, snapshot, \
+    get_rng_state, set_rng_state, ArtifactWriter, write_sentences, \
+    init_distributed, shard_batch, average_gradients, broadcast_params, \
+    broadcast_flag, CodeMonitor
 from models import Seq2Seq, MLP_D, MLP_G
+from lm_eval import ReversePerplexity, LMEvaluator
 
 parser = argparse.ArgumentParser(description='PyTorch ARAE for Text')
 # Path Arguments
@@ -22,6 +27,12 @@ parser.add_argument('--data_path', type=str, required=True,
                     help='location of the data corpus')
 parser.add_argument('--kenlm_path', type=str, default='../Data/kenlm',
                     help='path to kenlm directory')
+parser.add_argument('--lm_backend', type=str, default='kenlm',
+                    choices=['kenlm', 'numpy'],
+                    help='n-gram language model for the reverse perplexity: '
+                         'KenLM at --kenlm_path, or the built-in Kneser-Ney '
+                         'on token ids (numpy; checked against lmplz by '
+                         'experiments/ngram_parity.py)')
 parser.add_argument('--outf', type=str, default='example',
                     help='output directory name')
 
@@ -73,8 +84,42 @@ parser.add_argument('--no_earlystopping', action='store_true',
 parser.add_argument('--patience', type=int, default=5,
                     help="number of language model evaluations without ppl "
                          "improvement to wait before early stopping")
+parser.add_argument('--sync_lm', action='store_true',
+                    help="evaluate the language model in the training process "
+                         "(default: in a background worker process, applying "
+                         "early stopping when its results arrive)")
+parser.add_argument('--lm_gate', type=float, default=0,
+                    help="skip a reverse perplexity evaluation when the "
+                         "Frechet distance between real and fake codes is "
+                         "over this many times that at the best models' "
+                         "evaluation; skips do not count towards "
+                         "--patience (0 = always evaluate)")
+parser.add_argument('--lm_samples', type=int, default=100000,
+                    help="number of generated sentences the language model "
+                         "is trained on at most")
+parser.add_argument('--lm_min_samples', type=int, default=0,
+                    help="adaptive budget: generated sentences of the first "
+                         "stage of the evaluation, doubled each stage up to "
+                         "--lm_samples (sampling stops once the models are "
+                         "significantly worse or better than the best ones "
+                         "over the evaluation sentences, not over generated "
+                         "samples; 0 = fixed budget of --lm_samples; "
+                         "--lm_samples / 8 is recommended)")
+parser.add_argument('--lm_alpha', type=float, default=0.05,
+                    help="significance level for stopping an evaluation early")
+parser.add_argument('--lm_bootstrap', type=int, default=1000,
+                    help="bootstrap resamples of the evaluation sentences")
 parser.add_argument('--batch_size', type=int, default=64, metavar='N',
                     help='batch size')
+parser.add_argument('--accum_steps', type=int, default=1,
+                    help='split each autoencoder and critic batch into this '
+                         'many micro-batches and accumulate their gradients '
+                         '(same updates, lower peak memory)')
+parser.add_argument('--checkpoint_segment', type=int, default=0,
+                    help='decode this many time steps at a time under '
+                         'activation checkpointing in the autoencoder step, '
+                         'recomputing them in the backward pass to save '
+                         'memory on long sentences (0 = off)')
 parser.add_argument('--niters_ae', type=int, default=1,
                     help='number of autoencoder iterations in training')
 parser.add_argument('--niters_gan_d', type=int, default=5,
@@ -84,6 +129,14 @@ parser.add_argument('--niters_gan_g', type=int, default=1,
 parser.add_argument('--niters_gan_schedule', type=str, default='2-4-6',
                     help='epoch counts to increase number of GAN training '
                          ' iterations (increment by 1 each time)')
+parser.add_argument('--code_buffer_size', type=int, default=0,
+                    help='keep this many recently encoded real codes and '
+                         'train the critic on them between encoder updates '
+                         '(0 = encode a fresh batch for every critic step)')
+parser.add_argument('--enc_update_interval', type=int, default=5,
+                    help='with --code_buffer_size, encode a real batch (and '
+                         'pass the critic gradient to the encoder) only every '
+                         'this many critic steps')
 parser.add_argument('--lr_ae', type=float, default=1,
                     help='autoencoder learning rate')
 parser.add_argument('--lr_gan_g', type=float, default=5e-05,
@@ -102,6 +155,11 @@ parser.add_argument('--sample', action='store_true',
                     help='sample when decoding for generation')
 parser.add_argument('--N', type=int, default=5,
                     help='N-gram order for training n-gram language model')
+parser.add_argument('--eval_batch_size', type=int, default=100,
+                    help='batch size for evaluating the autoencoder')
+parser.add_argument('--eval_dump_size', type=int, default=1000,
+                    help='number of test sentences whose reconstructions are '
+                         'written at each evaluation (-1 = all)')
 parser.add_argument('--log_interval', type=int, default=200,
                     help='interval to log autoencoder training results')
 
@@ -110,26 +168,49 @@ parser.add_argument('--seed', type=int, default=1111,
                     help='random seed')
 parser.add_argument('--cuda', action='store_true',
                     help='use CUDA')
+parser.add_argument('--resume', action='store_true',
+                    help='resume from the training checkpoint in the output '
+                         'directory')
+parser.add_argument('--checkpoint_interval', type=int, default=1000,
+                    help='save a resumable training checkpoint every this '
+                         'many steps (0 = only on SIGTERM)')
+parser.add_argument('--max_steps', type=int, default=0,
+                    help='stop after this many training steps and report '
+                         'throughput (for benchmarking; 0 = no limit)')
 
 args = parser.parse_args()
-print(vars(args))
+
+# data parallel training when launched with torchrun: every process trains
+# on its share of each batch and gradients are averaged before each update
+rank, world_size = init_distributed()
+master = rank == 0
+assert args.batch_size % world_size == 0, \
+    "batch_size must be divisible by the number of processes"
+local_batch_size = args.batch_size // world_size
+assert local_batch_size % args.accum_steps == 0, \
+    "batch_size per process must be divisible by accum_steps"
+micro_batch_size = local_batch_size // args.accum_steps
+if master:
+    print(vars(args))
 
 # make output directory if it doesn't already exist
-if not os.path.isdir('./output'):
+if master and not os.path.isdir('./output'):
     os.makedirs('./output')
-if not os.path.isdir('./output/{}'.format(args.outf)):
+if master and not os.path.isdir('./output/{}'.format(args.outf)):
     os.makedirs('./output/{}'.format(args.outf))
 
 # Set the random seed manually for reproducibility.
+# python's random (batch order, critic batches) must agree across processes;
+# torch's (generator noise) differs so each process draws its own samples
 random.seed(args.seed)
 np.random.seed(args.seed)
-torch.manual_seed(args.seed)
+torch.manual_seed(args.seed + rank)
 if torch.cuda.is_available():
     if not args.cuda:
         print("WARNING: You have a CUDA device, "
               "so you should probably run with --cuda")
     else:
-        torch.cuda.manual_seed(args.seed)
+        torch.cuda.manual_seed(args.seed + rank)
 
 ###############################################################################
 # Load data
@@ -140,25 +221,31 @@ corpus = Corpus(args.data_path,
                 maxlen=args.maxlen,
                 vocab_size=args.vocab_size,
                 lowercase=args.lowercase)
-# dumping vocabulary
-with open('./output/{}/vocab.json'.format(args.outf), 'w') as f:
-    json.dump(corpus.dictionary.word2idx, f)
-
-# save arguments
 ntokens = len(corpus.dictionary.word2idx)
-print("Vocabulary Size: {}".format(ntokens))
 args.ntokens = ntokens
-with open('./output/{}/args.json'.format(args.outf), 'w') as f:
-    json.dump(vars(args), f)
-with open("./output/{}/logs.txt".format(args.outf), 'w') as f:
-    f.write(str(vars(args)))
-    f.write("\n\n")
-
-eval_batch_size = 10
+if master:
+    # dumping vocabulary
+    with open('./output/{}/vocab.json'.format(args.outf), 'w') as f:
+        json.dump(corpus.dictionary.word2idx, f)
+
+    # save arguments
+    print("Vocabulary Size: {}".format(ntokens))
+    with open('./output/{}/args.json'.format(args.outf), 'w') as f:
+        json.dump(vars(args), f)
+    with open("./output/{}/logs.txt".format(args.outf),
+              'a' if args.resume else 'w') as f:
+        f.write(str(vars(args)))
+        f.write("\n\n")
+
+eval_batch_size = args.eval_batch_size
 test_data = batchify(corpus.test, eval_batch_size, shuffle=False)
+# corpus order of the training sentences, to record the batch order
+train_unshuffled = list(corpus.train)
+train_ids = {id(x): i for i, x in enumerate(train_unshuffled)}
 train_data = batchify(corpus.train, args.batch_size, shuffle=True)
 
-print("Loaded data!")
+if master:
+    print("Loaded data!")
 
 ###############################################################################
 # Build the models
@@ -172,14 +259,16 @@ autoencoder = Seq2Seq(emsize=args.emsize,
                       noise_radius=args.noise_radius,
                       hidden_init=args.hidden_init,
                       dropout=args.dropout,
+                      checkpoint_segment=args.checkpoint_segment,
                       gpu=args.cuda)
 
 gan_gen = MLP_G(ninput=args.z_size, noutput=args.nhidden, layers=args.arch_g)
 gan_disc = MLP_D(ninput=args.nhidden, noutput=1, layers=args.arch_d)
 
-print(autoencoder)
-print(gan_gen)
-print(gan_disc)
+if master:
+    print(autoencoder)
+    print(gan_gen)
+    print(gan_disc)
 
 optimizer_ae = optim.SGD(autoencoder.parameters(), lr=args.lr_ae)
 optimizer_gan_g = optim.Adam(gan_gen.parameters(),
@@ -189,77 +278,118 @@ optimizer_gan_d = optim.Adam(gan_disc.parameters(),
                              lr=args.lr_gan_d,
                              betas=(args.beta1, 0.999))
 
-criterion_ce = nn.CrossEntropyLoss()
-
 if args.cuda:
     autoencoder = autoencoder.cuda()
     gan_gen = gan_gen.cuda()
     gan_disc = gan_disc.cuda()
-    criterion_ce = criterion_ce.cuda()
+
+# processes start from the same weights
+broadcast_params(autoencoder, world_size)
+broadcast_params(gan_gen, world_size)
+broadcast_params(gan_disc, world_size)
+
+# checkpoints and sample files are written in the background
+writer = ArtifactWriter()
+# and reverse perplexity is evaluated in a worker process
+lm_evaluator = LMEvaluator('./output/{}'.format(args.outf), writer,
+                           seed=args.seed) if master else None
+# statistics of the real and fake codes between evaluations
+code_monitor = CodeMonitor() if master else None
 
 ###############################################################################
 # Training code
 ###############################################################################
 
 
-def save_model():
+def save_model(states=None):
+    """Save the models, or the snapshotted state dicts in states"""
     print("Saving models")
-    with open('./output/{}/autoencoder_model.pt'.format(args.outf), 'wb') as f:
-        torch.save(autoencoder.state_dict(), f)
-    with open('./output/{}/gan_gen_model.pt'.format(args.outf), 'wb') as f:
-        torch.save(gan_gen.state_dict(), f)
-    with open('./output/{}/gan_disc_model.pt'.format(args.outf), 'wb') as f:
-        torch.save(gan_disc.state_dict(), f)
+    if states is None:
+        states = {'autoencoder': autoencoder.state_dict(),
+                  'gan_gen': gan_gen.state_dict(),
+                  'gan_disc': gan_disc.state_dict()}
+    for name in ['autoencoder', 'gan_gen', 'gan_disc']:
+        writer.save(states[name],
+                    './output/{}/{}_model.pt'.format(args.outf, name))
+
+
+def save_checkpoint(epoch, niter, niter_global):
+    """
+    Save everything needed to resume training after step niter of epoch:
+    weights, optimizer moments, random state, GAN schedule, noise radius,
+    early stopping state and the order of this epoch's training batches.
+    """
+    print("Saving training checkpoint")
+    checkpoint = {
+        'autoencoder': autoencoder.state_dict(),
+        'gan_gen': gan_gen.state_dict(),
+        'gan_disc': gan_disc.state_dict(),
+        'optimizer_ae': optimizer_ae.state_dict(),
+        'optimizer_gan_g': optimizer_gan_g.state_dict(),
+        'optimizer_gan_d': optimizer_gan_d.state_dict(),
+        'rng': get_rng_state(args.cuda),
+        'epoch': epoch,
+        'niter': niter,
+        'niter_global': niter_global,
+        'niter_gan': niter_gan,
+        'noise_radius': autoencoder.noise_radius,
+        'best_ppl': best_ppl,
+        'lm_reference': lm_reference,
+        'best_fd': best_fd,
+        'impatience': impatience,
+        'all_ppl': all_ppl,
+        'fixed_noise': fixed_noise.data.cpu(),
+        'train_order': np.array([train_ids[id(x)] for x in corpus.train],
+                                dtype=np.int64),
+    }
+    writer.save(checkpoint, './output/{}/checkpoint.pt'.format(args.outf))
+
+
+def handle_sigterm(signum, frame):
+    # checkpoint at the next step boundary rather than mid-update
+    global preempted
+    preempted = True
 
 
 def evaluate_autoencoder(data_source, epoch):
+    """
+    Token-level reconstruction loss and accuracy on data_source; the
+    reconstructions of the first --eval_dump_size sentences are written out
+    """
     # Turn on evaluation mode which disables dropout.
     autoencoder.eval()
     total_loss = 0
-    ntokens = len(corpus.dictionary.word2idx)
-    all_accuracies = 0
-    bcnt = 0
+    total_correct = 0
+    total_targets = 0
+    targets, outputs = [], []
+    ndumped = 0
     for i, batch in enumerate(data_source):
         source, target, lengths = batch
-        source = to_gpu(args.cuda, Variable(source, volatile=True))
-        target = to_gpu(args.cuda, Variable(target, volatile=True))
+        source = to_gpu(args.cuda, source)
+        target = to_gpu(args.cuda, target)
 
-        mask = target.gt(0)
-        masked_target = target.masked_select(mask)
-        # examples x ntokens
-        output_mask = mask.unsqueeze(1).expand(mask.size(0), ntokens)
+        dump = args.eval_dump_size < 0 or ndumped < args.eval_dump_size
+        with torch.no_grad():
+            # loss and accuracy over the unpadded positions only
+            hidden = autoencoder(source, lengths, noise=True, encode_only=True)
+            result = autoencoder.decode_loss(hidden, source, lengths, target,
+                                             temp=args.temp, predictions=dump)
+            total_loss += result[0].item()
+            total_correct += result[1].item()
+            total_targets += int(target.gt(0).sum())
 
-        # output: batch x seq_len x ntokens
-        output = autoencoder(source, lengths, noise=True)
-        flattened_output = output.view(-1, ntokens)
+        if dump:
+            # the argmax words of the same pass: batch x seq_len
+            outputs.append(result[2].cpu().numpy())
+            targets.append(target.view(source.size(0), -1).cpu().numpy())
+            ndumped += source.size(0)
 
-        masked_output = \
-            flattened_output.masked_select(output_mask).view(-1, ntokens)
-        total_loss += criterion_ce(masked_output/args.temp, masked_target).data
+    # real sentence, then autoencoder output sentence
+    aeoutf = "./output/%s/%d_autoencoder.txt" % (args.outf, epoch)
+    writer.put(write_sentences, aeoutf, [targets, outputs],
+               corpus.dictionary.idx2word, None, "\n")
 
-        # accuracy
-        max_vals, max_indices = torch.max(masked_output, 1)
-        all_accuracies += \
-            torch.mean(max_indices.eq(masked_target).float()).data[0]
-        bcnt += 1
-
-        aeoutf = "./output/%s/%d_autoencoder.txt" % (args.outf, epoch)
-        with open(aeoutf, "a") as f:
-            max_values, max_indices = torch.max(output, 2)
-            max_indices = \
-                max_indices.view(output.size(0), -1).data.cpu().numpy()
-            target = target.view(output.size(0), -1).data.cpu().numpy()
-            for t, idx in zip(target, max_indices):
-                # real sentence
-                chars = " ".join([corpus.dictionary.idx2word[x] for x in t])
-                f.write(chars)
-                f.write("\n")
-                # autoencoder output sentence
-                chars = " ".join([corpus.dictionary.idx2word[x] for x in idx])
-                f.write(chars)
-                f.write("\n\n")
-
-    return total_loss[0] / len(data_source), all_accuracies/bcnt
+    return total_loss / total_targets, total_correct / total_targets
 
 
 def evaluate_generator(noise, epoch):
@@ -267,112 +397,178 @@ def evaluate_generator(noise, epoch):
     autoencoder.eval()
 
     # generate from fixed random noise
-    fake_hidden = gan_gen(noise)
-    max_indices = \
-        autoencoder.generate(fake_hidden, args.maxlen, sample=args.sample)
-
-    with open("./output/%s/%s_generated.txt" % (args.outf, epoch), "w") as f:
-        max_indices = max_indices.data.cpu().numpy()
-        for idx in max_indices:
-            # generated sentence
-            words = [corpus.dictionary.idx2word[x] for x in idx]
-            # truncate sentences to first occurrence of <eos>
-            truncated_sent = []
-            for w in words:
-                if w != '<eos>':
-                    truncated_sent.append(w)
-                else:
-                    break
-            chars = " ".join(truncated_sent)
-            f.write(chars)
-            f.write("\n")
-
-
-def train_lm(eval_path, save_path):
-    # generate examples
-    indices = []
-    noise = to_gpu(args.cuda, Variable(torch.ones(100, args.z_size)))
-    for i in range(1000):
-        noise.data.normal_(0, 1)
-
+    with torch.no_grad():
         fake_hidden = gan_gen(noise)
-        max_indices = autoencoder.generate(fake_hidden, args.maxlen)
-        indices.append(max_indices.data.cpu().numpy())
-
-    indices = np.concatenate(indices, axis=0)
-
-    # write generated sentences to text file
-    with open(save_path+".txt", "w") as f:
-        # laplacian smoothing
-        for word in corpus.dictionary.word2idx.keys():
-            f.write(word+"\n")
-        for idx in indices:
-            # generated sentence
-            words = [corpus.dictionary.idx2word[x] for x in idx]
-            # truncate sentences to first occurrence of <eos>
-            truncated_sent = []
-            for w in words:
-                if w != '<eos>':
-                    truncated_sent.append(w)
-                else:
-                    break
-            chars = " ".join(truncated_sent)
-            f.write(chars+"\n")
-
-    # train language model on generated examples
-    lm = train_ngram_lm(kenlm_path=args.kenlm_path,
-                        data_path=save_path+".txt",
-                        output_path=save_path+".arpa",
-                        N=args.N)
-
-    # load sentences to evaluate on
-    with open(eval_path, 'r') as f:
-        lines = f.readlines()
-    sentences = [l.replace('\n', '') for l in lines]
-    ppl = get_ppl(lm, sentences)
-
-    return ppl
+        max_indices = \
+            autoencoder.generate(fake_hidden, args.maxlen, sample=args.sample)
+
+    # sentences are truncated to the first occurrence of <eos>
+    writer.put(write_sentences,
+               "./output/%s/%s_generated.txt" % (args.outf, epoch),
+               [[max_indices.data.cpu().numpy()]],
+               corpus.dictionary.idx2word, '<eos>')
+
+
+def evaluate_lm(label):
+    """
+    Reverse perplexity of the current models for early stopping: handed to
+    the background worker (see apply_lm_results), or with --sync_lm
+    evaluated here. Returns whether training should stop.
+    """
+    global reverse_ppl
+    fd = code_monitor.last['fd'] if code_monitor.last else None
+    if args.lm_gate > 0 and fd is not None and best_fd is not None and \
+            fd > args.lm_gate * best_fd:
+        msg = "Skipping reverse perplexity ({}): code FD {:.4f} > {} x " \
+              "{:.4f} at the best models".format(label, fd, args.lm_gate,
+                                                 best_fd)
+        print(msg)
+        with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+            f.write("\n"+msg+"\n")
+        # not an evaluation: the patience only counts those
+        return False
+    eval_fds[label] = fd
+
+    eval_path = os.path.join(args.data_path, "test.txt")
+    save_path = "./output/{}/{}_lm_generations".format(args.outf, label)
+    if args.sync_lm:
+        if reverse_ppl is None:
+            reverse_ppl = ReversePerplexity(args, corpus.dictionary.idx2word,
+                                            lm_reference)
+        result = reverse_ppl.evaluate(autoencoder, gan_gen, eval_path,
+                                      save_path)
+        return record_ppl(label, result)
+    states = {'autoencoder': snapshot(autoencoder.state_dict()),
+              'gan_gen': snapshot(gan_gen.state_dict()),
+              'gan_disc': snapshot(gan_disc.state_dict())}
+    lm_evaluator.submit(label, states, eval_path, save_path)
+    return False
+
+
+def apply_lm_results(wait=False):
+    """
+    Early stopping on the background evaluations that have finished (with
+    wait, on all of them); returns whether training should stop
+    """
+    stop = False
+    for label, result, states in lm_evaluator.poll(wait):
+        stop = record_ppl(label, result, states) or stop
+    return stop
+
+
+def record_ppl(label, result, states=None):
+    """
+    Log the reverse perplexity of the models evaluated at label (result of
+    ReversePerplexity.evaluate), save them (states, or the current models)
+    on improvement and return whether training should stop
+    """
+    global best_ppl, impatience, lm_reference, best_fd
+    ppl = result['ppl']
+    fd = eval_fds.pop(label, None)
+    print("Perplexity {} ({}, {} samples)".format(ppl, label,
+                                                  result['nsamples']))
+    all_ppl.append(ppl)
+    print(all_ppl)
+    with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+        f.write("\n\nPerplexity {} ({}, {} samples)\n".format(
+            ppl, label, result['nsamples']))
+        f.write(str(all_ppl)+"\n\n")
+    if result['improved']:
+        impatience = 0
+        best_ppl = ppl
+        lm_reference = result['reference']
+        best_fd = fd
+        print("New best ppl {}\n".format(best_ppl))
+        with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+            f.write("New best ppl {}\n".format(best_ppl))
+        save_model(states)
+        return False
+    return no_improvement()
+
+
+def no_improvement():
+    """Count an evaluation without improvement; returns whether to stop"""
+    global impatience
+    impatience += 1
+    # end training
+    if impatience > args.patience:
+        print("Ending training")
+        with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+            f.write("\nEnding Training\n")
+        return True
+    return False
+
+
+def report_codes():
+    """Log the statistics of the codes seen since the last report"""
+    stats = code_monitor.report()
+    if stats is None:
+        return
+    msg = '| codes | FD {fd:.4f} | mean gap {mean_gap:.4f} | std ratio ' \
+          '{std_ratio:.3f} | collapsed dims {collapsed}'.format(**stats)
+    print(msg)
+    with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+        f.write(msg+"\n")
+
+
+def report_throughput(nsteps, elapsed):
+    """Log training speed over all processes to throughput.json"""
+    result = {'nprocs': world_size,
+              'batch_size': args.batch_size,
+              'steps': nsteps,
+              'seconds': elapsed,
+              'steps_per_sec': nsteps / elapsed,
+              'sents_per_sec': nsteps * args.niters_ae * args.batch_size / elapsed}
+    print("| throughput {:d} processes | {:.2f} steps/s | {:.1f} sents/s".
+          format(world_size, result['steps_per_sec'], result['sents_per_sec']))
+    with open("./output/{}/throughput.json".format(args.outf), 'w') as f:
+        json.dump(result, f)
+
+
+def micro_batches(batch):
+    """This process's share of batch, split into --accum_steps micro-batches"""
+    batch = shard_batch(batch, rank, world_size)
+    return [shard_batch(batch, j, args.accum_steps)
+            for j in range(args.accum_steps)]
 
 
 def train_ae(batch, total_loss_ae, start_time, i):
     autoencoder.train()
     autoencoder.zero_grad()
+    autoencoder.reset_grad_norm()
 
-    source, target, lengths = batch
-    source = to_gpu(args.cuda, Variable(source))
-    target = to_gpu(args.cuda, Variable(target))
+    micro = micro_batches(batch)
+    # weight each micro-batch by its share of the target tokens, so that the
+    # accumulated gradient is that of the mean loss over the whole batch
+    ntargets = sum(int(target.gt(0).sum()) for _, target, _ in micro)
 
-    # Create sentence length mask over padding
-    mask = target.gt(0)
-    masked_target = target.masked_select(mask)
-    # examples x ntokens
-    output_mask = mask.unsqueeze(1).expand(mask.size(0), ntokens)
+    correct = 0
+    for source, target, lengths in micro:
+        source = to_gpu(args.cuda, Variable(source))
+        target = to_gpu(args.cuda, Variable(target))
 
-    # output: batch x seq_len x ntokens
-    output = autoencoder(source, lengths, noise=True)
+        # summed cross entropy over the target tokens; the decoder runs in
+        # checkpointed segments with --checkpoint_segment
+        loss, micro_correct = autoencoder(source, lengths, noise=True,
+                                          target=target, temp=args.temp)
+        loss = loss / ntargets
+        loss.backward()
 
-    # output_size: batch_size, maxlen, self.ntokens
-    flattened_output = output.view(-1, ntokens)
+        total_loss_ae += loss.detach()
+        correct += micro_correct
 
-    masked_output = \
-        flattened_output.masked_select(output_mask).view(-1, ntokens)
-    loss = criterion_ce(masked_output/args.temp, masked_target)
-    loss.backward()
+    average_gradients(autoencoder, world_size)
 
     # `clip_grad_norm` to prevent exploding gradient in RNNs / LSTMs
-    torch.nn.utils.clip_grad_norm(autoencoder.parameters(), args.clip)
+    torch.nn.utils.clip_grad_norm_(autoencoder.parameters(), args.clip)
     optimizer_ae.step()
 
-    total_loss_ae += loss.data
-
     accuracy = None
-    if i % args.log_interval == 0 and i > 0:
+    if i % args.log_interval == 0 and i > 0 and master:
         # accuracy
-        probs = F.softmax(masked_output)
-        max_vals, max_indices = torch.max(probs, 1)
-        accuracy = torch.mean(max_indices.eq(masked_target).float()).data[0]
+        accuracy = correct.item() / ntargets
 
-        cur_loss = total_loss_ae[0] / args.log_interval
+        cur_loss = float(total_loss_ae) / args.log_interval
         elapsed = time.time() - start_time
         print('| epoch {:3d} | {:5d}/{:5d} batches | ms/batch {:5.2f} | '
               'loss {:5.2f} | ppl {:8.2f} | acc {:8.2f}'
@@ -398,7 +594,7 @@ def train_gan_g():
     gan_gen.zero_grad()
 
     noise = to_gpu(args.cuda,
-                   Variable(torch.ones(args.batch_size, args.z_size)))
+                   Variable(torch.ones(local_batch_size, args.z_size)))
     noise.data.normal_(0, 1)
 
     fake_hidden = gan_gen(noise)
@@ -406,73 +602,151 @@ def train_gan_g():
 
     # loss / backprop
     errG.backward(one)
+    average_gradients(gan_gen, world_size)
     optimizer_gan_g.step()
 
     return errG
 
 
-def grad_hook(grad):
+def normalize_code_grads(grads):
+    """
+    Critic gradients w.r.t. the real codes of each micro-batch, rescaled
+    for passing on to the encoder
+    """
     # Gradient norm: regularize to be same
     # code_grad_gan * code_grad_ae / norm(code_grad_gan)
+    # with both norms averaged over the whole batch
     if args.enc_grad_norm:
-        gan_norm = torch.norm(grad, 2, 1).detach().data.mean()
-        normed_grad = grad * autoencoder.grad_norm / gan_norm
+        gan_norm = sum(torch.norm(grad, 2, 1).data.sum() for grad in grads) / \
+            sum(grad.size(0) for grad in grads)
+        scale = autoencoder.grad_norm / gan_norm
     else:
-        normed_grad = grad
+        scale = 1
 
     # weight factor and sign flip
-    normed_grad *= -math.fabs(args.gan_toenc)
-    return normed_grad
-
-
-def train_gan_d(batch):
+    scale *= -math.fabs(args.gan_toenc)
+    return [grad * scale for grad in grads]
+
+
+def push_codes(codes):
+    """Add a batch of real codes to the ring buffer, overwriting the oldest"""
+    global code_buffer, code_buffer_len, code_buffer_pos
+    if code_buffer is None:
+        code_buffer = codes.new(args.code_buffer_size, codes.size(1)).zero_()
+    n = min(codes.size(0), args.code_buffer_size)
+    idx = torch.LongTensor([(code_buffer_pos+i) % args.code_buffer_size
+                            for i in range(n)])
+    code_buffer.index_copy_(0, to_gpu(args.cuda, idx), codes[:n])
+    code_buffer_pos = (code_buffer_pos+n) % args.code_buffer_size
+    code_buffer_len = min(code_buffer_len+n, args.code_buffer_size)
+
+
+def sample_codes(n):
+    """n real codes drawn from the buffer, as a Variable"""
+    idx = torch.LongTensor(n).random_(0, code_buffer_len)
+    return Variable(code_buffer.index_select(0, to_gpu(args.cuda, idx)))
+
+
+def encoder_step():
+    """
+    Whether the next critic step should encode a real batch (and train the
+    encoder on the critic's gradient) or reuse buffered codes
+    """
+    global critic_steps
+    critic_steps += 1
+    if args.code_buffer_size <= 0 or code_buffer_len < local_batch_size:
+        return True
+    return critic_steps % args.enc_update_interval == 0
+
+
+def train_gan_d(batch, update_encoder=True):
     # clamp parameters to a cube
     for p in gan_disc.parameters():
         p.data.clamp_(-args.gan_clamp, args.gan_clamp)
 
-    autoencoder.train()
-    autoencoder.zero_grad()
     gan_disc.train()
     gan_disc.zero_grad()
 
+    # micro-batch losses are weighted by their share of the batch
+    weight = 1.0 / args.accum_steps
+
     # positive samples ----------------------------
-    # generate real codes
-    source, target, lengths = batch
-    source = to_gpu(args.cuda, Variable(source))
-    target = to_gpu(args.cuda, Variable(target))
+    if update_encoder:
+        autoencoder.train()
+        autoencoder.zero_grad()
+        micro = micro_batches(batch)
+    else:
+        # critic-only step: no encoder forward/backward
+        micro = [None] * args.accum_steps
+
+    errD_real = 0
+    real_hiddens, real_codes = [], []
+    for part in micro:
+        if update_encoder:
+            # generate real codes
+            source, target, lengths = part
+            source = to_gpu(args.cuda, Variable(source))
+            target = to_gpu(args.cuda, Variable(target))
+
+            # batch_size x nhidden
+            real_hidden = autoencoder(source, lengths, noise=False,
+                                      encode_only=True)
+            if args.code_buffer_size > 0:
+                push_codes(real_hidden.data)
+            # the critic's gradient reaches the encoder below, once its norm
+            # over the whole batch is known
+            real_code = Variable(real_hidden.data, requires_grad=True)
+            real_hiddens.append(real_hidden)
+            real_codes.append(real_code)
+            if code_monitor is not None:
+                code_monitor.real.update(real_hidden.data)
+        else:
+            real_code = sample_codes(micro_batch_size)
 
-    # batch_size x nhidden
-    real_hidden = autoencoder(source, lengths, noise=False, encode_only=True)
-    real_hidden.register_hook(grad_hook)
+        # loss / backprop
+        err = gan_disc(real_code) * weight
+        err.backward(one)
+        errD_real = errD_real + err
 
-    # loss / backprop
-    errD_real = gan_disc(real_hidden)
-    errD_real.backward(one)
+    if update_encoder:
+        grads = normalize_code_grads([code.grad for code in real_codes])
+        for real_hidden, grad in zip(real_hiddens, grads):
+            real_hidden.backward(grad)
 
     # negative samples ----------------------------
-    # generate fake codes
-    noise = to_gpu(args.cuda,
-                   Variable(torch.ones(args.batch_size, args.z_size)))
-    noise.data.normal_(0, 1)
+    errD_fake = 0
+    for j in range(args.accum_steps):
+        # generate fake codes
+        noise = to_gpu(args.cuda,
+                       Variable(torch.ones(micro_batch_size, args.z_size)))
+        noise.data.normal_(0, 1)
 
-    # loss / backprop
-    fake_hidden = gan_gen(noise)
-    errD_fake = gan_disc(fake_hidden.detach())
-    errD_fake.backward(mone)
+        # loss / backprop
+        fake_hidden = gan_gen(noise)
+        if code_monitor is not None:
+            code_monitor.fake.update(fake_hidden.data)
+        err = gan_disc(fake_hidden.detach()) * weight
+        err.backward(mone)
+        errD_fake = errD_fake + err
+    average_gradients(gan_disc, world_size)
 
     # `clip_grad_norm` to prvent exploding gradient problem in RNNs / LSTMs
-    torch.nn.utils.clip_grad_norm(autoencoder.parameters(), args.clip)
+    if update_encoder:
+        average_gradients(autoencoder, world_size)
+        torch.nn.utils.clip_grad_norm_(autoencoder.parameters(), args.clip)
 
     optimizer_gan_d.step()
-    optimizer_ae.step()
+    if update_encoder:
+        optimizer_ae.step()
     errD = -(errD_real - errD_fake)
 
     return errD, errD_real, errD_fake
 
 
-print("Training...")
-with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
-    f.write('Training...\n')
+if master:
+    print("Training...")
+    with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+        f.write('Training...\n')
 
 # schedule of increasing GAN training loops
 if args.niters_gan_schedule != "":
@@ -481,29 +755,94 @@ else:
     gan_schedule = []
 niter_gan = 1
 
+# real codes for critic-only steps (see --code_buffer_size)
+code_buffer = None
+code_buffer_len = 0
+code_buffer_pos = 0
+critic_steps = 0
+
 fixed_noise = to_gpu(args.cuda,
                      Variable(torch.ones(args.batch_size, args.z_size)))
 fixed_noise.data.normal_(0, 1)
-one = to_gpu(args.cuda, torch.FloatTensor([1]))
+one = to_gpu(args.cuda, torch.tensor(1.))
 mone = one * -1
 
 best_ppl = None
+# per-sentence scores of the best models (see ReversePerplexity)
+lm_reference = None
+reverse_ppl = None
+# code Frechet distance when the best models (and those being evaluated)
+# were evaluated (see --lm_gate)
+best_fd = None
+eval_fds = {}
 impatience = 0
 all_ppl = []
-for epoch in range(1, args.epochs+1):
-    # update gan training schedule
-    if epoch in gan_schedule:
-        niter_gan += 1
-        print("GAN training loop schedule increased to {}".format(niter_gan))
+start_epoch = 1
+resume_niter = 0
+if args.resume:
+    checkpoint = torch.load('./output/{}/checkpoint.pt'.format(args.outf),
+                            weights_only=False)
+    autoencoder.load_state_dict(checkpoint['autoencoder'])
+    gan_gen.load_state_dict(checkpoint['gan_gen'])
+    gan_disc.load_state_dict(checkpoint['gan_disc'])
+    optimizer_ae.load_state_dict(checkpoint['optimizer_ae'])
+    optimizer_gan_g.load_state_dict(checkpoint['optimizer_gan_g'])
+    optimizer_gan_d.load_state_dict(checkpoint['optimizer_gan_d'])
+    niter_gan = checkpoint['niter_gan']
+    autoencoder.noise_radius = checkpoint['noise_radius']
+    best_ppl = checkpoint['best_ppl']
+    lm_reference = checkpoint['lm_reference']
+    best_fd = checkpoint['best_fd']
+    if lm_evaluator is not None:
+        lm_evaluator.reference = lm_reference
+    impatience = checkpoint['impatience']
+    all_ppl = checkpoint['all_ppl']
+    fixed_noise.data.copy_(checkpoint['fixed_noise'])
+    # same batches, in the same order, as the interrupted epoch
+    corpus.train[:] = [train_unshuffled[i] for i in checkpoint['train_order']]
+    train_data = batchify(corpus.train, args.batch_size, shuffle=False)
+    start_epoch = checkpoint['epoch']
+    resume_niter = checkpoint['niter']
+    resume_niter_global = checkpoint['niter_global']
+    set_rng_state(checkpoint['rng'])
+    if rank > 0:
+        # the checkpoint holds process 0's state; keep the noise distinct
+        torch.manual_seed(args.seed + rank + resume_niter_global)
+    if master:
+        print("Resuming at epoch {} step {}".format(start_epoch, resume_niter))
         with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
-            f.write("GAN training loop schedule increased to {}\n".
-                    format(niter_gan))
+            f.write("Resuming at epoch {} step {}\n".format(start_epoch,
+                                                           resume_niter))
+
+preempted = False
+signal.signal(signal.SIGTERM, handle_sigterm)
+
+# throughput, for --max_steps benchmarks
+total_steps = 0
+bench_start_time = None
+
+for epoch in range(start_epoch, args.epochs+1):
+    if resume_niter > 0:
+        # continue mid-epoch; the schedule was already updated
+        niter = resume_niter
+        niter_global = resume_niter_global
+        resume_niter = 0
+    else:
+        # update gan training schedule
+        if epoch in gan_schedule:
+            niter_gan += 1
+            if master:
+                print("GAN training loop schedule increased to {}".
+                      format(niter_gan))
+                with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+                    f.write("GAN training loop schedule increased to {}\n".
+                            format(niter_gan))
+        niter = 0
+        niter_global = 1
 
     total_loss_ae = 0
     epoch_start_time = time.time()
     start_time = time.time()
-    niter = 0
-    niter_global = 1
 
     # loop through all batches in training data
     while niter < len(train_data):
@@ -523,112 +862,112 @@ for epoch in range(1, args.epochs+1):
             for i in range(args.niters_gan_d):
                 # feed a seen sample within this epoch; good for early training
                 errD, errD_real, errD_fake = \
-                    train_gan_d(train_data[random.randint(0, len(train_data)-1)])
+                    train_gan_d(train_data[random.randint(0, len(train_data)-1)],
+                                update_encoder=encoder_step())
 
             # train generator
             for i in range(args.niters_gan_g):
                 errG = train_gan_g()
 
         niter_global += 1
+        if master and niter_global % args.log_interval == 0:
+            report_codes()
         if niter_global % 100 == 0:
-            print('[%d/%d][%d/%d] Loss_D: %.8f (Loss_D_real: %.8f '
-                  'Loss_D_fake: %.8f) Loss_G: %.8f'
-                  % (epoch, args.epochs, niter, len(train_data),
-                     errD.data[0], errD_real.data[0],
-                     errD_fake.data[0], errG.data[0]))
-            with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
-                f.write('[%d/%d][%d/%d] Loss_D: %.8f (Loss_D_real: %.8f '
-                        'Loss_D_fake: %.8f) Loss_G: %.8f\n'
-                        % (epoch, args.epochs, niter, len(train_data),
-                           errD.data[0], errD_real.data[0],
-                           errD_fake.data[0], errG.data[0]))
+            if master:
+                print('[%d/%d][%d/%d] Loss_D: %.8f (Loss_D_real: %.8f '
+                      'Loss_D_fake: %.8f) Loss_G: %.8f'
+                      % (epoch, args.epochs, niter, len(train_data),
+                         errD.item(), errD_real.item(),
+                         errD_fake.item(), errG.item()))
+                with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+                    f.write('[%d/%d][%d/%d] Loss_D: %.8f (Loss_D_real: %.8f '
+                            'Loss_D_fake: %.8f) Loss_G: %.8f\n'
+                            % (epoch, args.epochs, niter, len(train_data),
+                               errD.item(), errD_real.item(),
+                               errD_fake.item(), errG.item()))
 
             # exponentially decaying noise on autoencoder
             autoencoder.noise_radius = \
                 autoencoder.noise_radius*args.noise_anneal
 
+            stop = False
             if niter_global % 3000 == 0:
-                evaluate_generator(fixed_noise, "epoch{}_step{}".
-                                   format(epoch, niter_global))
+                if master:
+                    evaluate_generator(fixed_noise, "epoch{}_step{}".
+                                       format(epoch, niter_global))
 
                 # evaluate with lm
                 if not args.no_earlystopping and epoch > args.min_epochs:
-                    ppl = train_lm(eval_path=os.path.join(args.data_path,
-                                                          "test.txt"),
-                                   save_path="output/{}/"
-                                             "epoch{}_step{}_lm_generations".
-                                             format(args.outf, epoch,
-                                                    niter_global))
-                    print("Perplexity {}".format(ppl))
-                    all_ppl.append(ppl)
-                    print(all_ppl)
-                    with open("./output/{}/logs.txt".
-                              format(args.outf), 'a') as f:
-                        f.write("\n\nPerplexity {}\n".format(ppl))
-                        f.write(str(all_ppl)+"\n\n")
-                    if best_ppl is None or ppl < best_ppl:
-                        impatience = 0
-                        best_ppl = ppl
-                        print("New best ppl {}\n".format(best_ppl))
-                        with open("./output/{}/logs.txt".
-                                  format(args.outf), 'a') as f:
-                            f.write("New best ppl {}\n".format(best_ppl))
-                        save_model()
-                    else:
-                        impatience += 1
-                        # end training
-                        if impatience > args.patience:
-                            print("Ending training")
-                            with open("./output/{}/logs.txt".
-                                      format(args.outf), 'a') as f:
-                                f.write("\nEnding Training\n")
-                            sys.exit()
+                    stop = master and evaluate_lm(
+                        "epoch{}_step{}".format(epoch, niter_global))
+            # and stop early on the evaluations that have come back
+            stop = master and (apply_lm_results() or stop)
+            if broadcast_flag(stop, world_size):
+                sys.exit()
+
+        # timing starts after the first step
+        total_steps += 1
+        if bench_start_time is None:
+            bench_start_time = time.time()
+        if args.max_steps > 0 and total_steps == args.max_steps:
+            if master:
+                report_throughput(total_steps-1, time.time()-bench_start_time)
+            sys.exit()
+
+        # a SIGTERM to any process stops all of them
+        preempted = broadcast_flag(preempted, world_size, reduce_any=True)
+        if preempted or (args.checkpoint_interval > 0 and
+                         niter_global % args.checkpoint_interval == 0):
+            if master:
+                save_checkpoint(epoch, niter, niter_global)
+            if preempted:
+                if master:
+                    print("Received SIGTERM; exiting after checkpoint")
+                    with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+                        f.write("\nReceived SIGTERM; exiting after checkpoint\n")
+                sys.exit()
 
     # end of epoch ----------------------------
     # evaluation
-    test_loss, accuracy = evaluate_autoencoder(test_data, epoch)
-    print('-' * 89)
-    print('| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} | '
-          'test ppl {:5.2f} | acc {:3.3f}'.
-          format(epoch, (time.time() - epoch_start_time),
-                 test_loss, math.exp(test_loss), accuracy))
-    print('-' * 89)
+    if master:
+        test_loss, accuracy = evaluate_autoencoder(test_data, epoch)
+        print('-' * 89)
+        print('| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} | '
+              'test ppl {:5.2f} | acc {:3.3f}'.
+              format(epoch, (time.time() - epoch_start_time),
+                     test_loss, math.exp(test_loss), accuracy))
+        print('-' * 89)
 
-    with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
-        f.write('-' * 89)
-        f.write('\n| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} |'
-                ' test ppl {:5.2f} | acc {:3.3f}\n'.
-                format(epoch, (time.time() - epoch_start_time),
-                       test_loss, math.exp(test_loss), accuracy))
-        f.write('-' * 89)
-        f.write('\n')
-
-    evaluate_generator(fixed_noise, "end_of_epoch_{}".format(epoch))
-    if not args.no_earlystopping and epoch >= args.min_epochs:
-        ppl = train_lm(eval_path=os.path.join(args.data_path, "test.txt"),
-                       save_path="./output/{}/end_of_epoch{}_lm_generations".
-                                 format(args.outf, epoch))
-        print("Perplexity {}".format(ppl))
-        all_ppl.append(ppl)
-        print(all_ppl)
         with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
-            f.write("\n\nPerplexity {}\n".format(ppl))
-            f.write(str(all_ppl)+"\n\n")
-        if best_ppl is None or ppl < best_ppl:
-            impatience = 0
-            best_ppl = ppl
-            print("New best ppl {}\n".format(best_ppl))
-            with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
-                f.write("New best ppl {}\n".format(best_ppl))
-            save_model()
-        else:
-            impatience += 1
-            # end training
-            if impatience > args.patience:
-                print("Ending training")
-                with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
-                    f.write("\nEnding Training\n")
-                sys.exit()
+            f.write('-' * 89)
+            f.write('\n| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} |'
+                    ' test ppl {:5.2f} | acc {:3.3f}\n'.
+                    format(epoch, (time.time() - epoch_start_time),
+                           test_loss, math.exp(test_loss), accuracy))
+            f.write('-' * 89)
+            f.write('\n')
+
+        evaluate_generator(fixed_noise, "end_of_epoch_{}".format(epoch))
+    stop = False
+    if not args.no_earlystopping and epoch >= args.min_epochs:
+        stop = master and evaluate_lm("end_of_epoch{}".format(epoch))
+    stop = master and (apply_lm_results() or stop)
+    if broadcast_flag(stop, world_size):
+        sys.exit()
 
     # shuffle between epochs
     train_data = batchify(corpus.train, args.batch_size, shuffle=True)
+    preempted = broadcast_flag(preempted, world_size, reduce_any=True)
+    if preempted or args.checkpoint_interval > 0:
+        if master:
+            save_checkpoint(epoch+1, 0, 1)
+        if preempted:
+            if master:
+                print("Received SIGTERM; exiting after checkpoint")
+                with open("./output/{}/logs.txt".format(args.outf), 'a') as f:
+                    f.write("\nReceived SIGTERM; exiting after checkpoint\n")
+            sys.exit()
+
+# results of the evaluations still running
+if master:
+    apply_lm_results(wait=True)
@@ -3,6 +3,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+try:
+    from torch.func import functional_call
+except ImportError:  # PyTorch < 2.0
+    from torch.nn.utils.stateless import functional_call
 
 from utils import to_gpu
 import json
@@ -10,6 +14,30 @@ import os
 import numpy as np
 
 
+def masked_loss(decoded, target, temp=1):
+    """
+    Summed cross entropy of decoded (... x ntokens) over the non-padding
+    positions of target, and the number of them the argmax gets right
+    """
+    ntokens = decoded.size(-1)
+    target = target.contiguous().view(-1)
+    mask = target.gt(0)
+    if int(mask.data.sum()) == 0:
+        # e.g. a group whose sentences all ended before this segment
+        return decoded.sum() * 0, decoded.detach().sum() * 0
+    masked_target = target.masked_select(mask)
+    # examples x ntokens
+    output_mask = mask.unsqueeze(1).expand(mask.size(0), ntokens)
+    masked_output = \
+        decoded.contiguous().view(-1, ntokens).masked_select(output_mask)
+    masked_output = masked_output.view(-1, ntokens)
+    loss = F.cross_entropy(masked_output/temp, masked_target) * \
+        masked_target.size(0)
+    max_vals, max_indices = torch.max(masked_output.detach(), 1)
+    correct = max_indices.eq(masked_target).float().sum()
+    return loss, correct
+
+
 class MLP_Latent(nn.Module):
     def __init__(self, ninput, noutput, layers,
                  activation=nn.ReLU(), gpu=False):
@@ -88,7 +116,7 @@ class MLP_Classify(nn.Module):
     def forward(self, x):
         for i, layer in enumerate(self.layers):
             x = layer(x)
-        x = F.sigmoid(x)
+        x = torch.sigmoid(x)
         return x
 
     def init_weights(self):
@@ -101,27 +129,36 @@ class MLP_Classify(nn.Module):
                 pass
 
 
-class Seq2Seq2Decoder(nn.Module):
-    def __init__(self, emsize, nhidden, ntokens, nlayers, arch_latent, noise_radius=0.2,
-                 share_decoder_emb=False, hidden_init=False, dropout=0, gpu=False):
-        super(Seq2Seq2Decoder, self).__init__()
+class Seq2SeqNDecoder(nn.Module):
+    """
+    Shared encoder with one LSTM decoder (and decoder embedding) per
+    attribute. The decoder weights are stacked along a leading dimension of
+    size ndecoders. Teacher-forced decoding runs nn.LSTM on one decoder's
+    slice; free-running generation can step several decoders in one grouped
+    (batched matrix multiply) pass. Decoders are numbered from 1.
+    """
+
+    def __init__(self, emsize, nhidden, ntokens, nlayers, arch_latent, ndecoders=2, noise_radius=0.2,
+                 share_decoder_emb=False, hidden_init=False, dropout=0, checkpoint_segment=0, gpu=False):
+        super(Seq2SeqNDecoder, self).__init__()
         self.nhidden = nhidden
         self.emsize = emsize
         self.ntokens = ntokens
         self.nlayers = nlayers
+        self.ndecoders = ndecoders
         self.noise_radius = noise_radius
+        self.share_decoder_emb = share_decoder_emb
         self.hidden_init = hidden_init
         self.dropout = dropout
+        self.checkpoint_segment = checkpoint_segment
         self.gpu = gpu
 
-        self.start_symbols = to_gpu(gpu, Variable(torch.ones(10, 1).long()))
-
         # Vocabulary embedding
         self.embedding = nn.Embedding(ntokens, emsize)
-        self.embedding_decoder1 = nn.Embedding(ntokens, emsize)
-        self.embedding_decoder2 = nn.Embedding(ntokens, emsize)
+        nembeddings = 1 if share_decoder_emb else ndecoders
+        self.embedding_decoders = nn.Parameter(torch.Tensor(nembeddings, ntokens, emsize))
 
-        # RNN Encoder and Decoder
+        # RNN Encoder and (single layer) Decoders, in nn.LSTM gate order
         self.encoder = nn.LSTM(input_size=emsize,
                                hidden_size=nhidden,
                                num_layers=nlayers,
@@ -130,63 +167,64 @@ class Seq2Seq2Decoder(nn.Module):
         self.latent_encoder = MLP_Latent(ninput=nhidden, noutput=nhidden, layers=arch_latent) # already weight init'ed
 
         decoder_input_size = emsize+nhidden
-        self.decoder1 = nn.LSTM(input_size=decoder_input_size,
-                               hidden_size=nhidden,
-                               num_layers=1,
-                               dropout=dropout,
-                               batch_first=True)
-        self.decoder2 = nn.LSTM(input_size=decoder_input_size,
-                               hidden_size=nhidden,
-                               num_layers=1,
-                               dropout=dropout,
-                               batch_first=True)
+        self.decoder_weight_ih = nn.Parameter(torch.Tensor(ndecoders, 4*nhidden, decoder_input_size))
+        self.decoder_weight_hh = nn.Parameter(torch.Tensor(ndecoders, 4*nhidden, nhidden))
+        self.decoder_bias_ih = nn.Parameter(torch.Tensor(ndecoders, 4*nhidden))
+        self.decoder_bias_hh = nn.Parameter(torch.Tensor(ndecoders, 4*nhidden))
+        # run with one decoder's weights (see run_decoder); holds no memory
+        # (meta device) and is kept out of the parameters and state dict
+        self.__dict__['decoder_template'] = nn.LSTM(
+            input_size=decoder_input_size, hidden_size=nhidden,
+            batch_first=True, device='meta')
 
         # Initialize Linear Transformation
         self.linear = nn.Linear(nhidden, ntokens)
 
         self.init_weights()
 
-        if share_decoder_emb:
-            self.embedding_decoder2.weight = self.embedding_decoder1.weight
-
     def init_weights(self):
         initrange = 0.1
 
         # Initialize Vocabulary Matrix Weight
         self.embedding.weight.data.uniform_(-initrange, initrange)
-        self.embedding_decoder1.weight.data.uniform_(-initrange, initrange)
-        self.embedding_decoder2.weight.data.uniform_(-initrange, initrange)
+        self.embedding_decoders.data.uniform_(-initrange, initrange)
 
         # Initialize Encoder and Decoder Weights
         for p in self.encoder.parameters():
             p.data.uniform_(-initrange, initrange)
-        for p in self.decoder1.parameters():
-            p.data.uniform_(-initrange, initrange)
-        for p in self.decoder2.parameters():
+        for p in [self.decoder_weight_ih, self.decoder_weight_hh,
+                  self.decoder_bias_ih, self.decoder_bias_hh]:
             p.data.uniform_(-initrange, initrange)
 
         # Initialize Linear Weight
         self.linear.weight.data.uniform_(-initrange, initrange)
         self.linear.bias.data.fill_(0)
 
-    def init_hidden(self, bsz):
-        zeros1 = Variable(torch.zeros(self.nlayers, bsz, self.nhidden))
-        zeros2 = Variable(torch.zeros(self.nlayers, bsz, self.nhidden))
-        return (to_gpu(self.gpu, zeros1), to_gpu(self.gpu, zeros2))
-
-    def init_state(self, bsz):
-        zeros = Variable(torch.zeros(self.nlayers, bsz, self.nhidden))
-        return to_gpu(self.gpu, zeros)
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        """Also loads checkpoints with separate decoder1, decoder2, ... modules"""
+        state_dict = stack_decoder_state(state_dict, self.ndecoders)
+        if self.share_decoder_emb:
+            state_dict['embedding_decoders'] = state_dict['embedding_decoders'][:1]
+        return super(Seq2SeqNDecoder, self).load_state_dict(state_dict, *args, **kwargs)
 
     def store_grad_norm(self, grad):
         norm = torch.norm(grad, 2, 1)
         self.grad_norm = norm.detach().data.mean()
         return grad
 
-    def forward(self, whichdecoder, indices, lengths, noise=False, encode_only=False, base_only=False):
+    def forward(self, whichdecoder, indices, lengths, noise=False, encode_only=False, base_only=False,
+                return_codes=False, target=None, temp=1):
+        """
+        With return_codes, returns (decoded, hidden, latent) so callers can
+        reuse the codes of this pass; hidden is the encoder output before
+        noise is added. With target, decoded is replaced by the summed
+        reconstruction loss and number of correct predictions (see
+        decode_loss).
+        """
         batch_size, maxlen = indices.size()
 
-        hidden = self.encode(indices, lengths, noise)
+        base = self.encode(indices, lengths, noise=False)
+        hidden = self.add_noise(base) if noise else base
 
         if hidden.requires_grad:
             hidden.register_hook(self.store_grad_norm)
@@ -196,11 +234,73 @@ class Seq2Seq2Decoder(nn.Module):
         if encode_only:
             return hidden if base_only else latent
 
-        decoded = self.decode(whichdecoder, latent, batch_size, maxlen,
-                              indices=indices, lengths=lengths)
+        if target is not None:
+            decoded = self.decode_loss(whichdecoder, latent, indices, lengths,
+                                       target, temp)
+        else:
+            decoded = self.decode(whichdecoder, latent, batch_size, maxlen,
+                                  indices=indices, lengths=lengths)
 
+        if return_codes:
+            return decoded, base, latent
         return decoded
 
+    def forward_joint(self, indices, lengths, noise=False, targets=None, temp=1):
+        """
+        Encode one batch per decoder in a single encoder pass and decode
+        batch i with decoder i+1. indices and lengths are lists of batches
+        (each sorted by decreasing length, as batchify makes them).
+        Returns the list of decoded outputs and the list of noise-free codes.
+        With targets (one per batch), the decoded outputs are replaced by
+        (summed reconstruction loss, number correct) pairs.
+        """
+        sizes = [x.size(0) for x in indices]
+        maxlen = max(x.size(1) for x in indices)
+        def pad_batches(batches):
+            padded = []
+            for x in batches:
+                if x.size(1) < maxlen:
+                    pad = Variable(x.data.new(x.size(0), maxlen-x.size(1)).zero_())
+                    x = torch.cat([x, pad], 1)
+                padded.append(x)
+            return padded
+        padded = pad_batches(indices)
+
+        # packing needs the joint batch sorted by length
+        all_lengths = [l for batch_lengths in lengths for l in batch_lengths]
+        order = sorted(range(len(all_lengths)), key=lambda j: -all_lengths[j])
+        inverse = [0] * len(order)
+        for pos, j in enumerate(order):
+            inverse[j] = pos
+        order = to_gpu(self.gpu, torch.LongTensor(order))
+        inverse = to_gpu(self.gpu, torch.LongTensor(inverse))
+
+        joint = torch.cat(padded, 0).index_select(0, Variable(order))
+        base = self.encode(joint, sorted(all_lengths, reverse=True), noise=False)
+        base = base.index_select(0, Variable(inverse))
+        hidden = self.add_noise(base) if noise else base
+
+        if hidden.requires_grad:
+            hidden.register_hook(self.store_grad_norm)
+
+        latent = self.latent_encoder(hidden)
+
+        codes = []
+        decoded = []
+        start = 0
+        for i, (x, batch_lengths) in enumerate(zip(indices, lengths)):
+            codes.append(base.narrow(0, start, sizes[i]))
+            code = latent.narrow(0, start, sizes[i])
+            if targets is not None:
+                decoded.append(self.decode_loss(i+1, code, x, batch_lengths,
+                                                targets[i], temp))
+            else:
+                decoded.append(self.decode(i+1, code, sizes[i], x.size(1),
+                                           indices=x, lengths=batch_lengths))
+            start += sizes[i]
+
+        return decoded, codes
+
     def encode(self, indices, lengths, noise):
         embeddings = self.embedding(indices)
         packed_embeddings = pack_padded_sequence(input=embeddings,
@@ -222,38 +322,79 @@ class Seq2Seq2Decoder(nn.Module):
         # For newest version of PyTorch (as of 8/25) use this:
         hidden = torch.div(hidden, norms.unsqueeze(1).expand_as(hidden))
 
-        if noise and self.noise_radius > 0:
-            gauss_noise = torch.normal(means=torch.zeros(hidden.size()),
-                                       std=self.noise_radius)
-            hidden = hidden + to_gpu(self.gpu, Variable(gauss_noise))
+        if noise:
+            hidden = self.add_noise(hidden)
 
         return hidden
 
-    def decode(self, whichdecoder, hidden, batch_size, maxlen, indices=None, lengths=None):
-        # batch x maxlen x hidden
-        all_hidden = hidden.unsqueeze(1).repeat(1, maxlen, 1)
+    def add_noise(self, hidden):
+        if self.noise_radius > 0:
+            gauss_noise = torch.normal(mean=torch.zeros(hidden.size()),
+                                       std=self.noise_radius)
+            hidden = hidden + to_gpu(self.gpu, Variable(gauss_noise))
+        return hidden
 
+    def decoder_params(self, decoders):
+        """Stacked LSTM weights of the given decoders (in that order)"""
+        idx = Variable(to_gpu(self.gpu, torch.LongTensor([d-1 for d in decoders])))
+        return [p.index_select(0, idx) for p in
+                (self.decoder_weight_ih, self.decoder_weight_hh,
+                 self.decoder_bias_ih, self.decoder_bias_hh)]
+
+    def embed_decoders(self, decoders, indices):
+        """Look up ngroups x batch x len indices in the decoders' embeddings"""
+        rows = [0 if self.share_decoder_emb else d-1 for d in decoders]
+        offsets = Variable(to_gpu(self.gpu, torch.LongTensor(rows) * self.ntokens))
+        offsets = offsets.view(-1, 1, 1).expand_as(indices)
+        flat = (indices + offsets).contiguous().view(-1)
+        embeddings = self.embedding_decoders.view(-1, self.emsize).index_select(0, flat)
+        return embeddings.view(indices.size(0), indices.size(1), indices.size(2), self.emsize)
+
+    def init_decoder_state(self, hidden):
+        """Initial (h, c) of the decoders for ... x batch x nhidden codes"""
+        zeros = Variable(hidden.data.new(hidden.size()).zero_())
         if self.hidden_init:
             # initialize decoder hidden state to encoder output
-            state = (hidden.unsqueeze(0), self.init_state(batch_size))
-        else:
-            state = self.init_hidden(batch_size)
-
-        if whichdecoder == 1:
-            embeddings = self.embedding_decoder1(indices)
-        else:
-            embeddings = self.embedding_decoder2(indices)
-
-        augmented_embeddings = torch.cat([embeddings, all_hidden], 2)
+            return hidden, zeros
+        return zeros, zeros
+
+    def run_decoder(self, whichdecoder, inputs, state):
+        """
+        Run decoder whichdecoder: nn.LSTM (decoder_template) with its slice
+        of the stacked weights. inputs is batch x len x (emsize+nhidden) or
+        a PackedSequence, and so is the output. Returns (output, h, c).
+        """
+        d = whichdecoder - 1
+        weights = {'weight_ih_l0': self.decoder_weight_ih[d],
+                   'weight_hh_l0': self.decoder_weight_hh[d],
+                   'bias_ih_l0': self.decoder_bias_ih[d],
+                   'bias_hh_l0': self.decoder_bias_hh[d]}
+        output, (h, c) = functional_call(self.decoder_template, weights,
+                                         (inputs, state))
+        return output, h, c
+
+    def decoder_inputs(self, whichdecoder, hidden, indices):
+        """Decoder embeddings of indices concatenated with the codes"""
+        row = 0 if self.share_decoder_emb else whichdecoder-1
+        embeddings = F.embedding(indices, self.embedding_decoders[row])
+        # batch x len x hidden
+        all_hidden = hidden.unsqueeze(1).repeat(1, indices.size(1), 1)
+        return torch.cat([embeddings, all_hidden], 2)
+
+    def decode_packed(self, whichdecoder, hidden, indices, lengths):
+        """Teacher-forced decoder outputs, as a PackedSequence"""
+        augmented_embeddings = self.decoder_inputs(whichdecoder, hidden, indices)
         packed_embeddings = pack_padded_sequence(input=augmented_embeddings,
                                                  lengths=lengths,
                                                  batch_first=True)
+        state = self.init_decoder_state(hidden.unsqueeze(0))
+        packed_output, h, c = self.run_decoder(whichdecoder, packed_embeddings, state)
+        return packed_output
 
-        if whichdecoder == 1:
-            packed_output, state = self.decoder1(packed_embeddings, state)
-        else:
-            packed_output, state = self.decoder2(packed_embeddings, state)
-        output, lengths = pad_packed_sequence(packed_output, batch_first=True)
+    def decode(self, whichdecoder, hidden, batch_size, maxlen, indices=None, lengths=None):
+        packed_output = self.decode_packed(whichdecoder, hidden, indices, lengths)
+        output, lengths = pad_packed_sequence(packed_output, batch_first=True,
+                                              total_length=maxlen)
 
         # reshape to batch_size*maxlen x nhidden before linear over vocab
         decoded = self.linear(output.contiguous().view(-1, self.nhidden))
@@ -261,59 +402,142 @@ class Seq2Seq2Decoder(nn.Module):
 
         return decoded
 
-    def generate(self, whichdecoder, hidden, maxlen, sample=False, temp=1.0):
-        """Generate through decoder; no backprop"""
-
-        batch_size = hidden.size(0)
-
-        if self.hidden_init:
-            # initialize decoder hidden state to encoder output
-            state = (hidden.unsqueeze(0), self.init_state(batch_size))
-        else:
-            state = self.init_hidden(batch_size)
+    def decode_loss(self, whichdecoder, hidden, indices, lengths, target, temp=1):
+        """
+        Teacher-forced decoding scored against target: returns the summed
+        cross entropy over the non-padding targets and the number of correct
+        argmax predictions. With checkpoint_segment > 0 the decoder, output
+        projection and loss run checkpoint_segment steps at a time under
+        activation checkpointing, so only the LSTM state between segments is
+        kept for the backward pass and never more than one segment's logits.
+        """
+        batch_size, maxlen = indices.size()
+        target = target.contiguous().view(batch_size, maxlen)
+        if self.checkpoint_segment <= 0 or not hidden.requires_grad:
+            # project and score the unpadded positions only
+            packed_output = self.decode_packed(whichdecoder, hidden, indices, lengths)
+            decoded = self.linear(packed_output.data)
+            packed_target = pack_padded_sequence(target, lengths,
+                                                 batch_first=True)
+            return masked_loss(decoded, packed_target.data, temp)
+
+        from torch.utils.checkpoint import checkpoint
+
+        def segment(indices, target, hidden, h, c):
+            augmented_embeddings = self.decoder_inputs(whichdecoder, hidden, indices)
+            # padding is decoded too but masked out of the loss; the state
+            # is only carried on for rows that are still running
+            output, h, c = self.run_decoder(whichdecoder, augmented_embeddings, (h, c))
+            decoded = self.linear(output.contiguous().view(-1, self.nhidden))
+            loss, correct = masked_loss(decoded, target, temp)
+            return loss, correct, h, c
+
+        h, c = self.init_decoder_state(hidden.unsqueeze(0))
+        loss, correct = 0, 0
+        for start in range(0, maxlen, self.checkpoint_segment):
+            end = min(start + self.checkpoint_segment, maxlen)
+            # rows are sorted by decreasing length: drop finished sentences
+            nrows = sum(1 for l in lengths if l > start)
+            seg_loss, seg_correct, h, c = checkpoint(
+                segment, indices[:nrows, start:end], target[:nrows, start:end],
+                hidden[:nrows], h[:, :nrows], c[:, :nrows],
+                use_reentrant=False)
+            loss = loss + seg_loss
+            correct = correct + seg_correct
+        return loss, correct
+
+    def lstm_step(self, gates, state, weight_hh):
+        """One LSTM step; gates holds the input projections plus biases"""
+        h, c = state
+        gates = gates + torch.bmm(h, weight_hh.transpose(1, 2))
+        ingate, forgetgate, cellgate, outgate = gates.chunk(4, 2)
+        c = torch.sigmoid(forgetgate) * c + \
+            torch.sigmoid(ingate) * torch.tanh(cellgate)
+        h = torch.sigmoid(outgate) * torch.tanh(c)
+        return h, c
+
+    @torch.no_grad()
+    def generate_grouped(self, decoders, hidden, maxlen, sample=False, temp=1.0):
+        """
+        Generate with each of decoders in one grouped pass; no backprop.
+        hidden is batch x nhidden (every decoder decodes the same codes) or
+        ngroups x batch x nhidden. Returns ngroups x batch x maxlen indices.
+        """
+        ngroups = len(decoders)
+        if hidden.dim() == 2:
+            hidden = hidden.unsqueeze(0).expand(ngroups, hidden.size(0), hidden.size(1))
+        batch_size = hidden.size(1)
+        weight_ih, weight_hh, bias_ih, bias_hh = self.decoder_params(decoders)
+        weight_emb = weight_ih.narrow(2, 0, self.emsize).transpose(1, 2)
+        weight_code = weight_ih.narrow(2, self.emsize, self.nhidden).transpose(1, 2)
+        code_gates = torch.bmm(hidden, weight_code) + (bias_ih + bias_hh).unsqueeze(1)
+
+        state = self.init_decoder_state(hidden)
 
         # <sos>
-        self.start_symbols.data.resize_(batch_size, 1)
-        self.start_symbols.data.fill_(1)
-        self.start_symbols = to_gpu(self.gpu, self.start_symbols)
-
-        if whichdecoder == 1:
-            embedding = self.embedding_decoder1(self.start_symbols)
-        else:
-            embedding = self.embedding_decoder2(self.start_symbols)
-
-        inputs = torch.cat([embedding, hidden.unsqueeze(1)], 2)
+        indices = Variable(to_gpu(self.gpu, torch.ones(ngroups, batch_size, 1).long()))
 
         # unroll
         all_indices = []
         for i in range(maxlen):
-            if whichdecoder == 1:
-                output, state = self.decoder1(inputs, state)
-            else:
-                output, state = self.decoder2(inputs, state)
-            overvocab = self.linear(output.squeeze(1))
+            embedding = self.embed_decoders(decoders, indices).view(ngroups, batch_size, self.emsize)
+            gates = torch.bmm(embedding, weight_emb) + code_gates
+            state = self.lstm_step(gates, state, weight_hh)
+            overvocab = self.linear(state[0].contiguous().view(-1, self.nhidden))
 
             if not sample:
                 vals, indices = torch.max(overvocab, 1)
-                indices = indices.unsqueeze(1)
             else:
-                assert 1 == 0
                 # sampling
-                probs = F.softmax(overvocab/temp)
+                probs = F.softmax(overvocab/temp, dim=1)
                 indices = torch.multinomial(probs, 1)
+            indices = indices.view(ngroups, batch_size, 1)
 
             all_indices.append(indices)
 
-            if whichdecoder == 1:
-                embedding = self.embedding_decoder1(indices)
-            else:
-                embedding = self.embedding_decoder2(indices)
-            inputs = torch.cat([embedding, hidden.unsqueeze(1)], 2)
-
-        max_indices = torch.cat(all_indices, 1)
+        max_indices = torch.cat(all_indices, 2)
 
         return max_indices
 
+    def generate(self, whichdecoder, hidden, maxlen, sample=False, temp=1.0):
+        """Generate through decoder; no backprop"""
+        return self.generate_grouped([whichdecoder], hidden, maxlen,
+                                     sample=sample, temp=temp)[0]
+
+
+class Seq2Seq2Decoder(Seq2SeqNDecoder):
+    """Seq2SeqNDecoder with two decoders, for two-attribute transfer"""
+
+    def __init__(self, emsize, nhidden, ntokens, nlayers, arch_latent, noise_radius=0.2,
+                 share_decoder_emb=False, hidden_init=False, dropout=0, checkpoint_segment=0,
+                 gpu=False):
+        super(Seq2Seq2Decoder, self).__init__(
+            emsize, nhidden, ntokens, nlayers, arch_latent, ndecoders=2,
+            noise_radius=noise_radius, share_decoder_emb=share_decoder_emb,
+            hidden_init=hidden_init, dropout=dropout,
+            checkpoint_segment=checkpoint_segment, gpu=gpu)
+
+
+def stack_decoder_state(state_dict, ndecoders):
+    """
+    Convert a state dict with one decoder{i}/embedding_decoder{i} module per
+    decoder (as saved before the decoders were stacked) to stacked tensors
+    """
+    if 'decoder1.weight_ih_l0' not in state_dict:
+        return state_dict
+    state_dict = state_dict.copy()
+    for name, key in [('decoder_weight_ih', 'weight_ih_l0'),
+                      ('decoder_weight_hh', 'weight_hh_l0'),
+                      ('decoder_bias_ih', 'bias_ih_l0'),
+                      ('decoder_bias_hh', 'bias_hh_l0')]:
+        state_dict[name] = torch.stack(
+            [state_dict.pop('decoder{}.{}'.format(i, key))
+             for i in range(1, ndecoders+1)])
+    state_dict['embedding_decoders'] = torch.stack(
+        [state_dict.pop('embedding_decoder{}.weight'.format(i))
+         for i in range(1, ndecoders+1)])
+    return state_dict
+
 
 class MLP_D(nn.Module):
     def __init__(self, ninput, noutput, layers,
@@ -417,8 +641,6 @@ class Seq2Seq(nn.Module):
         self.dropout = dropout
         self.gpu = gpu
 
-        self.start_symbols = to_gpu(gpu, Variable(torch.ones(10, 1).long()))
-
         # Vocabulary embedding
         self.embedding = nn.Embedding(ntokens, emsize)
         self.embedding_decoder = nn.Embedding(ntokens, emsize)
@@ -511,7 +733,7 @@ class Seq2Seq(nn.Module):
         # hidden = torch.div(hidden, norms.unsqueeze(1).expand_as(hidden))
 
         if noise and self.noise_radius > 0:
-            gauss_noise = torch.normal(means=torch.zeros(hidden.size()),
+            gauss_noise = torch.normal(mean=torch.zeros(hidden.size()),
                                        std=self.noise_radius)
             hidden = hidden + to_gpu(self.gpu, Variable(gauss_noise))
 
@@ -542,6 +764,7 @@ class Seq2Seq(nn.Module):
 
         return decoded
 
+    @torch.no_grad()
     def generate(self, hidden, maxlen, sample=False, temp=1.0):
         """Generate through decoder; no backprop"""
 
@@ -554,10 +777,9 @@ class Seq2Seq(nn.Module):
             state = self.init_hidden(batch_size)
 
         # <sos>
-        self.start_symbols.data.resize_(batch_size, 1)
-        self.start_symbols.data.fill_(1)
+        start_symbols = to_gpu(self.gpu, torch.ones(batch_size, 1).long())
 
-        embedding = self.embedding_decoder(self.start_symbols)
+        embedding = self.embedding_decoder(start_symbols)
         inputs = torch.cat([embedding, hidden.unsqueeze(1)], 2)
 
         # unroll
@@ -568,9 +790,10 @@ class Seq2Seq(nn.Module):
 
             if not sample:
                 vals, indices = torch.max(overvocab, 1)
+                indices = indices.unsqueeze(1)
             else:
                 # sampling
-                probs = F.softmax(overvocab/temp)
+                probs = F.softmax(overvocab/temp, dim=1)
                 indices = torch.multinomial(probs, 1)
 
             all_indices.append(indices)
@@ -598,14 +821,18 @@ def load_models(load_path, epoch, twodecoders=False):
                               dropout=model_args['dropout'],
                               gpu=model_args['cuda'])
     else:
-        autoencoder = Seq2Seq2Decoder(arch_latent=model_args['arch_latent'],
+        # two-decoder checkpoints are converted by load_state_dict
+        autoencoder = Seq2SeqNDecoder(arch_latent=model_args['arch_latent'],
                               emsize=model_args['emsize'],
                               nhidden=model_args['nhidden'],
                               ntokens=model_args['ntokens'],
                               nlayers=model_args['nlayers'],
+                              ndecoders=model_args.get('ndecoders', 2),
                               noise_radius=model_args['noise_radius'],
+                              share_decoder_emb=model_args.get('share_decoder_emb', False),
                               hidden_init=model_args['hidden_init'],
-                              dropout=model_args['dropout'])
+                              dropout=model_args['dropout'],
+                              checkpoint_segment=model_args.get('checkpoint_segment', 0))
 
     gan_gen = MLP_G(ninput=model_args['z_size'],
                     noutput=model_args['nhidden'],
@@ -629,12 +856,10 @@ def generate(autoencoder, gan_gen, z, vocab, sample, maxlen):
     """
     Assume noise is batch_size x z_size
     """
-    if type(z) == Variable:
+    if torch.is_tensor(z):
         noise = z
-    elif type(z) == torch.FloatTensor or type(z) == torch.cuda.FloatTensor:
-        noise = Variable(z, volatile=True)
     elif type(z) == np.ndarray:
-        noise = Variable(torch.from_numpy(z).float(), volatile=True)
+        noise = torch.from_numpy(z).float()
     else:
         raise ValueError("Unsupported input type (noise): {}".format(type(z)))
 
@@ -642,10 +867,11 @@ def generate(autoencoder, gan_gen, z, vocab, sample, maxlen):
     autoencoder.eval()
 
     # generate from random noise
-    fake_hidden = gan_gen(noise)
-    max_indices = autoencoder.generate(hidden=fake_hidden,
-                                       maxlen=maxlen,
-                                       sample=sample)
+    with torch.no_grad():
+        fake_hidden = gan_gen(noise)
+        max_indices = autoencoder.generate(hidden=fake_hidden,
+                                           maxlen=maxlen,
+                                           sample=sample)
 
     max_indices = max_indices.data.cpu().numpy()
     sentences = []
@@ -6,6 +6,7 @@ import numpy as np
 import random
 import sys
 import json
+import signal
 
 import torch
 import torch.nn as nn
@@ -13,7 +14,10 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
 
-from utils import to_gpu, Corpus, batchify, train_ngram_lm, get_ppl
+from utils import to_gpu, Corpus, batchify, train_ngram_lm, get_ppl, \
+    cached_ngram_lm, get_rng_state, set_rng_state, ArtifactWriter, \
+    write_sentences, EOS_WORD, init_distributed, shard_batch, \
+    average_gradients, broadcast_params, broadcast_flag
 from models import Seq2Seq2Decoder, Seq2Seq, MLP_D, MLP_G, MLP_Classify, load_models
 import shutil
 
@@ -55,6 +59,8 @@ parser.add_argument('--noise_anneal', type=float, default=0.997,
                          'every 100 iterations')
 parser.add_argument('--hidden_init', action='store_true',
                     help="initialize decoder hidden state with encoder's")
+parser.add_argument('--share_decoder_emb', action='store_true',
+                    help='share one input embedding between the decoders')
 parser.add_argument('--arch_g', type=str, default='200-400-800',
                     help='generator architecture (MLP)')
 parser.add_argument('--arch_d', type=str, default='300-200-100',
@@ -111,12 +117,37 @@ parser.add_argument('--gan_clamp', type=float, default=0.01,
                     help='WGAN clamp')
 parser.add_argument('--lambda_class', type=float, default=1,
                     help='lambda on classifier')
+parser.add_argument('--reuse_ae_codes', action='store_true',
+                    help='train the classifier on the codes the autoencoder '
+                         'step computed, before its update, instead of '
+                         're-encoding the batches with the updated encoder')
+parser.add_argument('--sequential_ae', action='store_true',
+                    help='train the autoencoder on each domain batch with a '
+                         'separate encoder pass and update (default: one '
+                         'joint pass and update on the summed loss)')
+parser.add_argument('--checkpoint_segment', type=int, default=0,
+                    help='decode this many time steps at a time under '
+                         'activation checkpointing in the autoencoder step, '
+                         'recomputing them in the backward pass to save '
+                         'memory on long sentences (0 = off)')
 
 # Evaluation Arguments
 parser.add_argument('--sample', action='store_true',
                     help='sample when decoding for generation')
 parser.add_argument('--N', type=int, default=5,
                     help='N-gram order for training n-gram language model')
+parser.add_argument('--lm_cache', type=str, default='./lm_cache',
+                    help='directory of n-gram LMs trained on fixed data, '
+                         'by a hash of their training text, N and vocab')
+parser.add_argument('--lm_workers', type=int, default=1,
+                    help='processes scoring test sentences with the '
+                         'reverse language model')
+parser.add_argument('--eval_batch_size', type=int, default=100,
+                    help='batch size for evaluation')
+parser.add_argument('--eval_dump_size', type=int, default=1000,
+                    help='number of validation sentences per domain whose '
+                         'reconstructions and transfers are written at each '
+                         'evaluation (-1 = all)')
 parser.add_argument('--log_interval', type=int, default=200,
                     help='interval to log autoencoder training results')
 
@@ -128,27 +159,47 @@ parser.add_argument('--cuda', action='store_true',
 parser.add_argument('--debug', action='store_true',
                     help='debug')
 parser.add_argument('--device_id', type=str, default='0')
+parser.add_argument('--resume', action='store_true',
+                    help='resume from the training checkpoint in outf')
+parser.add_argument('--checkpoint_interval', type=int, default=1000,
+                    help='save a resumable training checkpoint every this '
+                         'many steps (0 = only on SIGTERM)')
+parser.add_argument('--max_steps', type=int, default=0,
+                    help='stop after this many training steps and report '
+                         'throughput (for benchmarking; 0 = no limit)')
 
 args = parser.parse_args()
-print(vars(args))
+
+# data parallel training when launched with torchrun: every process trains
+# on its share of each batch and gradients are averaged before each update
+rank, world_size = init_distributed()
+master = rank == 0
+assert args.batch_size % world_size == 0, \
+    "batch_size must be divisible by the number of processes"
+local_batch_size = args.batch_size // world_size
+if master:
+    print(vars(args))
 
 os.environ['CUDA_VISIBLE_DEVICES'] = args.device_id
 
 # make output directory if it doesn't already exist
-if os.path.isdir(args.outf):
-    shutil.rmtree(args.outf)
-os.makedirs(args.outf)
+if master and not args.resume:
+    if os.path.isdir(args.outf):
+        shutil.rmtree(args.outf)
+    os.makedirs(args.outf)
 
 # Set the random seed manually for reproducibility.
+# python's random (batch order, critic batches) must agree across processes;
+# torch's (generator noise) differs so each process draws its own samples
 random.seed(args.seed)
 np.random.seed(args.seed)
-torch.manual_seed(args.seed)
+torch.manual_seed(args.seed + rank)
 if torch.cuda.is_available():
     if not args.cuda:
         print("WARNING: You have a CUDA device, "
               "so you should probably run with --cuda")
     else:
-        torch.cuda.manual_seed(args.seed)
+        torch.cuda.manual_seed(args.seed + rank)
 
 ###############################################################################
 # Load data
@@ -175,31 +226,34 @@ corpus = Corpus(datafiles,
                 vocab=vocabdict,
                 debug=args.debug)
 
-# dumping vocabulary
-with open('{}/vocab.json'.format(args.outf), 'w') as f:
-    json.dump(corpus.dictionary.word2idx, f)
-
-# save arguments
 ntokens = len(corpus.dictionary.word2idx)
-print("Vocabulary Size: {}".format(ntokens))
 args.ntokens = ntokens
-with open('{}/args.json'.format(args.outf), 'w') as f:
-    json.dump(vars(args), f)
-with open("{}/logs.txt".format(args.outf), 'w') as f:
-    f.write(str(vars(args)))
-    f.write("\n\n")
-
-eval_batch_size = 100
+if master:
+    # dumping vocabulary
+    with open('{}/vocab.json'.format(args.outf), 'w') as f:
+        json.dump(corpus.dictionary.word2idx, f)
+
+    # save arguments
+    print("Vocabulary Size: {}".format(ntokens))
+    with open('{}/args.json'.format(args.outf), 'w') as f:
+        json.dump(vars(args), f)
+    with open("{}/logs.txt".format(args.outf), 'a' if args.resume else 'w') as f:
+        f.write(str(vars(args)))
+        f.write("\n\n")
+
+eval_batch_size = args.eval_batch_size
 test1_data = batchify(corpus.data['valid1'], eval_batch_size, shuffle=False)
 test2_data = batchify(corpus.data['valid2'], eval_batch_size, shuffle=False)
-if args.debug:
-    train1_data = batchify(corpus.data['valid1'], args.batch_size, shuffle=True)
-    train2_data = batchify(corpus.data['valid2'], args.batch_size, shuffle=True)
-else:
-    train1_data = batchify(corpus.data['train1'], args.batch_size, shuffle=True)
-    train2_data = batchify(corpus.data['train2'], args.batch_size, shuffle=True)
+train_names = ('valid1', 'valid2') if args.debug else ('train1', 'train2')
+# corpus order of the training sentences, to record the batch order
+train_unshuffled = [list(corpus.data[name]) for name in train_names]
+train_ids = [{id(x): i for i, x in enumerate(data)}
+             for data in train_unshuffled]
+train1_data = batchify(corpus.data[train_names[0]], args.batch_size, shuffle=True)
+train2_data = batchify(corpus.data[train_names[1]], args.batch_size, shuffle=True)
 
-print("Loaded data!")
+if master:
+    print("Loaded data!")
 
 ###############################################################################
 # Build the models
@@ -219,6 +273,7 @@ else:
                           ntokens=ntokens,
                           nlayers=args.nlayers,
                           noise_radius=args.noise_radius,
+                          share_decoder_emb=args.share_decoder_emb,
                           hidden_init=args.hidden_init,
                           dropout=args.dropout,
                           gpu=args.cuda)
@@ -226,13 +281,15 @@ else:
     gan_gen = MLP_G(ninput=args.z_size, noutput=args.nhidden, layers=args.arch_g)
     gan_disc = MLP_D(ninput=args.nhidden, noutput=1, layers=args.arch_d)
 
+autoencoder.checkpoint_segment = args.checkpoint_segment
 classifier = MLP_Classify(ninput=args.nhidden, noutput=1, layers=args.arch_classify)
 g_factor = None
 
-print(autoencoder)
-print(gan_gen)
-print(gan_disc)
-print(classifier)
+if master:
+    print(autoencoder)
+    print(gan_gen)
+    print(gan_disc)
+    print(classifier)
 
 optimizer_ae = optim.SGD(autoencoder.parameters(), lr=args.lr_ae)
 optimizer_gan_g = optim.Adam(gan_gen.parameters(),
@@ -245,14 +302,20 @@ optimizer_gan_d = optim.Adam(gan_disc.parameters(),
 optimizer_classify = optim.SGD(classifier.parameters(),
                                lr=args.lr_classify)
 
-criterion_ce = nn.CrossEntropyLoss()
-
 if args.cuda:
     autoencoder = autoencoder.cuda()
     gan_gen = gan_gen.cuda()
     gan_disc = gan_disc.cuda()
     classifier = classifier.cuda()
-    criterion_ce = criterion_ce.cuda()
+
+# processes start from the same weights
+broadcast_params(autoencoder, world_size)
+broadcast_params(gan_gen, world_size)
+broadcast_params(gan_disc, world_size)
+broadcast_params(classifier, world_size)
+
+# checkpoints and sample files are written in the background
+writer = ArtifactWriter()
 
 ###############################################################################
 # Training code
@@ -261,14 +324,53 @@ if args.cuda:
 
 def save_model(epoch):
     print("Saving models")
-    with open('{}/autoencoder_model_{}.pt'.format(args.outf, epoch), 'wb') as f:
-        torch.save(autoencoder.state_dict(), f)
-    with open('{}/gan_gen_model_{}.pt'.format(args.outf, epoch), 'wb') as f:
-        torch.save(gan_gen.state_dict(), f)
-    with open('{}/gan_disc_model_{}.pt'.format(args.outf, epoch), 'wb') as f:
-        torch.save(gan_disc.state_dict(), f)
-    with open('{}/classifier_model_{}.pt'.format(args.outf, epoch), 'wb') as f:
-        torch.save(classifier.state_dict(), f)
+    writer.save(autoencoder.state_dict(),
+                '{}/autoencoder_model_{}.pt'.format(args.outf, epoch))
+    writer.save(gan_gen.state_dict(),
+                '{}/gan_gen_model_{}.pt'.format(args.outf, epoch))
+    writer.save(gan_disc.state_dict(),
+                '{}/gan_disc_model_{}.pt'.format(args.outf, epoch))
+    writer.save(classifier.state_dict(),
+                '{}/classifier_model_{}.pt'.format(args.outf, epoch))
+
+
+def save_checkpoint(epoch, niter, niter_global):
+    """
+    Save everything needed to resume training after step niter of epoch:
+    weights, optimizer moments, random state, GAN schedule, noise radius
+    and the order of this epoch's training batches.
+    """
+    print("Saving training checkpoint")
+    checkpoint = {
+        'autoencoder': autoencoder.state_dict(),
+        'gan_gen': gan_gen.state_dict(),
+        'gan_disc': gan_disc.state_dict(),
+        'classifier': classifier.state_dict(),
+        'optimizer_ae': optimizer_ae.state_dict(),
+        'optimizer_gan_g': optimizer_gan_g.state_dict(),
+        'optimizer_gan_d': optimizer_gan_d.state_dict(),
+        'optimizer_classify': optimizer_classify.state_dict(),
+        'rng': get_rng_state(args.cuda),
+        'epoch': epoch,
+        'niter': niter,
+        'niter_global': niter_global,
+        'niter_gan': niter_gan,
+        'noise_radius': autoencoder.noise_radius,
+        'best_ppl': best_ppl,
+        'impatience': impatience,
+        'all_ppl': all_ppl,
+        'fixed_noise': fixed_noise.data.cpu(),
+        'train_order': [np.array([ids[id(x)] for x in corpus.data[name]],
+                                 dtype=np.int64)
+                        for ids, name in zip(train_ids, train_names)],
+    }
+    writer.save(checkpoint, '{}/checkpoint.pt'.format(args.outf))
+
+
+def handle_sigterm(signum, frame):
+    # checkpoint at the next step boundary rather than mid-update
+    global preempted
+    preempted = True
 
 
 def evaluate_generator(noise, epoch):
@@ -276,104 +378,70 @@ def evaluate_generator(noise, epoch):
     autoencoder.eval()
 
     # generate from fixed random noise
-    fake_hidden = gan_gen(noise)
+    with torch.no_grad():
+        fake_hidden = gan_gen(noise)
 
-    for whichdecoder in (1, 2):
-        max_indices = autoencoder.generate(
-            whichdecoder, hidden=fake_hidden, maxlen=args.maxlen, sample=args.sample)
-
-        with open("./{}/{}_{}_generated.txt".format(args.outf, epoch, whichdecoder), "w") as f:
-            max_indices = max_indices.data.cpu().numpy()
-            for idx in max_indices:
-                # generated sentence
-                words = [corpus.dictionary.idx2word[x] for x in idx]
-                # truncate sentences to first occurrence of <eos>
-                truncated_sent = []
-                for w in words:
-                    if w != '<eos>':
-                        truncated_sent.append(w)
-                    else:
-                        break
-                chars = " ".join(truncated_sent)
-                f.write(chars)
-                f.write("\n")
+        # both decoders in one grouped pass
+        all_indices = autoencoder.generate_grouped(
+            [1, 2], hidden=fake_hidden, maxlen=args.maxlen, sample=args.sample)
+
+    for whichdecoder, max_indices in zip((1, 2), all_indices):
+        # sentences are truncated to the first occurrence of <eos>
+        writer.put(write_sentences,
+                   "./{}/{}_{}_generated.txt".format(args.outf, epoch, whichdecoder),
+                   [[max_indices.data.cpu().numpy()]],
+                   corpus.dictionary.idx2word, EOS_WORD)
 
 
 def evaluate_autoencoder(whichdecoder, data_source, epoch):
+    """
+    Token-level reconstruction loss and accuracy of decoder whichdecoder on
+    data_source; the first --eval_dump_size sentences and their transfers
+    (the other decoder, from the same code) are written out
+    """
     # Turn on evaluation mode which disables dropout.
     autoencoder.eval()
     total_loss = 0
-    ntokens = len(corpus.dictionary.word2idx)
-    all_accuracies = 0
-    bcnt = 0
+    total_correct = 0
+    total_targets = 0
+    targets, transfers = [], []
+    ndumped = 0
     for i, batch in enumerate(data_source):
         source, target, lengths = batch
-        source = to_gpu(args.cuda, Variable(source, volatile=True))
-        target = to_gpu(args.cuda, Variable(target, volatile=True))
-
-        mask = target.gt(0)
-        masked_target = target.masked_select(mask)
-        # examples x ntokens
-        output_mask = mask.unsqueeze(1).expand(mask.size(0), ntokens)
-
-        hidden = autoencoder(0, source, lengths, noise=False, encode_only=True)
-
-        # output: batch x seq_len x ntokens
-        if whichdecoder == 1:
-            output = autoencoder(1, source, lengths, noise=False)
-            flattened_output = output.view(-1, ntokens)
-            masked_output = \
-                flattened_output.masked_select(output_mask).view(-1, ntokens)
-            # accuracy
-            max_vals1, max_indices1 = torch.max(masked_output, 1)
-            all_accuracies += \
-                torch.mean(max_indices1.eq(masked_target).float()).data[0]
-
-            max_values1, max_indices1 = torch.max(output, 2)
-            max_indices2 = autoencoder.generate(2, hidden, maxlen=50)
-        else:
-            output = autoencoder(2, source, lengths, noise=False)
-            flattened_output = output.view(-1, ntokens)
-            masked_output = \
-                flattened_output.masked_select(output_mask).view(-1, ntokens)
-            # accuracy
-            max_vals2, max_indices2 = torch.max(masked_output, 1)
-            all_accuracies += \
-                torch.mean(max_indices2.eq(masked_target).float()).data[0]
-
-            max_values2, max_indices2 = torch.max(output, 2)
-            max_indices1 = autoencoder.generate(1, hidden, maxlen=50)
-
-        total_loss += criterion_ce(masked_output/args.temp, masked_target).data
-        bcnt += 1
-
-        aeoutf_from = "{}/{}_output_decoder_{}_from.txt".format(args.outf, epoch, whichdecoder)
-        aeoutf_tran = "{}/{}_output_decoder_{}_tran.txt".format(args.outf, epoch, whichdecoder)
-        with open(aeoutf_from, 'w') as f_from, open(aeoutf_tran,'w') as f_trans:
-            max_indices1 = \
-                max_indices1.view(output.size(0), -1).data.cpu().numpy()
-            max_indices2 = \
-                max_indices2.view(output.size(0), -1).data.cpu().numpy()
-            target = target.view(output.size(0), -1).data.cpu().numpy()
-            for t, idx1, idx2 in zip(target, max_indices1, max_indices2):
-                # real sentence
-                chars = " ".join([corpus.dictionary.idx2word[x] for x in t])
-                f_from.write(chars)
-                f_from.write("\n\n")
-                # transfer sentence
-                idx = idx2 if whichdecoder == 1 else idx1
-                chars = " ".join([corpus.dictionary.idx2word[x] for x in idx])
-                f_trans.write(chars)
-                f_trans.write("\n\n")
-
-    return total_loss[0] / len(data_source), all_accuracies/bcnt
-
-
-def train_lm(save_path):
+        source = to_gpu(args.cuda, source)
+        target = to_gpu(args.cuda, target)
+
+        with torch.no_grad():
+            # loss and accuracy over the non-padding positions only
+            (loss, correct), _, latent = autoencoder(
+                whichdecoder, source, lengths, noise=False, return_codes=True,
+                target=target, temp=args.temp)
+            total_loss += loss.item()
+            total_correct += correct.item()
+            total_targets += int(target.gt(0).sum())
+
+            if args.eval_dump_size < 0 or ndumped < args.eval_dump_size:
+                # transfer sentence: the other decoder, from the same code
+                transfer = autoencoder.generate(3-whichdecoder, latent, maxlen=50)
+                transfers.append(
+                    transfer.view(source.size(0), -1).cpu().numpy())
+                targets.append(target.view(source.size(0), -1).cpu().numpy())
+                ndumped += source.size(0)
+
+    aeoutf_from = "{}/{}_output_decoder_{}_from.txt".format(args.outf, epoch, whichdecoder)
+    aeoutf_tran = "{}/{}_output_decoder_{}_tran.txt".format(args.outf, epoch, whichdecoder)
+    writer.put(write_sentences, aeoutf_from, [targets],
+               corpus.dictionary.idx2word, None, "\n")
+    writer.put(write_sentences, aeoutf_tran, [transfers],
+               corpus.dictionary.idx2word, None, "\n")
+
+    return total_loss / total_targets, total_correct / total_targets
+
+
+def train_lm():
     '''
-    train LM
-    save_path: file name (no extension) for saving
-        generated sentences and ngrams
+    train LM on the validation targets of both domains; returns the path
+    (no extension) of the cached model, whose training text is path.txt
     '''
 
     # get positive and negative examples (targets)
@@ -388,29 +456,25 @@ def train_lm(save_path):
     # indices = np.vstack(indices)
     # np.random.shuffle(indices)
 
-    # write sampled sentences to text file
-    with open(save_path+".txt", "w") as f:
-        # laplacian smoothing
-        for word in corpus.dictionary.word2idx.keys():
-            f.write(word+"\n")
-        for idx in indices:
-            # sample sentence
-            words = [corpus.dictionary.idx2word[x] for x in idx]
-            # truncate sentences to first occurrence of <eos>
-            truncated_sent = []
-            for w in words:
-                if w != '<eos>':
-                    truncated_sent.append(w)
-                else:
-                    break
-            chars = " ".join(truncated_sent)
-            f.write(chars+"\n")
-
-    # train language model on examples
-    train_ngram_lm(kenlm_path=args.kenlm_path,
-                   data_path=save_path+".txt",
-                   output_path=save_path,
-                   N=args.N)
+    sentences = []
+    for idx in indices:
+        # sample sentence
+        words = [corpus.dictionary.idx2word[x] for x in idx]
+        # truncate sentences to first occurrence of <eos>
+        truncated_sent = []
+        for w in words:
+            if w != '<eos>':
+                truncated_sent.append(w)
+            else:
+                break
+        sentences.append(" ".join(truncated_sent))
+
+    # train language model on examples, unless it is cached
+    return cached_ngram_lm(kenlm_path=args.kenlm_path,
+                           sentences=sentences,
+                           vocab=corpus.dictionary.word2idx.keys(),
+                           N=args.N,
+                           cache_dir=args.lm_cache)
 
 
 def train_reverse_lm(eval_path, save_path):
@@ -463,30 +527,54 @@ def train_reverse_lm(eval_path, save_path):
     with open(eval_path, 'r') as f:
         lines = f.readlines()
     sentences = [l.replace('\n', '') for l in lines]
-    ppl = get_ppl(lm, sentences)
+    if args.lm_workers > 1:
+        # workers load the binary model
+        ppl = get_ppl(save_path+".binary", sentences, args.lm_workers)
+    else:
+        ppl = get_ppl(lm, sentences)
 
     return ppl
 
 
-def train_classifier(whichclass, batch):
-    ''' [2b] train attribute classifier '''
+def report_throughput(nsteps, elapsed):
+    """Log training speed over all processes to throughput.json"""
+    # each step trains on a batch of each domain
+    result = {'nprocs': world_size,
+              'batch_size': args.batch_size,
+              'steps': nsteps,
+              'seconds': elapsed,
+              'steps_per_sec': nsteps / elapsed,
+              'sents_per_sec': nsteps * args.niters_ae * 2 * args.batch_size / elapsed}
+    print("| throughput {:d} processes | {:.2f} steps/s | {:.1f} sents/s".
+          format(world_size, result['steps_per_sec'], result['sents_per_sec']))
+    with open("{}/throughput.json".format(args.outf), 'w') as f:
+        json.dump(result, f)
+
+
+def train_classifier(whichclass, batch, code=None):
+    ''' [2b] train attribute classifier on the (detached) encoder output of
+    batch; with code, on that code of the batch (from train_ae, before the
+    autoencoder update) instead of encoding it again '''
     classifier.train()
     classifier.zero_grad()
 
-    source, target, lengths = batch
-    source = to_gpu(args.cuda, Variable(source))
-    labels = to_gpu(args.cuda, Variable(torch.zeros(source.size(0)).fill_(whichclass-1)))
+    if code is None:
+        source, target, lengths = shard_batch(batch, rank, world_size)
+        source = to_gpu(args.cuda, Variable(source))
+        code = autoencoder(0, source, lengths, noise=False, encode_only=True,
+                           base_only=True).detach()
+    labels = to_gpu(args.cuda, Variable(torch.zeros(code.size(0)).fill_(whichclass-1)))
 
     # Train
-    code = autoencoder(0, source, lengths, noise=False, encode_only=True, base_only=True).detach()
     scores = classifier(code)
     classify_loss = F.binary_cross_entropy(scores.squeeze(1), labels)
     classify_loss.backward()
+    average_gradients(classifier, world_size)
     optimizer_classify.step()
-    classify_loss = classify_loss.cpu().data[0]
+    classify_loss = classify_loss.item()
 
     pred = scores.data.round().squeeze(1)
-    accuracy = pred.eq(labels.data).float().mean()
+    accuracy = pred.eq(labels.data).float().mean().item()
 
     return classify_loss, accuracy
 
@@ -502,7 +590,7 @@ def classifier_regularize(whichclass, batch):
     autoencoder.train()
     autoencoder.zero_grad()
 
-    source, target, lengths = batch
+    source, target, lengths = shard_batch(batch, rank, world_size)
     source = to_gpu(args.cuda, Variable(source))
     target = to_gpu(args.cuda, Variable(target))
     flippedclass = abs(2-whichclass)
@@ -515,53 +603,22 @@ def classifier_regularize(whichclass, batch):
     scores = classifier(code)
     classify_reg_loss = F.binary_cross_entropy(scores.squeeze(1), labels)
     classify_reg_loss.backward()
+    average_gradients(autoencoder, world_size)
 
-    torch.nn.utils.clip_grad_norm(autoencoder.parameters(), args.clip)
+    torch.nn.utils.clip_grad_norm_(autoencoder.parameters(), args.clip)
     optimizer_ae.step()
 
     return classify_reg_loss
 
 
-def train_ae(whichdecoder, batch, total_loss_ae, start_time, i):
-    ''' [1] train encoder/decoder for reconstruction '''
-    autoencoder.train()
-    autoencoder.zero_grad()
-
-    source, target, lengths = batch
-    source = to_gpu(args.cuda, Variable(source))
-    target = to_gpu(args.cuda, Variable(target))
-
-    # Create sentence length mask over padding
-    mask = target.gt(0)
-    masked_target = target.masked_select(mask)
-    # examples x ntokens
-    output_mask = mask.unsqueeze(1).expand(mask.size(0), ntokens)
-
-    # output: batch x seq_len x ntokens
-    output = autoencoder(whichdecoder, source, lengths, noise=True)
-
-    # output_size: batch_size, maxlen, self.ntokens
-    flattened_output = output.view(-1, ntokens)
-
-    masked_output = \
-        flattened_output.masked_select(output_mask).view(-1, ntokens)
-    loss = criterion_ce(masked_output/args.temp, masked_target)
-    loss.backward()
-
-    # `clip_grad_norm` to prevent exploding gradient in RNNs / LSTMs
-    torch.nn.utils.clip_grad_norm(autoencoder.parameters(), args.clip)
-    optimizer_ae.step()
-
-    total_loss_ae += loss.data
-
+def log_ae(total_loss_ae, correct, ntargets, start_time, i):
+    """Report the running autoencoder loss every log_interval batches"""
     accuracy = None
-    if i % args.log_interval == 0 and i > 0:
+    if i % args.log_interval == 0 and i > 0 and master:
         # accuracy
-        probs = F.softmax(masked_output, dim=-1)
-        max_vals, max_indices = torch.max(probs, 1)
-        accuracy = torch.mean(max_indices.eq(masked_target).float()).data[0]
+        accuracy = correct.item() / ntargets
 
-        cur_loss = total_loss_ae[0] / args.log_interval
+        cur_loss = float(total_loss_ae) / args.log_interval
         elapsed = time.time() - start_time
         print('| epoch {:3d} | {:5d}/{:5d} batches | ms/batch {:5.2f} | '
               'loss {:5.2f} | ppl {:8.2f} | acc {:8.2f}'
@@ -582,13 +639,84 @@ def train_ae(whichdecoder, batch, total_loss_ae, start_time, i):
     return total_loss_ae, start_time
 
 
+def train_ae(whichdecoder, batch, total_loss_ae, start_time, i):
+    ''' [1] train encoder/decoder for reconstruction '''
+    autoencoder.train()
+    autoencoder.zero_grad()
+
+    source, target, lengths = shard_batch(batch, rank, world_size)
+    source = to_gpu(args.cuda, Variable(source))
+    target = to_gpu(args.cuda, Variable(target))
+
+    # mean cross entropy over the target tokens; the decoder runs in
+    # checkpointed segments with --checkpoint_segment
+    (loss, correct), code, _ = autoencoder(whichdecoder, source, lengths,
+                                           noise=True, return_codes=True,
+                                           target=target, temp=args.temp)
+    ntargets = int(target.data.gt(0).sum())
+    loss = loss / ntargets
+    loss.backward()
+    average_gradients(autoencoder, world_size)
+
+    # `clip_grad_norm` to prevent exploding gradient in RNNs / LSTMs
+    torch.nn.utils.clip_grad_norm_(autoencoder.parameters(), args.clip)
+    optimizer_ae.step()
+
+    total_loss_ae += loss.detach()
+    total_loss_ae, start_time = \
+        log_ae(total_loss_ae, correct, ntargets, start_time, i)
+
+    # noise-free code of the batch, for the classifier
+    return total_loss_ae, start_time, code.detach()
+
+
+def train_ae_joint(batch1, batch2, total_loss_ae1, total_loss_ae2, start_time, i):
+    ''' [1] train encoder/decoders for reconstruction on a batch of each
+    domain: one encoder pass over both, one update on the summed loss '''
+    autoencoder.train()
+    autoencoder.zero_grad()
+
+    source1, target1, lengths1 = shard_batch(batch1, rank, world_size)
+    source2, target2, lengths2 = shard_batch(batch2, rank, world_size)
+    source1 = to_gpu(args.cuda, Variable(source1))
+    target1 = to_gpu(args.cuda, Variable(target1))
+    source2 = to_gpu(args.cuda, Variable(source2))
+    target2 = to_gpu(args.cuda, Variable(target2))
+
+    ((loss1, correct1), (loss2, correct2)), (code1, code2) = \
+        autoencoder.forward_joint([source1, source2], [lengths1, lengths2],
+                                  noise=True, targets=[target1, target2],
+                                  temp=args.temp)
+    ntargets1 = int(target1.data.gt(0).sum())
+    ntargets2 = int(target2.data.gt(0).sum())
+    loss1 = loss1 / ntargets1
+    loss2 = loss2 / ntargets2
+    (loss1 + loss2).backward()
+    average_gradients(autoencoder, world_size)
+
+    # `clip_grad_norm` to prevent exploding gradient in RNNs / LSTMs
+    torch.nn.utils.clip_grad_norm_(autoencoder.parameters(), args.clip)
+    optimizer_ae.step()
+
+    total_loss_ae1 += loss1.detach()
+    total_loss_ae2 += loss2.detach()
+    total_loss_ae1, next_start_time = \
+        log_ae(total_loss_ae1, correct1, ntargets1, start_time, i)
+    total_loss_ae2, _ = \
+        log_ae(total_loss_ae2, correct2, ntargets2, start_time, i)
+
+    # noise-free codes of the batches, for the classifier
+    return total_loss_ae1, total_loss_ae2, next_start_time, \
+        code1.detach(), code2.detach()
+
+
 def train_gan_g():
     ''' [3] adversarially train generator to discriminator '''
     gan_gen.train()
     gan_gen.zero_grad()
 
     noise = to_gpu(args.cuda,
-                   Variable(torch.ones(args.batch_size, args.z_size)))
+                   Variable(torch.ones(local_batch_size, args.z_size)))
     noise.data.normal_(0, 1)
 
     fake_hidden = gan_gen(noise)
@@ -596,6 +724,7 @@ def train_gan_g():
 
     # loss / backprop
     errG.backward(one)
+    average_gradients(gan_gen, world_size)
     optimizer_gan_g.step()
 
     return errG
@@ -612,7 +741,7 @@ def train_gan_d(whichdecoder, batch):
 
     # positive samples ----------------------------
     # generate real codes
-    source, target, lengths = batch
+    source, target, lengths = shard_batch(batch, rank, world_size)
     source = to_gpu(args.cuda, Variable(source))
     target = to_gpu(args.cuda, Variable(target))
 
@@ -626,13 +755,14 @@ def train_gan_d(whichdecoder, batch):
     # negative samples ----------------------------
     # generate fake codes
     noise = to_gpu(args.cuda,
-                   Variable(torch.ones(args.batch_size, args.z_size)))
+                   Variable(torch.ones(local_batch_size, args.z_size)))
     noise.data.normal_(0, 1)
 
     # loss / backprop
     fake_hidden = gan_gen(noise)
     errD_fake = gan_disc(fake_hidden.detach())
     errD_fake.backward(mone)
+    average_gradients(gan_disc, world_size)
 
     optimizer_gan_d.step()
     errD = -(errD_real - errD_fake)
@@ -651,7 +781,7 @@ def train_gan_d_into_ae(whichdecoder, batch):
 
     # positive samples ----------------------------
     # generate real codes
-    source, target, lengths = batch
+    source, target, lengths = shard_batch(batch, rank, world_size)
     source = to_gpu(args.cuda, Variable(source))
     target = to_gpu(args.cuda, Variable(target))
 
@@ -663,18 +793,20 @@ def train_gan_d_into_ae(whichdecoder, batch):
     # loss / backprop
     errD_real = gan_disc(real_hidden)
     errD_real.backward(one)
+    average_gradients(autoencoder, world_size)
 
     # `clip_grad_norm` to prvent exploding gradient problem in RNNs / LSTMs
-    torch.nn.utils.clip_grad_norm(autoencoder.parameters(), args.clip)
+    torch.nn.utils.clip_grad_norm_(autoencoder.parameters(), args.clip)
 
     optimizer_ae.step()
 
     return errD_real
 
 
-print("Training...")
-with open("{}/logs.txt".format(args.outf), 'a') as f:
-    f.write('Training...\n')
+if master:
+    print("Training...")
+    with open("{}/logs.txt".format(args.outf), 'a') as f:
+        f.write('Training...\n')
 
 # schedule of increasing GAN training loops
 if args.niters_gan_schedule != "":
@@ -686,33 +818,85 @@ niter_gan = 1
 fixed_noise = to_gpu(args.cuda,
                      Variable(torch.ones(args.batch_size, args.z_size)))
 fixed_noise.data.normal_(0, 1)
-one = to_gpu(args.cuda, torch.FloatTensor([1]))
+one = to_gpu(args.cuda, torch.tensor(1.))
 mone = one * -1
 
 # train LM to validation set
-# train_lm('./{}/lm_samples'.format(args.outf))
+# lm_samples = train_lm()
 # sys.exit()
 
 best_ppl = None
 impatience = 0
 all_ppl = []
+start_epoch = args.load_epoch
+resume_niter = 0
+if args.resume:
+    checkpoint = torch.load('{}/checkpoint.pt'.format(args.outf),
+                            weights_only=False)
+    autoencoder.load_state_dict(checkpoint['autoencoder'])
+    gan_gen.load_state_dict(checkpoint['gan_gen'])
+    gan_disc.load_state_dict(checkpoint['gan_disc'])
+    classifier.load_state_dict(checkpoint['classifier'])
+    optimizer_ae.load_state_dict(checkpoint['optimizer_ae'])
+    optimizer_gan_g.load_state_dict(checkpoint['optimizer_gan_g'])
+    optimizer_gan_d.load_state_dict(checkpoint['optimizer_gan_d'])
+    optimizer_classify.load_state_dict(checkpoint['optimizer_classify'])
+    niter_gan = checkpoint['niter_gan']
+    autoencoder.noise_radius = checkpoint['noise_radius']
+    best_ppl = checkpoint['best_ppl']
+    impatience = checkpoint['impatience']
+    all_ppl = checkpoint['all_ppl']
+    fixed_noise.data.copy_(checkpoint['fixed_noise'])
+    # same batches, in the same order, as the interrupted epoch
+    for name, data, order in zip(train_names, train_unshuffled,
+                                 checkpoint['train_order']):
+        corpus.data[name][:] = [data[i] for i in order]
+    train1_data = batchify(corpus.data[train_names[0]], args.batch_size, shuffle=False)
+    train2_data = batchify(corpus.data[train_names[1]], args.batch_size, shuffle=False)
+    start_epoch = checkpoint['epoch']
+    resume_niter = checkpoint['niter']
+    resume_niter_global = checkpoint['niter_global']
+    set_rng_state(checkpoint['rng'])
+    if rank > 0:
+        # the checkpoint holds process 0's state; keep the noise distinct
+        torch.manual_seed(args.seed + rank + resume_niter_global)
+    if master:
+        print("Resuming at epoch {} step {}".format(start_epoch, resume_niter))
+        with open("{}/logs.txt".format(args.outf), 'a') as f:
+            f.write("Resuming at epoch {} step {}\n".format(start_epoch, resume_niter))
+
+preempted = False
+signal.signal(signal.SIGTERM, handle_sigterm)
+
+# throughput, for --max_steps benchmarks
+total_steps = 0
+bench_start_time = None
+
 try:
-    for epoch in range(args.load_epoch, args.epochs+args.load_epoch):
-        # update gan training schedule
-        if epoch in gan_schedule:
-            niter_gan += 1
-            print("GAN training loop schedule increased to {}".format(niter_gan))
-            with open("{}/logs.txt".format(args.outf), 'a') as f:
-                f.write("GAN training loop schedule increased to {}\n".
-                        format(niter_gan))
+    for epoch in range(start_epoch, args.epochs+args.load_epoch):
+        if resume_niter > 0:
+            # continue mid-epoch; the schedule was already updated
+            niter = resume_niter
+            niter_global = resume_niter_global
+            resume_niter = 0
+        else:
+            # update gan training schedule
+            if epoch in gan_schedule:
+                niter_gan += 1
+                if master:
+                    print("GAN training loop schedule increased to {}".format(niter_gan))
+                    with open("{}/logs.txt".format(args.outf), 'a') as f:
+                        f.write("GAN training loop schedule increased to {}\n".
+                                format(niter_gan))
+            niter = 0
+            niter_global = 1
 
         total_loss_ae1 = 0
         total_loss_ae2 = 0
         classify_loss = 0
+        classify_acc = 0
         epoch_start_time = time.time()
         start_time = time.time()
-        niter = 0
-        niter_global = 1
 
         # loop through all batches in training data
         while niter < len(train1_data) and niter < len(train2_data):
@@ -721,14 +905,23 @@ try:
             for i in range(args.niters_ae):
                 if niter == len(train1_data):
                     break  # end of epoch
-                total_loss_ae1, start_time = \
-                    train_ae(1, train1_data[niter], total_loss_ae1, start_time, niter)
-                total_loss_ae2, _ = \
-                    train_ae(2, train2_data[niter], total_loss_ae2, start_time, niter)
+                if args.sequential_ae:
+                    total_loss_ae1, start_time, code1 = \
+                        train_ae(1, train1_data[niter], total_loss_ae1, start_time, niter)
+                    total_loss_ae2, _, code2 = \
+                        train_ae(2, train2_data[niter], total_loss_ae2, start_time, niter)
+                else:
+                    total_loss_ae1, total_loss_ae2, start_time, code1, code2 = \
+                        train_ae_joint(train1_data[niter], train2_data[niter],
+                                       total_loss_ae1, total_loss_ae2, start_time, niter)
 
                 # train classifier ----------------------------
-                classify_loss1, classify_acc1 = train_classifier(1, train1_data[niter])
-                classify_loss2, classify_acc2 = train_classifier(2, train2_data[niter])
+                if not args.reuse_ae_codes:
+                    code1, code2 = None, None
+                classify_loss1, classify_acc1 = \
+                    train_classifier(1, train1_data[niter], code1)
+                classify_loss2, classify_acc2 = \
+                    train_classifier(2, train2_data[niter], code2)
                 classify_loss = (classify_loss1 + classify_loss2) / 2
                 classify_acc = (classify_acc1 + classify_acc2) / 2
                 # reverse to autoencoder
@@ -767,33 +960,56 @@ try:
 
             niter_global += 1
             if niter_global % 100 == 0:
-                print('[%d/%d][%d/%d] Loss_D: %.4f (Loss_D_real: %.4f '
-                      'Loss_D_fake: %.4f) Loss_G: %.4f'
-                      % (epoch, args.epochs, niter, len(train1_data),
-                         errD.data[0], errD_real.data[0],
-                         errD_fake.data[0], errG.data[0]))
-                print("Classify loss: {:5.2f} | Classify accuracy: {:3.3f}\n".format(
-                        classify_loss, classify_acc))
-                with open("{}/logs.txt".format(args.outf), 'a') as f:
-                    f.write('[%d/%d][%d/%d] Loss_D: %.4f (Loss_D_real: %.4f '
-                            'Loss_D_fake: %.4f) Loss_G: %.4f\n'
-                            % (epoch, args.epochs, niter, len(train1_data),
-                               errD.data[0], errD_real.data[0],
-                               errD_fake.data[0], errG.data[0]))
-                    f.write("Classify loss: {:5.2f} | Classify accuracy: {:3.3f}\n".format(
+                if master:
+                    print('[%d/%d][%d/%d] Loss_D: %.4f (Loss_D_real: %.4f '
+                          'Loss_D_fake: %.4f) Loss_G: %.4f'
+                          % (epoch, args.epochs, niter, len(train1_data),
+                             errD.item(), errD_real.item(),
+                             errD_fake.item(), errG.item()))
+                    print("Classify loss: {:5.2f} | Classify accuracy: {:3.3f}\n".format(
                             classify_loss, classify_acc))
+                    with open("{}/logs.txt".format(args.outf), 'a') as f:
+                        f.write('[%d/%d][%d/%d] Loss_D: %.4f (Loss_D_real: %.4f '
+                                'Loss_D_fake: %.4f) Loss_G: %.4f\n'
+                                % (epoch, args.epochs, niter, len(train1_data),
+                                   errD.item(), errD_real.item(),
+                                   errD_fake.item(), errG.item()))
+                        f.write("Classify loss: {:5.2f} | Classify accuracy: {:3.3f}\n".format(
+                                classify_loss, classify_acc))
 
                 # exponentially decaying noise on autoencoder
                 autoencoder.noise_radius = \
                     autoencoder.noise_radius*args.noise_anneal
 
-                if (niter_global-1) % 3000 == 0:
+                if (niter_global-1) % 3000 == 0 and master:
                     evaluate_generator(fixed_noise, "epoch{}_step{}".format(epoch, niter_global))
 
+            # timing starts after the first step
+            total_steps += 1
+            if bench_start_time is None:
+                bench_start_time = time.time()
+            if args.max_steps > 0 and total_steps == args.max_steps:
+                if master:
+                    report_throughput(total_steps-1, time.time()-bench_start_time)
+                sys.exit()
+
+            # a SIGTERM to any process stops all of them
+            preempted = broadcast_flag(preempted, world_size, reduce_any=True)
+            if preempted or (args.checkpoint_interval > 0 and
+                             niter_global % args.checkpoint_interval == 0):
+                if master:
+                    save_checkpoint(epoch, niter, niter_global)
+                if preempted:
+                    if master:
+                        print("Received SIGTERM; exiting after checkpoint")
+                        with open("{}/logs.txt".format(args.outf), 'a') as f:
+                            f.write("\nReceived SIGTERM; exiting after checkpoint\n")
+                    sys.exit()
+
                 #     # evaluate with lm
                 #     if not args.no_earlystopping and epoch > args.min_epochs:
                 #         ppl = train_reverse_lm(
-                #             eval_path='./{}/lm_samples.txt'.format(args.outf),
+                #             eval_path=lm_samples+'.txt',
                 #             save_path="./{}/epoch{}_step{}_lm_generations".format(
                 #                 args.outf, epoch, niter_global))
                 #         print("Perplexity {}".format(ppl))
@@ -807,50 +1023,63 @@ try:
 
         # end of epoch ----------------------------
         # evaluation
-        test_loss, accuracy = evaluate_autoencoder(1, test1_data[:1000], epoch)
-        print('-' * 89)
-        print('| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} | '
-              'test ppl {:5.2f} | acc {:3.3f}'.
-              format(epoch, (time.time() - epoch_start_time),
-                     test_loss, math.exp(test_loss), accuracy))
-        print('-' * 89)
-        with open("{}/logs.txt".format(args.outf), 'a') as f:
-            f.write('-' * 89)
-            f.write('\n| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} |'
-                    ' test ppl {:5.2f} | acc {:3.3f}\n'.
-                    format(epoch, (time.time() - epoch_start_time),
-                           test_loss, math.exp(test_loss), accuracy))
-            f.write('-' * 89)
-            f.write('\n')
-
-        test_loss, accuracy = evaluate_autoencoder(2, test2_data[:1000], epoch)
-        print('-' * 89)
-        print('| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} | '
-              'test ppl {:5.2f} | acc {:3.3f}'.
-              format(epoch, (time.time() - epoch_start_time),
-                     test_loss, math.exp(test_loss), accuracy))
-        print('-' * 89)
-        with open("{}/logs.txt".format(args.outf), 'a') as f:
-            f.write('-' * 89)
-            f.write('\n| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} |'
-                    ' test ppl {:5.2f} | acc {:3.3f}\n'.
-                    format(epoch, (time.time() - epoch_start_time),
-                           test_loss, math.exp(test_loss), accuracy))
-            f.write('-' * 89)
-            f.write('\n')
-
-        # save model for epoch
-        save_model(epoch)
+        if master:
+            test_loss, accuracy = evaluate_autoencoder(1, test1_data[:1000], epoch)
+            print('-' * 89)
+            print('| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} | '
+                  'test ppl {:5.2f} | acc {:3.3f}'.
+                  format(epoch, (time.time() - epoch_start_time),
+                         test_loss, math.exp(test_loss), accuracy))
+            print('-' * 89)
+            with open("{}/logs.txt".format(args.outf), 'a') as f:
+                f.write('-' * 89)
+                f.write('\n| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} |'
+                        ' test ppl {:5.2f} | acc {:3.3f}\n'.
+                        format(epoch, (time.time() - epoch_start_time),
+                               test_loss, math.exp(test_loss), accuracy))
+                f.write('-' * 89)
+                f.write('\n')
+
+            test_loss, accuracy = evaluate_autoencoder(2, test2_data[:1000], epoch)
+            print('-' * 89)
+            print('| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} | '
+                  'test ppl {:5.2f} | acc {:3.3f}'.
+                  format(epoch, (time.time() - epoch_start_time),
+                         test_loss, math.exp(test_loss), accuracy))
+            print('-' * 89)
+            with open("{}/logs.txt".format(args.outf), 'a') as f:
+                f.write('-' * 89)
+                f.write('\n| end of epoch {:3d} | time: {:5.2f}s | test loss {:5.2f} |'
+                        ' test ppl {:5.2f} | acc {:3.3f}\n'.
+                        format(epoch, (time.time() - epoch_start_time),
+                               test_loss, math.exp(test_loss), accuracy))
+                f.write('-' * 89)
+                f.write('\n')
 
-        if args.debug:
-            continue
+            # save model for epoch
+            save_model(epoch)
 
         # shuffle between epochs
-        train1_data = batchify(corpus.data['train1'], args.batch_size, shuffle=True)
-        train2_data = batchify(corpus.data['train2'], args.batch_size, shuffle=True)
+        if not args.debug:
+            train1_data = batchify(corpus.data['train1'], args.batch_size, shuffle=True)
+            train2_data = batchify(corpus.data['train2'], args.batch_size, shuffle=True)
+
+        preempted = broadcast_flag(preempted, world_size, reduce_any=True)
+        if preempted or args.checkpoint_interval > 0:
+            if master:
+                save_checkpoint(epoch+1, 0, 1)
+            if preempted:
+                if master:
+                    print("Received SIGTERM; exiting after checkpoint")
+                    with open("{}/logs.txt".format(args.outf), 'a') as f:
+                        f.write("\nReceived SIGTERM; exiting after checkpoint\n")
+                sys.exit()
 except KeyboardInterrupt:
     print('Ending training...')
 
+if not master:
+    sys.exit()
+
 
 test_loss, accuracy = evaluate_autoencoder(1, test1_data, epoch+1)
 print('-' * 89)
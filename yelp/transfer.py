@@ -6,7 +6,6 @@ import numpy as np
 import random
 import sys
 import json
-import kenlm
 import subprocess
 
 import torch
@@ -15,7 +14,8 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
 
-from utils import to_gpu, Corpus, batchify, truncate, get_ppl
+from utils import to_gpu, Corpus, batchify, truncate, score_sentences, \
+    cached_ngram_lm
 from models import Seq2Seq2Decoder, Seq2Seq, MLP_D, MLP_G, MLP_Classify, load_models
 
 parser = argparse.ArgumentParser(description='PyTorch ARAE for Text')
@@ -41,8 +41,21 @@ parser.add_argument('--lowercase', action='store_true',
 # Evaluation Arguments
 parser.add_argument('--batch_size', type=int, default=32,
                     help='batch size')
-parser.add_argument('--lm_path', type=str, default="", #TODO
-                    help='language model path')
+parser.add_argument('--lm_path', type=str, default="",
+                    help='KenLM model for the perplexity of the transfers '
+                         '(default: trained on the validation sentences of '
+                         'both domains, as train.py\'s train_lm, once per '
+                         'distinct text in --lm_cache)')
+parser.add_argument('--kenlm_path', type=str, default='../Data/kenlm',
+                    help='path to kenlm directory')
+parser.add_argument('--lm_cache', type=str, default='./lm_cache',
+                    help='directory of n-gram LMs trained on fixed data, '
+                         'by a hash of their training text, N and vocab')
+parser.add_argument('--N', type=int, default=5,
+                    help='N-gram order for training n-gram language model')
+parser.add_argument('--lm_workers', type=int, default=1,
+                    help='processes scoring the transfers with the '
+                         'language model')
 parser.add_argument('--ft_path', type=str, default="", #TODO
                     help='language model path')
 parser.add_argument('--sample', action='store_true',
@@ -85,6 +98,10 @@ if not os.path.isdir('{}/eval'.format(args.load_path)):
 # (Path to textfile, Name, Use4Vocab)
 datafiles = [(os.path.join(args.data_path, "test1.txt"), "test1", False),
              (os.path.join(args.data_path, "test2.txt"), "test2", True)]
+if not args.lm_path:
+    # training text of the language model
+    datafiles += [(os.path.join(args.data_path, "valid1.txt"), "valid1", False),
+                  (os.path.join(args.data_path, "valid2.txt"), "valid2", False)]
 if args.load_vocab != "":
     vocabdict = json.load(args.load_vocab)
 else:
@@ -130,10 +147,11 @@ def evaluate_transfer(whichdecoder, data_source, epoch):
     for i, batch in enumerate(data_source):
         source, target, lengths = batch
         target = target.view(source.size(0), -1)
-        source = to_gpu(args.cuda, Variable(source, volatile=True))
+        source = to_gpu(args.cuda, source)
 
         mask = target.gt(0)
-        hidden = autoencoder(0, source, lengths, noise=False, encode_only=True)
+        with torch.no_grad():
+            hidden = autoencoder(0, source, lengths, noise=False, encode_only=True)
 
         # output: batch x seq_len x ntokens
         if whichdecoder == 1:
@@ -187,9 +205,27 @@ with open(ft_file, 'w') as f:
         f.write("__label__1 "+sent+"\n")
 
 # Perplexity (NOT reverse ppl)
-model = kenlm.Model(args.lm_path)
-ppl = get_ppl(model, transfer1+transfer2)
-print("Perplexity: {}".format(ppl))
+if args.lm_path:
+    lm_path = args.lm_path
+else:
+    # the same validation sentences give the same (cached) LM on every run
+    sentences = [truncate([corpus.dictionary.idx2word[x] for x in idx[1:]])
+                 for name in ("valid1", "valid2") for idx in corpus.data[name]]
+    lm_path = cached_ngram_lm(kenlm_path=args.kenlm_path,
+                              sentences=sentences,
+                              vocab=corpus.dictionary.word2idx.keys(),
+                              N=args.N,
+                              cache_dir=args.lm_cache) + ".binary"
+lm_scores = score_sentences(lm_path, transfer1+transfer2,
+                            nworkers=args.lm_workers)
+print("Perplexity: {}".format(lm_scores.ppl))
+
+# log10 probability and word count of each transferred sentence, in the
+# order of transfer_file
+lm_file = "{}/eval/transfer_epoch{}_lm.txt".format(args.load_path, args.epoch)
+with open(lm_file, 'w') as f:
+    for score, word_count in zip(lm_scores.scores, lm_scores.word_counts):
+        f.write("{:.4f}\t{}\n".format(score, word_count))
 
 curdir = os.getcwd()
 
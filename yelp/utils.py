@@ -1,4 +1,12 @@
 import os
+import atexit
+import collections
+import hashlib
+import itertools
+import json
+import multiprocessing
+import queue
+import threading
 import torch
 import numpy as np
 import random
@@ -19,6 +27,101 @@ def to_gpu(gpu, var):
     return var
 
 
+def get_rng_state(gpu=False):
+    """Snapshot of the python, numpy and torch random number generators"""
+    state = {'random': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if gpu:
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state:
+        torch.cuda.set_rng_state(state['cuda'])
+
+
+def init_distributed():
+    """
+    Join the process group of a torchrun launch (RANK, WORLD_SIZE,
+    MASTER_ADDR and MASTER_PORT in the environment) over gloo.
+    Returns (rank, world_size); (0, 1) when not launched that way.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    import torch.distributed as dist
+    dist.init_process_group(backend='gloo')
+    return dist.get_rank(), dist.get_world_size()
+
+
+def shard_batch(batch, rank, world_size):
+    """
+    This process's rows (rank, rank+world_size, ...) of a batchify batch,
+    trimmed to their longest sentence so that rows stay sorted by length
+    """
+    if world_size == 1:
+        return batch
+    source, target, lengths = batch
+    rows = list(range(rank, source.size(0), world_size))
+    lengths = [lengths[i] for i in rows]
+    maxlen = lengths[0]
+    idx = torch.LongTensor(rows)
+    if source.is_cuda:
+        idx = idx.cuda()
+    target = target.view(source.size(0), -1).index_select(0, idx)
+    source = source.index_select(0, idx)
+    return (source[:, :maxlen].contiguous(),
+            target[:, :maxlen].contiguous().view(-1), lengths)
+
+
+def average_gradients(model, world_size):
+    """All-reduce the gradients of model to their mean over all processes"""
+    if world_size == 1:
+        return
+    import torch.distributed as dist
+    grads = [p.grad.data for p in model.parameters() if p.grad is not None]
+    if not grads:
+        return
+    # one flat buffer: a single all-reduce instead of one per parameter
+    flat = torch.cat([g.contiguous().view(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= world_size
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset+g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def broadcast_params(model, world_size):
+    """Copy the parameters (and buffers) of process 0 to all processes"""
+    if world_size == 1:
+        return
+    import torch.distributed as dist
+    for p in model.state_dict().values():
+        dist.broadcast(p, 0)
+
+
+def broadcast_flag(flag, world_size, reduce_any=False):
+    """
+    Process 0's value of a boolean decision on every process, or with
+    reduce_any whether it is set on any process
+    """
+    if world_size == 1:
+        return flag
+    import torch.distributed as dist
+    t = torch.FloatTensor([1 if flag else 0])
+    if reduce_any:
+        dist.all_reduce(t, op=dist.ReduceOp.MAX)
+    else:
+        dist.broadcast(t, 0)
+    return t[0] > 0
+
+
 class Dictionary(object):
     def __init__(self, word2idx=None):
         if word2idx is None:
@@ -174,6 +277,106 @@ def length_sort(items, lengths, descending=True):
     return list(items), list(lengths)
 
 
+def snapshot(obj):
+    """
+    Copy of a (nested) state dict that later training steps won't modify:
+    tensors are moved to cpu (or cloned if already there)
+    """
+    if torch.is_tensor(obj):
+        return obj.cpu() if obj.is_cuda else obj.clone()
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def save_state(state, path):
+    """torch.save via a temporary file, so a kill mid-write keeps the old one"""
+    with open(path+'.tmp', 'wb') as f:
+        torch.save(state, f)
+    os.rename(path+'.tmp', path)
+
+
+def write_sentences(path, columns, idx2word, eos=None, sep="", mode='w'):
+    """
+    Write records of sentences given as word indices. columns holds one
+    list of index batches (numpy, batch x len) per line of a record; the
+    i-th rows of all columns are written on successive lines, followed
+    by sep. With eos set, sentences are truncated at its first occurrence.
+    """
+    rows = [itertools.chain(*batches) for batches in columns]
+    with open(path, mode) as f:
+        for record in zip(*rows):
+            for idx in record:
+                words = [idx2word[x] for x in idx]
+                if eos is not None and eos in words:
+                    words = words[:words.index(eos)]
+                f.write(" ".join(words))
+                f.write("\n")
+            f.write(sep)
+
+
+class ArtifactWriter(object):
+    """
+    Writes model checkpoints and text outputs on a background thread, so
+    the training loop does not wait on serialization, detokenization and
+    disk. Jobs are run in the order they were queued; at most maxsize are
+    pending, after which put() blocks. Everything queued must be a snapshot
+    (see save(), and pass numpy copies of index matrices to put()).
+    An error in a job is raised on the next put() or flush().
+    """
+
+    def __init__(self, maxsize=8):
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        # daemon threads are killed at exit, so drain the queue first
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, fn, *args):
+        """Queue fn(*args)"""
+        self.check()
+        self.queue.put((fn, args))
+
+    def save(self, state, path):
+        """Queue torch.save of a snapshot of state (e.g. a state_dict)"""
+        self.put(save_state, snapshot(state), path)
+
+    def flush(self):
+        """Block until everything queued so far is written"""
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+
 def truncate(words):
     # truncate sentences to first occurrence of <eos>
     truncated_sent = []
@@ -186,10 +389,10 @@ def truncate(words):
     return sent
 
 
-def train_ngram_lm(kenlm_path, data_path, output_path, N):
+def build_ngram_lm(kenlm_path, data_path, output_path, N):
     """
     Trains a modified Kneser-Ney n-gram KenLM from a text file.
-    Creates a .arpa file to store n-grams.
+    Creates output_path.arpa and its binary version output_path.binary.
     """
     # create .arpa file of n-grams
     curdir = os.path.abspath(os.path.curdir)
@@ -203,6 +406,14 @@ def train_ngram_lm(kenlm_path, data_path, output_path, N):
               os.path.join(curdir, output_path)+".binary"
     os.system("cd "+os.path.join(kenlm_path, 'build')+" && "+command)
 
+
+def train_ngram_lm(kenlm_path, data_path, output_path, N):
+    """
+    Trains a modified Kneser-Ney n-gram KenLM from a text file.
+    Creates a .arpa file to store n-grams.
+    """
+    build_ngram_lm(kenlm_path, data_path, output_path, N)
+
     load_kenlm()
     # create language model
     model = kenlm.Model(output_path+".arpa")
@@ -210,17 +421,112 @@ def train_ngram_lm(kenlm_path, data_path, output_path, N):
     return model
 
 
-def get_ppl(lm, sentences):
+def cached_ngram_lm(kenlm_path, sentences, vocab, N, cache_dir):
+    """
+    Path (no extension) of an N-gram KenLM trained on the vocabulary words
+    (laplacian smoothing) and sentences (space delimited strings), found in
+    cache_dir by a hash of the training text, N and vocab; the LM is only
+    estimated when it isn't there yet. The training text is kept at
+    path.txt, the binary model at path.binary.
+    """
+    text = "".join(word+"\n" for word in vocab) + \
+           "".join(sent+"\n" for sent in sentences)
+    key = hashlib.sha1()
+    key.update(json.dumps({'N': N, 'vocab': list(vocab)}).encode('utf-8'))
+    key.update(text.encode('utf-8'))
+    path = os.path.join(cache_dir, "lm_{}gram_{}".format(N, key.hexdigest()))
+    if os.path.exists(path+".binary"):
+        return path
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # build under a temporary name so an interrupted build is never a hit
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path+".txt", "w") as f:
+        f.write(text)
+    build_ngram_lm(kenlm_path, tmp_path+".txt", tmp_path, N)
+    if not os.path.exists(tmp_path+".binary"):
+        raise RuntimeError("building the n-gram LM {} failed".format(path))
+    os.remove(tmp_path+".arpa")
+    os.rename(tmp_path+".txt", path+".txt")
+    os.rename(tmp_path+".binary", path+".binary")
+    return path
+
+
+# KenLM models loaded by load_lm, by path
+loaded_lms = {}
+
+
+def load_lm(path):
+    """
+    KenLM model at path, loaded once per process (and shared with forked
+    score_sentences workers); binary models are memory mapped
+    """
+    key = (os.path.realpath(path), os.path.getmtime(path))
+    if key not in loaded_lms:
+        load_kenlm()
+        config = kenlm.Config()
+        config.load_method = kenlm.LoadMethod.LAZY
+        loaded_lms[key] = kenlm.Model(path, config)
+    return loaded_lms[key]
+
+
+LMScores = collections.namedtuple('LMScores',
+                                  ['scores', 'word_counts', 'total', 'ppl'])
+
+# the KenLM model of a score_sentences() pool worker
+worker_lm = None
+
+
+def init_lm_worker(lm_path):
+    global worker_lm
+    worker_lm = load_lm(lm_path)
+
+
+def score_chunk(sentences, lm=None):
+    """log10 probabilities and word counts of sentences"""
+    lm = worker_lm if lm is None else lm
+    scores = np.array([lm.score(sent, bos=True, eos=False)
+                       for sent in sentences], dtype=np.float64)
+    word_counts = np.array([len(sent.split()) for sent in sentences],
+                           dtype=np.int64)
+    return scores, word_counts
+
+
+def score_sentences(lm, sentences, nworkers=1, chunk_size=2000):
+    """
+    Score sentences (space delimited strings) with a KenLM model, from <s>
+    and without </s>. lm is a kenlm.Model or the path of one (preferably a
+    binary); given a path and nworkers > 1, chunks of sentences are scored
+    by a pool of nworkers processes, each of which loads the model once.
+    Returns LMScores: the log10 probability and word count of each sentence,
+    their total log10 probability and the perplexity over all words.
+    """
+    if isinstance(lm, str) and nworkers > 1 and len(sentences) > chunk_size:
+        chunks = [sentences[i:i+chunk_size]
+                  for i in range(0, len(sentences), chunk_size)]
+        # fork, as the calling scripts can't be re-imported by spawned workers
+        ctx = multiprocessing.get_context('fork')
+        pool = ctx.Pool(min(nworkers, len(chunks)),
+                        initializer=init_lm_worker, initargs=(lm,))
+        try:
+            results = pool.map(score_chunk, chunks)
+        finally:
+            pool.terminate()
+        scores = np.concatenate([r[0] for r in results])
+        word_counts = np.concatenate([r[1] for r in results])
+    else:
+        if isinstance(lm, str):
+            lm = load_lm(lm)
+        scores, word_counts = score_chunk(sentences, lm)
+    total = float(scores.sum())
+    ppl = 10**-(total/word_counts.sum())
+    return LMScores(scores, word_counts, total, ppl)
+
+
+def get_ppl(lm, sentences, nworkers=1):
     """
-    Assume sentences is a list of strings (space delimited sentences)
+    Assume sentences is a list of strings (space delimited sentences);
+    see score_sentences
     """
-    total_nll = 0
-    total_wc = 0
-    for sent in sentences:
-        words = sent.strip().split()
-        score = lm.score(sent, bos=True, eos=False)
-        word_count = len(words)
-        total_wc += word_count
-        total_nll += score
-    ppl = 10**-(total_nll/total_wc)
-    return ppl
+    return score_sentences(lm, sentences, nworkers).ppl